@@ -1,19 +1,41 @@
 # -*- coding: utf-8 -*-
 import argparse
 import atexit
+import BaseHTTPServer
+import cgi
+import collections
+import csv
 import datetime
+import gc
+import gzip
+import hashlib
+import heapq
 import inspect
 import json
 import logging
+import marshal
+import math
 import os
+import pipes
 import platform
+import posixpath
+import Queue
+import random
 import re
 import urllib2
 import shutil
+import signal
+import SimpleHTTPServer
 import socket
+import SocketServer
+import sqlite3
+import stat
 import subprocess
 import sys
+import tarfile
+import threading
 import time
+import zipfile
 
 try:
     import selenium
@@ -27,6 +49,12 @@ except ImportError:
     print('Please install package selenium')
     exit(1)
 
+# only to lock build cache shared by concurrent runs
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 class Util(object):
     LOGGER_NAME = __file__
@@ -99,6 +127,19 @@ class Util(object):
         else:
             return ''
 
+    # address of host that other devices could reach, found by the route to a
+    # public address, while nothing is sent
+    @staticmethod
+    def get_host_ip():
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect(('8.8.8.8', 80))
+            return s.getsockname()[0]
+        except socket.error:
+            return socket.gethostbyname(socket.gethostname())
+        finally:
+            s.close()
+
     @staticmethod
     def get_logger():
         return logging.getLogger(Util.LOGGER_NAME)
@@ -122,7 +163,7 @@ class Util(object):
 
     @staticmethod
     def has_pkg(pkg):
-        cmd = Cmd('dpkg -s ' + pkg)
+        cmd = Cmd('dpkg -s ' + pkg, timeout=Cmd.PROBE_TIMEOUT, max_lines=1)
         if cmd.status:
             return False
         else:
@@ -149,33 +190,66 @@ class Util(object):
             return s
 
 
+# Properties and GLES info of device are fetched together in one adb round
+# trip on first use, and cached afterwards.
 class AndroidDevice(object):
     def __init__(self, id):
         self.id = id
+        self.props = None
+        self.gles_lines = None
+        self.lock = threading.Lock()
 
     def get_prop(self, key):
-        cmd = AdbShellCmd('getprop | grep %s' % key, device_id=self.id)
-        match = re.search('\[%s\]: \[(.*)\]' % key, cmd.output)
-        if match:
-            return match.group(1)
+        self._fetch()
+        if key in self.props:
+            return self.props[key]
         else:
             Util.error('Could not find %s' % key)
 
+    def get_gles_lines(self):
+        self._fetch()
+        return self.gles_lines
+
+    def _fetch(self):
+        with self.lock:
+            if self.props is not None:
+                return
+            batch = AdbShellBatch(self.id)
+            props_index = batch.add('getprop')
+            gles_index = batch.add('dumpsys SurfaceFlinger | grep GLES')
+            results = batch.run(Cmd.PROBE_TIMEOUT)
+            self.props = {}
+            for line in results[props_index][1].split('\n'):
+                match = re.match('^\[(.*?)\]: \[(.*)\]$', line.strip())
+                if match:
+                    self.props[match.group(1)] = match.group(2)
+            self.gles_lines = results[gles_index][1].split('\n')
+
 
 class AndroidDevices():
     def __init__(self):
+        self._logger = Util.get_logger()
         self.devices = []
-        cmd = Cmd('adb devices')
-        for device_line in cmd.output.split('\n'):
-            if re.match('List of devices attached', device_line):
-                continue
-            elif re.match('^\s*$', device_line):
-                continue
-            elif re.search('offline', device_line):
-                continue
-            else:
-                id = device_line.split()[0]
-                self.devices.append(AndroidDevice(id))
+        if AdbClient.shared:
+            try:
+                devices = AdbClient.shared.get_devices()
+            except socket.error as e:
+                Util.error('Could not list Android devices: %s' % e)
+            for (id, state) in devices:
+                if state != 'offline':
+                    self.devices.append(AndroidDevice(id))
+        else:
+            cmd = Cmd('adb devices')
+            for device_line in cmd.output.split('\n'):
+                if re.match('List of devices attached', device_line):
+                    continue
+                elif re.match('^\s*$', device_line):
+                    continue
+                elif re.search('offline', device_line):
+                    continue
+                else:
+                    id = device_line.split()[0]
+                    self.devices.append(AndroidDevice(id))
 
         if len(self.devices) < 1:
             Util.error('Could not find available Android device')
@@ -193,13 +267,119 @@ class AndroidDevices():
                 Util.error('Cound not find Android device with id %s' % device_id)
 
 
+# Child process of a shell command, whose stdout and stderr are drained by
+# threads, so that a full pipe never blocks the child. Lines are passed to
+# callback as they come, and only the last max_lines of them are kept. With
+# stream, the process could be iterated for its lines. The whole process group
+# is killed on timeout.
+class CmdProcess(object):
+    MAX_LINES = 10000
+    KILL_WAIT = 5
+
+    def __init__(self, cmd, timeout=None, callback=None, max_lines=MAX_LINES, stream=False):
+        self.cmd = cmd
+        self.callback = callback
+        self.stream = stream
+        self.lines = collections.deque(maxlen=max_lines)
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.timed_out = False
+        if timeout:
+            self.deadline = time.time() + timeout
+        else:
+            self.deadline = None
+
+        if platform.system() == 'Windows':
+            self.process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        else:
+            self.process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setsid)
+        self.threads = []
+        for pipe in [self.process.stdout, self.process.stderr]:
+            thread = threading.Thread(target=self._drain, args=(pipe,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    @property
+    def output(self):
+        with self.lock:
+            return ''.join(self.lines)
+
+    def __iter__(self):
+        if not self.stream:
+            raise ValueError('Only process with stream could be iterated')
+        open_count = len(self.threads)
+        while open_count:
+            try:
+                line = self.queue.get(timeout=self._get_remaining())
+            except Queue.Empty:
+                self._timeout()
+                continue
+            if line is None:
+                open_count -= 1
+            else:
+                yield line
+        self.wait()
+
+    def wait(self):
+        for thread in self.threads:
+            thread.join(self._get_remaining())
+            if thread.is_alive():
+                self._timeout()
+                # a child out of the process group may still hold the pipe
+                thread.join(self.KILL_WAIT)
+        while self.process.poll() is None:
+            if self.deadline and time.time() > self.deadline:
+                self._timeout()
+                break
+            time.sleep(0.01)
+        return self.process.wait()
+
+    def kill(self):
+        if platform.system() == 'Windows':
+            devnull = open(os.devnull, 'w')
+            subprocess.call('taskkill /F /T /PID %d' % self.process.pid, stdout=devnull, stderr=devnull)
+            devnull.close()
+        else:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def _timeout(self):
+        self.timed_out = True
+        self.deadline = None
+        self.kill()
+
+    def _get_remaining(self):
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+    def _drain(self, pipe):
+        for line in iter(pipe.readline, ''):
+            with self.lock:
+                self.lines.append(line)
+                if self.callback:
+                    self.callback(line)
+            if self.stream:
+                self.queue.put(line)
+        pipe.close()
+        if self.stream:
+            self.queue.put(None)
+
+
 class Cmd(object):
-    def __init__(self, cmd, show_cmd=False, dryrun=False, abort=False):
+    # timeout of commands probing environment
+    PROBE_TIMEOUT = 30
+
+    def __init__(self, cmd, show_cmd=False, dryrun=False, abort=False, timeout=None, callback=None, max_lines=CmdProcess.MAX_LINES):
         self._logger = Util.get_logger()
         self.cmd = cmd
         self.show_cmd = show_cmd
         self.dryrun = dryrun
         self.abort = abort
+        self.timed_out = False
 
         if self.show_cmd:
             self._logger.info('[CMD]: %s' % self.cmd)
@@ -210,35 +390,255 @@ class Cmd(object):
             self.process = None
             return
 
-        tmp_output = ''
-        process = subprocess.Popen(self.cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        while True:
-            nextline = process.stdout.readline()
-            if nextline == '' and process.poll() is not None:
-                break
-            tmp_output += nextline
-
-        self.status = process.returncode
-        (out, error) = process.communicate()
-        self.output = tmp_output + out + error
-        self.process = process
+        self._execute(timeout, callback, max_lines)
+        if self.timed_out:
+            self._logger.warning('Killed %s after %s seconds' % (cmd, timeout))
 
         if self.abort and self.status:
-            Util.error('Failed to execute %s' % cmd, error_code=self.status)
+            Util.error('Failed to execute %s' % cmd)
+
+    def _execute(self, timeout, callback, max_lines):
+        process = CmdProcess(self.cmd, timeout, callback, max_lines)
+        self.status = process.wait()
+        self.output = process.output
+        self.timed_out = process.timed_out
+        self.process = process.process
 
 
 class AdbShellCmd(Cmd):
-    def __init__(self, cmd, device_id, dryrun=False, abort=False):
+    def __init__(self, cmd, device_id, dryrun=False, abort=False, timeout=None):
         fail_str = 'FAIL'
-        cmd = 'adb -s %s shell "(%s) || echo %s"' % (device_id, cmd, fail_str)
-        super(AdbShellCmd, self).__init__(cmd, dryrun, abort=False)
-        if re.search('FAIL', self.output):
+        self.device_id = device_id
+        if AdbClient.shared:
+            shell_cmd = '(%s) || echo %s' % (cmd, fail_str)
+        else:
+            shell_cmd = 'adb -s %s shell "(%s) || echo %s"' % (device_id, cmd, fail_str)
+        super(AdbShellCmd, self).__init__(shell_cmd, dryrun=dryrun, abort=False, timeout=timeout)
+        if re.search('FAIL', self.output) or self.status or self.timed_out:
             if abort:
-                Util.error('Failed to execute %s' % cmd, error_code=self.status)
+                Util.error('Failed to execute %s on Android device %s' % (cmd, device_id))
             self.status = False
         else:
             self.status = True
 
+    def _execute(self, timeout, callback, max_lines):
+        if not AdbClient.shared:
+            super(AdbShellCmd, self)._execute(timeout, callback, max_lines)
+            return
+        self.process = None
+        self.status = 0
+        try:
+            (self.output, self.timed_out) = AdbClient.shared.shell(self.device_id, self.cmd, timeout)
+        except socket.error as e:
+            self._logger.warning('Could not run %s on Android device %s: %s' % (self.cmd, self.device_id, e))
+            (self.status, self.output, self.timed_out) = (1, '', False)
+
+
+# Shell commands run on Android device in one adb round trip. Output and exit
+# code of each command are delimited by marker lines with a random token, and
+# commands are split into several round trips only if the script would be too
+# long for adb.
+class AdbShellBatch(object):
+    MAX_SCRIPT_LENGTH = 4000
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.cmds = []
+        self.results = []
+
+    # Return index of cmd in results
+    def add(self, cmd):
+        self.cmds.append(cmd)
+        return len(self.cmds) - 1
+
+    # results are (status, output) of commands in order
+    def run(self, timeout=None):
+        self.results = []
+        token = 'ADB-BATCH-%016x' % random.getrandbits(64)
+        scripts = []
+        script = ''
+        for (index, cmd) in enumerate(self.cmds):
+            # an extra newline puts end marker on its own line, and is dropped when lines are joined back
+            part = 'echo "%s begin %d"; (%s) 2>&1; status=$?; echo; echo "%s end %d $status"; ' % (token, index, cmd, token, index)
+            if script and len(script) + len(part) > self.MAX_SCRIPT_LENGTH:
+                scripts.append(script)
+                script = ''
+            script += part
+        if script:
+            scripts.append(script)
+
+        results = {}
+        for script in scripts:
+            if AdbClient.shared:
+                try:
+                    (output, _) = AdbClient.shared.shell(self.device_id, script, timeout)
+                except socket.error as e:
+                    Util.error('Could not run commands on Android device %s: %s' % (self.device_id, e))
+            else:
+                output = Cmd('adb -s %s shell %s' % (self.device_id, self._quote(script)), timeout=timeout).output
+            # old adb translates newline to CRLF
+            lines = output.replace('\r\n', '\n').split('\n')
+            index = None
+            for line in lines:
+                match = re.match('^%s (begin|end) (\d+)(?: (\d+))?$' % token, line)
+                if not match:
+                    if index is not None:
+                        output_lines.append(line)
+                elif match.group(1) == 'begin':
+                    index = int(match.group(2))
+                    output_lines = []
+                elif index is not None:
+                    results[index] = (int(match.group(3)), '\n'.join(output_lines))
+                    index = None
+        for index in range(len(self.cmds)):
+            if index not in results:
+                Util.error('Could not get result of %s on Android device %s' % (self.cmds[index], self.device_id))
+            self.results.append(results[index])
+        return self.results
+
+    @staticmethod
+    def _quote(script):
+        if platform.system() == 'Windows':
+            return '"%s"' % script.replace('"', '\\"')
+        return pipes.quote(script)
+
+
+# Client of adb server over its host protocol, used instead of spawning adb
+# for each command if shared is set. A shell service takes over the connection
+# it runs on, so connections already switched to the transport of a device are
+# pooled and refilled in background, saving the handshake of the next command.
+# Failures, including FAIL replies of adb server, are raised as socket.error.
+class AdbClient(object):
+    POOL_SIZE = 2
+    shared = None
+
+    def __init__(self, host='localhost', port=5037):
+        self._logger = Util.get_logger()
+        self.host = host
+        self.port = port
+        self.lock = threading.Lock()
+        # serial -> connections switched to its transport
+        self.pool = {}
+
+    # Return (serial, state) of devices
+    def get_devices(self):
+        s = self._connect()
+        try:
+            self._request(s, 'host:devices')
+            data = self._read(s, int(self._read(s, 4), 16))
+        finally:
+            s.close()
+        devices = []
+        for line in data.splitlines():
+            fields = line.split('\t')
+            if len(fields) == 2:
+                devices.append((fields[0], fields[1]))
+        return devices
+
+    # Return (output, timed_out) of cmd, where output is partial on timeout
+    def shell(self, serial, cmd, timeout=None):
+        (s, pooled) = self._get_transport(serial)
+        try:
+            try:
+                self._request(s, 'shell:' + cmd)
+            # pooled connection may be closed since, e.g., device reconnected
+            except socket.error:
+                if not pooled:
+                    raise
+                s.close()
+                s = self._connect_transport(serial)
+                self._request(s, 'shell:' + cmd)
+            self._refill(serial)
+            s.settimeout(timeout)
+            chunks = []
+            timed_out = False
+            try:
+                while True:
+                    chunk = s.recv(65536)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            except socket.timeout:
+                timed_out = True
+            return (''.join(chunks), timed_out)
+        finally:
+            s.close()
+
+    # Forward remote_port of device to local_port of host, like adb reverse
+    def reverse(self, serial, remote_port, local_port):
+        payload = 'reverse:forward:tcp:%d;tcp:%d' % (remote_port, local_port)
+        s = self._connect_transport(serial)
+        try:
+            self._request(s, payload)
+            # the second status is of the forward itself
+            self._check_status(s, payload)
+        finally:
+            s.close()
+
+    def close(self):
+        with self.lock:
+            for connections in self.pool.values():
+                for s in connections:
+                    s.close()
+            self.pool = {}
+
+    def _get_transport(self, serial):
+        with self.lock:
+            connections = self.pool.get(serial)
+            if connections:
+                return (connections.pop(), True)
+        return (self._connect_transport(serial), False)
+
+    def _refill(self, serial):
+        def refill():
+            try:
+                s = self._connect_transport(serial)
+            except socket.error:
+                return
+            with self.lock:
+                connections = self.pool.setdefault(serial, [])
+                if len(connections) < self.POOL_SIZE:
+                    connections.append(s)
+                    return
+            s.close()
+        thread = threading.Thread(target=refill)
+        thread.daemon = True
+        thread.start()
+
+    def _connect_transport(self, serial):
+        s = self._connect()
+        try:
+            self._request(s, 'host:transport:%s' % serial)
+        except socket.error:
+            s.close()
+            raise
+        return s
+
+    def _connect(self):
+        return socket.create_connection((self.host, self.port))
+
+    # Send a request and check the status of response
+    def _request(self, s, payload):
+        s.sendall('%04x%s' % (len(payload), payload))
+        self._check_status(s, payload)
+
+    def _check_status(self, s, payload):
+        status = self._read(s, 4)
+        if status == 'OKAY':
+            return
+        if status == 'FAIL':
+            raise socket.error('Adb server failed on %s: %s' % (payload, self._read(s, int(self._read(s, 4), 16))))
+        raise socket.error('Unexpected response %s from adb server' % status)
+
+    def _read(self, s, size):
+        data = ''
+        while len(data) < size:
+            chunk = s.recv(size - len(data))
+            if not chunk:
+                raise socket.error('Connection closed by adb server')
+            data += chunk
+        return data
+
 
 class Timer(object):
     def __init__(self, use_ms=False):
@@ -321,6 +721,10 @@ class GPU(object):
     def _is_vendor_name(self, vendor_name):
         return self.vendor_name == vendor_name or self.vendor_id == self.VENDOR_NAME_ID[vendor_name]
 
+    # arguments to create the same GPU
+    def get_fields(self):
+        return [self.vendor_name, self.vendor_id, self.product_name, self.product_id, self.driver_version]
+
     def __str__(self):
         return json.dumps({
             'vendor_name': self.vendor_name,
@@ -332,9 +736,14 @@ class GPU(object):
 
 
 class GPUs(object):
-    def __init__(self, os, android_device, driver=None):
+    # gpus are fields of GPUs probed before, e.g., by EnvCache
+    def __init__(self, os, android_device, driver=None, gpus=None):
         self._logger = Util.get_logger()
         self.gpus = []
+        if gpus:
+            for fields in gpus:
+                self.gpus.append(GPU(*fields))
+            return
 
         vendor_name = []
         vendor_id = []
@@ -343,8 +752,7 @@ class GPUs(object):
         driver_version = []
 
         if os.is_android():
-            cmd = AdbShellCmd('dumpsys | grep GLES', android_device.id)
-            for line in cmd.output.split('\n'):
+            for line in android_device.get_gles_lines():
                 if re.match('GLES', line):
                     fields = line.replace('GLES:', '').strip().split(',')
                     vendor_name.append(fields[0])
@@ -378,7 +786,7 @@ class GPUs(object):
                     break
 
         elif os.is_linux():
-            cmd = Cmd('lshw -numeric -c display')
+            cmd = Cmd('lshw -numeric -c display', timeout=Cmd.PROBE_TIMEOUT)
             lines = cmd.output.split('\n')
             for line in lines:
                 line = line.strip()
@@ -394,7 +802,7 @@ class GPUs(object):
                     break
 
         elif os.is_mac():
-            cmd = Cmd('system_profiler SPDisplaysDataType')
+            cmd = Cmd('system_profiler SPDisplaysDataType', timeout=Cmd.PROBE_TIMEOUT)
             lines = cmd.output.split('\n')
             for line in lines:
                 line = line.strip()
@@ -411,7 +819,7 @@ class GPUs(object):
                     driver_version.append('')
 
         elif os.is_win():
-            cmd = Cmd('wmic path win32_videocontroller get /format:list')
+            cmd = Cmd('wmic path win32_videocontroller get /format:list', timeout=Cmd.PROBE_TIMEOUT)
             lines = cmd.output.split('\n')
             for line in lines:
                 line = line.rstrip('\r')
@@ -487,10 +895,13 @@ class OS(object):
 
 
 class HostOS(OS):
-    def __init__(self):
+    # name and version are probed unless given, e.g., by EnvCache
+    def __init__(self, name=None, version=None):
         # name
         system = platform.system().lower()
-        if system == 'linux':
+        if name:
+            self.name = name
+        elif system == 'linux':
             cmd = Cmd('cat /etc/lsb-release')
             if re.search('CHROMEOS', cmd.output, re.I):
                 self.name = 'cros'
@@ -502,7 +913,9 @@ class HostOS(OS):
             self.name = 'win'
 
         # version
-        if self.is_cros():
+        if version is not None:
+            pass
+        elif self.is_cros():
             version = platform.platform()
         elif self.is_linux():
             version = platform.dist()[1]
@@ -537,7 +950,7 @@ class AndroidOS(OS):
 
 
 class Browser(object):
-    def __init__(self, name, path, options, os):
+    def __init__(self, name, path, options, os, mirror=False):
         self.name = name
         self.os = os
         self.version = ''
@@ -576,7 +989,8 @@ class Browser(object):
         # option
         self.options = options
         if self.is_chrome():
-            if not self.os.is_android() and not self.os.is_cros():
+            # mirror caches the cases by Cache-Control
+            if not self.os.is_android() and not self.os.is_cros() and not mirror:
                 self.options.append('--disk-cache-size=1')
                 if self.os.is_linux():
                     self.options.append('--disk-cache-dir=/dev/null')
@@ -624,6 +1038,179 @@ class Browser(object):
         })
 
 
+# Environment of host probed once and cached in a file, together with the
+# version and active GPU of each browser. Probes run in parallel, and the
+# cache is invalidated when any cheap signal in its signature changes, e.g.,
+# kernel or driver version, PCI ids of display devices, or mtime of browser.
+class EnvCache(object):
+    PROBE_TIMEOUT = 60
+    SIGNATURE_FILES = ['/etc/lsb-release', '/proc/version', '/proc/driver/nvidia/version', '/sys/module/i915/version', '/sys/module/amdgpu/version', '/sys/module/nvidia/version']
+    PCI_DIR = '/sys/bus/pci/devices'
+    PKG_STATUS_FILE = '/var/lib/dpkg/status'
+    OS_NAMES = {
+        'darwin': 'mac',
+        'linux': 'linux',
+        'windows': 'win',
+    }
+
+    def __init__(self, file_path, pkgs=[], refresh=False):
+        self._logger = Util.get_logger()
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        signature = self._get_signature()
+        self.env = None
+        if not refresh and os.path.exists(file_path):
+            f = open(file_path)
+            try:
+                self.env = json.load(f)
+            except ValueError:
+                pass
+            f.close()
+        if not self.env or self.env['signature'] != signature:
+            self.env = {'signature': signature, 'browsers': {}, 'pkgs': {}}
+        pkg_mtime = self._get_mtime(self.PKG_STATUS_FILE)
+        if self.env['pkgs'].get('mtime') != pkg_mtime:
+            self.env['pkgs'] = {'mtime': pkg_mtime, 'status': {}}
+
+        probes = {}
+        if 'host_os' not in self.env:
+            probes['host_os'] = self._probe_host_os
+            if platform.system().lower() in self.OS_NAMES:
+                probes['gpus'] = self._probe_gpus
+        for pkg in pkgs:
+            if pkg not in self.env['pkgs']['status']:
+                probes[pkg] = lambda pkg=pkg: Util.has_pkg(pkg)
+        if probes:
+            self._probe(probes)
+
+    def get_host_os(self):
+        return HostOS(self.env['host_os']['name'], self.env['host_os']['version'])
+
+    # GPUs of desktop are from cache, and the others are probed each time
+    def get_gpus(self, os, android_device, driver):
+        if self.env.get('gpus') and os.name == self.env['host_os']['name'] and not os.is_cros():
+            return GPUs(os, android_device, gpus=self.env['gpus'])
+        return GPUs(os, android_device, driver)
+
+    def has_pkg(self, pkg):
+        status = self.env['pkgs']['status']
+        if pkg not in status:
+            status[pkg] = Util.has_pkg(pkg)
+            self.save()
+        return status[pkg]
+
+    # Version of browser from cache, or from driver if browser changed
+    def update_browser(self, browser, driver):
+        entry = self._get_browser_entry(browser)
+        if entry is not None and 'version' in entry:
+            browser.version = entry['version']
+            return
+        browser.update(driver)
+        if entry is not None:
+            entry['version'] = browser.version
+            self.save()
+
+    def get_active_gpu(self, gpus, browser, driver):
+        if len(gpus.gpus) == 1:
+            return gpus.gpus[0]
+        entry = self._get_browser_entry(browser)
+        if entry is not None and 'gpu' in entry and entry['gpu'] < len(gpus.gpus):
+            return gpus.gpus[entry['gpu']]
+        gpu = gpus.get_active(driver)
+        if entry is not None and gpu is not None:
+            entry['gpu'] = gpus.gpus.index(gpu)
+            self.save()
+        return gpu
+
+    def save(self):
+        with self.lock:
+            Util.ensure_dir(os.path.dirname(os.path.abspath(self.file_path)))
+            tmp_path = '%s.%s' % (self.file_path, os.getpid())
+            f = open(tmp_path, 'w')
+            json.dump(self.env, f, sort_keys=True)
+            f.close()
+            # rename doesn't replace existing file on Windows
+            if platform.system() == 'Windows':
+                Util.ensure_nofile(self.file_path)
+            os.rename(tmp_path, self.file_path)
+
+    # Run probes in parallel, each gives a key of env
+    def _probe(self, probes):
+        self._logger.info('Probe environment: %s' % ', '.join(sorted(probes)))
+        results = {}
+        threads = []
+        for (key, probe) in probes.items():
+            thread = threading.Thread(target=lambda key=key, probe=probe: results.update({key: probe()}))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        deadline = time.time() + self.PROBE_TIMEOUT
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+
+        for key in probes:
+            if key in results:
+                continue
+            # GPUs are probed again for desktop when needed, which reports the error
+            if key == 'gpus':
+                self._logger.warning('Could not probe GPUs')
+            else:
+                Util.error('Could not probe %s' % key)
+        if 'host_os' in results:
+            self.env['host_os'] = results.pop('host_os')
+            # GPUs of Chrome OS are only available from chrome://gpu
+            gpus = results.pop('gpus', None)
+            if self.env['host_os']['name'] != 'cros':
+                self.env['gpus'] = gpus
+        self.env['pkgs']['status'].update(results)
+        self.save()
+
+    def _probe_host_os(self):
+        host_os = HostOS()
+        return {'name': host_os.name, 'version': host_os.version}
+
+    def _probe_gpus(self):
+        gpus = GPUs(OS(self.OS_NAMES[platform.system().lower()]), None)
+        return [gpu.get_fields() for gpu in gpus.gpus]
+
+    def _get_signature(self):
+        signature = {'uname': list(platform.uname())}
+        for file_path in self.SIGNATURE_FILES:
+            if os.path.exists(file_path):
+                signature[file_path] = '\n'.join(Util.read_file(file_path))
+        if os.path.isdir(self.PCI_DIR):
+            pci_ids = []
+            for name in sorted(os.listdir(self.PCI_DIR)):
+                device_dir = '%s/%s' % (self.PCI_DIR, name)
+                # class 0x03 is display controller
+                if not ''.join(Util.read_file(device_dir + '/class')).startswith('0x03'):
+                    continue
+                pci_ids.append('%s:%s' % (''.join(Util.read_file(device_dir + '/vendor')), ''.join(Util.read_file(device_dir + '/device'))))
+            signature['pci_ids'] = pci_ids
+        # driver store changes when a driver is installed on Windows
+        if platform.system() == 'Windows':
+            signature['driver_store'] = self._get_mtime('%s/System32/DriverStore/FileRepository' % Util.get_env('WINDIR'))
+        return signature
+
+    # Entry of browser in cache, which is reset if the browser changed, or None
+    # if the browser is not a local file
+    def _get_browser_entry(self, browser):
+        if not browser.path or not os.path.isfile(browser.path):
+            return None
+        stat_result = os.stat(os.path.realpath(browser.path))
+        browser_stat = [stat_result.st_mtime, stat_result.st_size]
+        entry = self.env['browsers'].get(browser.path)
+        if not entry or entry['stat'] != browser_stat:
+            entry = {'stat': browser_stat}
+            self.env['browsers'][browser.path] = entry
+        return entry
+
+    def _get_mtime(self, file_path):
+        if os.path.exists(file_path):
+            return os.path.getmtime(file_path)
+        return None
+
+
 class Webdriver(object):
     CHROME_WEBDRIVER_NAME = 'chromedriver'
     EDGE_WEBDRIVER_NAME = 'MicrosoftWebDriver'
@@ -636,7 +1223,7 @@ class Webdriver(object):
         'chrome_public': 'org.chromium.chrome',
     }
 
-    def __init__(self, path, browser, host_os, target_os, android_device=None, debug=False):
+    def __init__(self, path, browser, host_os, target_os, android_device=None, port=None, debug=False):
         self._logger = Util.get_logger()
         self.path = path
         self.target_os = target_os
@@ -696,7 +1283,8 @@ class Webdriver(object):
                 self._browser.tabs[0].Close()
 
             webdriver_args = [self.path]
-            port = self._get_unused_port()
+            if not port:
+                port = self._get_unused_port()
             webdriver_args.append('--port=%d' % port)
             self.server_process = subprocess.Popen(webdriver_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE, env=None)
             capabilities = {}
@@ -724,7 +1312,8 @@ class Webdriver(object):
                     service_args = ['--verbose', '--log-path=log/chromedriver.log']
                 else:
                     service_args = []
-                self.driver = selenium.webdriver.Chrome(executable_path=self.path, chrome_options=chrome_options, service_args=service_args)
+                port = self._get_unused_port()
+                self.driver = selenium.webdriver.Chrome(executable_path=self.path, port=port, chrome_options=chrome_options, service_args=service_args)
             elif browser.is_safari():
                 Util.not_implemented()
             elif browser.is_edge():
@@ -776,7 +1365,13 @@ class Webdriver(object):
                 return port
 
     def _quit(self):
-        self.driver.quit()
+        if not self.driver:
+            return
+        try:
+            self.driver.quit()
+        except Exception:
+            pass
+        self.driver = None
         if self.target_os.is_android() or self.target_os.is_cros():
             try:
                 urllib2.urlopen(self.server_url + '/shutdown', timeout=10).close()
@@ -798,9 +1393,13 @@ class Status(object):
     PYTIMEOUT = 'PYTIMEOUT'
     JSTIMEOUT = 'JSTIMEOUT'
     NOTEXIST = 'NOTEXIST'
+    FLAKY = 'FLAKY'
+    ALL = [PASS, FAIL, CRASH, FILTER, PYTIMEOUT, JSTIMEOUT, NOTEXIST, FLAKY]
 
 
 class Case(object):
+    __slots__ = ('path', 'status', 'total_count', 'pass_count', 'time')
+
     def __init__(self, path='', status='', total_count=0, pass_count=0, time=0):
         self.path = path
         self.status = status
@@ -849,17 +1448,19 @@ class Suite(object):
         self.count = 0
         self.exp_suite = exp_suite
 
-        self.issue_path = []
-        self.filter_path = []
+        # issue_path keeps the order of cases, and all of them have O(1)
+        # membership test
+        self.issue_path = collections.OrderedDict()
+        self.filter_path = set()
         self.retry_index = []
 
     def add_case(self, case):
         self.suite.append(case)
         self.path_index[case.path] = self.count
         if not case.is_pass():
-            self.issue_path.append(case.path)
+            self.issue_path[case.path] = None
         if case.is_filter():
-            self.filter_path.append(case.path)
+            self.filter_path.add(case.path)
         if case.is_fail() and self.exp_suite and case.path not in self.exp_suite.issue_path:
             self.retry_index.append(self.count)
         self.count += 1
@@ -870,13 +1471,1762 @@ class Suite(object):
     def remove_issue(self, index):
         path = self.suite[index].path
         del self.path_index[path]
-        self.issue_path.remove(path)
+        del self.issue_path[path]
 
 
 class Change(object):
-    def __init__(self, exp_case, cur_case):
+    __slots__ = ('exp_case', 'cur_case', 'exp_passrate', 'cur_passrate')
+
+    def __init__(self, exp_case, cur_case, exp_passrate=None, cur_passrate=None):
         self.exp_case = exp_case
         self.cur_case = cur_case
+        self.exp_passrate = exp_passrate
+        self.cur_passrate = cur_passrate
+
+
+class CaseTime(object):
+    SAMPLE_COUNT = 10
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        if os.path.exists(file_path):
+            f = open(file_path)
+            self.times = json.load(f)
+            f.close()
+        else:
+            self.times = {}
+
+    def add(self, path, time):
+        samples = self.times.setdefault(path, [])
+        samples.append(time)
+        del samples[:-self.SAMPLE_COUNT]
+
+    def add_suite(self, suite):
+        for case in suite.suite:
+            if case.time > 0:
+                self.add(case.path, case.time)
+
+    # median of recorded samples, or None for unknown case
+    def get(self, path):
+        return self.get_percentile(path, 50)
+
+    # percentile of recorded samples, or None if there are less
+    # than min_count samples
+    def get_percentile(self, path, percentile, min_count=1):
+        samples = self.times.get(path)
+        if not samples or len(samples) < min_count:
+            return None
+        samples = sorted(samples)
+        return samples[min(len(samples) * percentile // 100, len(samples) - 1)]
+
+    # unknown cases are assumed to take the average time of known ones
+    def get_all(self, paths):
+        times = [self.get(path) for path in paths]
+        known_times = [time for time in times if time is not None]
+        if known_times:
+            default = sum(known_times) / len(known_times)
+        else:
+            default = 0
+        return [default if time is None else time for time in times]
+
+    def save(self):
+        Util.ensure_dir(os.path.dirname(os.path.abspath(self.file_path)))
+        f = open(self.file_path, 'w')
+        json.dump(self.times, f, indent=0, sort_keys=True)
+        f.close()
+
+
+# Recent outcomes of the cases once found flipping, as 1 for pass and 0 for
+# fail. The flakiness score is 1 for a case passing half of the time, and 0 for
+# one always passing or always failing.
+class FlakeStats(object):
+    SAMPLE_COUNT = 50
+    MIN_COUNT = 5
+    # about 1 in this number of quarantined cases still run each time
+    RECHECK_INTERVAL = 10
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.samples = self._load()
+        # samples added by this run, which are merged into the file on save, as
+        # it may be shared by concurrent runs, e.g., children of fanout
+        self.added = {}
+
+    def add(self, path, passed):
+        self.added.setdefault(path, []).append(int(passed))
+        self._add(self.samples, path, [int(passed)])
+
+    # Cases failed in firstrun and retried, and the cases already tracked, are
+    # sampled with the outcome of this run. Other statuses are not sampled.
+    def add_suite(self, suite):
+        retry_index = set(suite.retry_index)
+        for (index, case) in enumerate(suite.suite):
+            if index in retry_index:
+                self.add(case.path, False)
+            elif case.path not in self.samples:
+                continue
+            if case.is_pass() or case.is_fail():
+                self.add(case.path, case.is_pass())
+
+    def get_score(self, path):
+        samples = self.samples.get(path)
+        if not samples:
+            return 0
+        passrate = float(sum(samples)) / len(samples)
+        return round(1 - abs(2 * passrate - 1), 2)
+
+    def get_quarantine(self, threshold):
+        return set(path for path in self.samples if len(self.samples[path]) >= self.MIN_COUNT and self.get_score(path) >= threshold)
+
+    # Quarantined cases to skip, leaving some out at random so that they keep
+    # getting samples, and a fixed case leaves quarantine without --flake-runs
+    def get_skipped(self, threshold):
+        return set(path for path in self.get_quarantine(threshold) if random.randrange(self.RECHECK_INTERVAL))
+
+    def save(self):
+        Util.ensure_dir(os.path.dirname(os.path.abspath(self.file_path)))
+        lock_f = open(self.file_path + '.lock', 'w')
+        if fcntl:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+        try:
+            samples = self._load()
+            for (path, added) in self.added.items():
+                self._add(samples, path, added)
+            f = open(self.file_path, 'w')
+            json.dump(samples, f, indent=0, sort_keys=True)
+            f.close()
+        finally:
+            lock_f.close()
+        self.samples = samples
+        self.added = {}
+
+    def _load(self):
+        if not os.path.exists(self.file_path):
+            return {}
+        f = open(self.file_path)
+        samples = json.load(f)
+        f.close()
+        return samples
+
+    def _add(self, samples, path, added):
+        path_samples = samples.setdefault(path, [])
+        path_samples.extend(added)
+        del path_samples[:-self.SAMPLE_COUNT]
+
+
+# Snapshot of test cases in the harness page, gathered with one execute_script
+# call instead of several WebDriver round trips per case. Each case is a dict
+# with the testpage element, its path, run button, status text and messages.
+class Harvester(object):
+    COMMON_SCRIPT = '''
+        function getChildren(element, tagName) {
+            var children = [];
+            if (element) {
+                for (var i = 0; i < element.children.length; i++) {
+                    if (element.children[i].tagName == tagName)
+                        children.push(element.children[i]);
+                }
+            }
+            return children;
+        }
+
+        function getText(element) {
+            return element ? (element.innerText || element.textContent || '').trim() : '';
+        }
+
+        function getCase(element) {
+            var div = getChildren(element, 'DIV')[0];
+            var button = null;
+            var inputs = getChildren(div, 'INPUT');
+            for (var i = 0; i < inputs.length; i++) {
+                if (inputs[i].type == 'button') {
+                    button = inputs[i];
+                    break;
+                }
+            }
+            var messages = [];
+            var lis = getChildren(getChildren(element, 'UL')[0], 'LI');
+            for (var i = 0; i < lis.length; i++)
+                messages.push(getText(lis[i]));
+            return {
+                element: element,
+                path: getText(getChildren(div, 'A')[0]),
+                button: button,
+                text: getText(div),
+                messages: messages
+            };
+        }
+    '''
+
+    # Only cases at indexes are harvested if indexes is not null
+    CASES_SCRIPT = COMMON_SCRIPT + '''
+        var folderName = arguments[0];
+        var casePath = arguments[1];
+        var indexes = arguments[2];
+        var folders = document.getElementsByClassName('folderName');
+        for (var i = 0; i < folders.length; i++) {
+            if (getText(folders[i]) != folderName)
+                continue;
+            var pages = Array.prototype.slice.call(folders[i].parentNode.parentNode.querySelectorAll('[class="testpage"]'));
+            if (casePath) {
+                pages = pages.filter(function(page) { return 'all/' + getCase(page).path == casePath; });
+                if (!pages.length)
+                    continue;
+            }
+            if (!indexes) {
+                indexes = [];
+                for (var j = 0; j < pages.length; j++)
+                    indexes.push(j);
+            }
+            var cases = [];
+            for (var j = 0; j < indexes.length; j++)
+                cases.push(indexes[j] < pages.length ? getCase(pages[indexes[j]]) : null);
+            return cases;
+        }
+        return null;
+    '''
+
+    # version and paths of all cases in order
+    FINGERPRINT_SCRIPT = COMMON_SCRIPT + '''
+        var version = document.getElementById('testVersion');
+        var pages = document.querySelectorAll('[class="testpage"]');
+        var items = [version ? version.value : ''];
+        for (var i = 0; i < pages.length; i++)
+            items.push(getCase(pages[i]).path);
+        return items.join('\\n');
+    '''
+
+    # Resolve as soon as the case shows its result, or with null after timeout
+    WAIT_SCRIPT = COMMON_SCRIPT + '''
+        var element = arguments[0];
+        var pattern = new RegExp(arguments[1], 'i');
+        var timeout = arguments[2];
+        var callback = arguments[arguments.length - 1];
+        var done = false;
+        var observer = null;
+        var timer = null;
+
+        function finish(state) {
+            if (done)
+                return;
+            done = true;
+            if (observer)
+                observer.disconnect();
+            clearTimeout(timer);
+            callback(state);
+        }
+
+        function check() {
+            var state = getCase(element);
+            if (pattern.test(state.text))
+                finish(state);
+        }
+
+        check();
+        if (!done) {
+            observer = new MutationObserver(check);
+            observer.observe(element, {childList: true, characterData: true, subtree: true});
+            timer = setTimeout(function() { finish(null); }, timeout);
+        }
+    '''
+
+    DONE_PATTERN = '(passed|skipped|failed|timeout)'
+    # extra seconds for WebDriver before giving up on a case whose page hangs
+    SCRIPT_TIMEOUT_MARGIN = 5
+
+    @staticmethod
+    def get_cases(driver, folder_name, case_path='', indexes=None):
+        return driver.execute_script(Harvester.CASES_SCRIPT, folder_name, case_path, indexes)
+
+    @staticmethod
+    def get_fingerprint(driver):
+        return hashlib.sha1(driver.execute_script(Harvester.FINGERPRINT_SCRIPT).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def wait_case(driver, element, timeout):
+        try:
+            state = driver.execute_async_script(Harvester.WAIT_SCRIPT, element, Harvester.DONE_PATTERN, timeout * 1000)
+        except TimeoutException:
+            return None
+        if not state or not re.search(Harvester.DONE_PATTERN, state['text'], re.I):
+            return None
+        return state
+
+
+class MirrorRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    # keep-alive
+    protocol_version = 'HTTP/1.1'
+    COMPRESS_EXTENSIONS = ['.css', '.frag', '.glsl', '.html', '.js', '.json', '.svg', '.txt', '.vert', '.xml']
+    MAX_AGE = 3600
+
+    def translate_path(self, path):
+        path = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self, path)
+        return os.path.join(self.server.root_dir, os.path.relpath(path, os.getcwd()))
+
+    # serve precompressed file if client accepts gzip
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and os.path.isfile(path + '.gz'):
+            f = open(path + '.gz', 'rb')
+            self.send_response(200)
+            self.send_header('Content-Type', self.guess_type(path))
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            return f
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+    def end_headers(self):
+        self.send_header('Cache-Control', 'max-age=%d' % self.MAX_AGE)
+        SimpleHTTPServer.SimpleHTTPRequestHandler.end_headers(self)
+
+    # directory listing has no Content-Length, which keep-alive needs
+    def list_directory(self, path):
+        self.send_error(404, 'File not found')
+        return None
+
+    def log_message(self, format, *args):
+        Util.get_logger().debug('[MIRROR] ' + format % args)
+
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, root_dir):
+        self.root_dir = root_dir
+        BaseHTTPServer.HTTPServer.__init__(self, ('', port), MirrorRequestHandler)
+
+
+class CtsMirror(object):
+    ARCHIVE_URL = 'https://github.com/KhronosGroup/WebGL/archive/main.zip'
+
+    def __init__(self, mirror_dir, version, type):
+        self._logger = Util.get_logger()
+        self.version = version
+        self.root_dir = os.path.abspath('%s/%s' % (mirror_dir, version))
+        if type == 'stable':
+            self.tree = 'conformance-suites/%s/' % version
+        else:
+            self.tree = 'sdk/tests/'
+
+    def exists(self):
+        return os.path.exists(self.root_dir + '/webgl-conformance-tests.html')
+
+    def build(self, archive):
+        self._logger.info('Build mirror of %s at %s' % (self.version, self.root_dir))
+        if os.path.exists(archive):
+            archive_path = archive
+        else:
+            archive_path = self.root_dir + '.zip'
+            Util.ensure_dir(os.path.dirname(archive_path))
+            self._logger.info('Download %s' % archive)
+            response = urllib2.urlopen(archive)
+            f = open(archive_path, 'wb')
+            shutil.copyfileobj(response, f, 1024 * 1024)
+            f.close()
+            response.close()
+
+        tmp_dir = self.root_dir + '.tmp'
+        Util.ensure_nodir(tmp_dir)
+        archive_file = zipfile.ZipFile(archive_path)
+        count = 0
+        for name in archive_file.namelist():
+            # skip the top directory of archive
+            relative_name = name.split('/', 1)[-1]
+            if not relative_name.startswith(self.tree) or name.endswith('/'):
+                continue
+            file_path = os.path.join(tmp_dir, relative_name[len(self.tree):])
+            Util.ensure_dir(os.path.dirname(file_path))
+            f = open(file_path, 'wb')
+            f.write(archive_file.read(name))
+            f.close()
+            self._compress(file_path)
+            count += 1
+        archive_file.close()
+        if archive_path != archive:
+            Util.ensure_nofile(archive_path)
+
+        if not os.path.exists(tmp_dir + '/webgl-conformance-tests.html'):
+            Util.ensure_nodir(tmp_dir)
+            Util.error('Could not find %s in %s' % (self.tree, archive))
+        Util.ensure_nodir(self.root_dir)
+        os.rename(tmp_dir, self.root_dir)
+        self._logger.info('Mirrored %s files' % count)
+
+    def serve(self, port, android_device=None):
+        server = MirrorServer(port, self.root_dir)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        if android_device and AdbClient.shared:
+            try:
+                AdbClient.shared.reverse(android_device.id, port, port)
+            except socket.error as e:
+                Util.error('Could not forward port %d of Android device %s: %s' % (port, android_device.id, e))
+        elif android_device:
+            Cmd('adb -s %s reverse tcp:%d tcp:%d' % (android_device.id, port, port), abort=True)
+        self._logger.info('Serve mirror of %s at port %d' % (self.version, port))
+
+    def _compress(self, file_path):
+        if os.path.splitext(file_path)[1] not in MirrorRequestHandler.COMPRESS_EXTENSIONS:
+            return
+        f_in = open(file_path, 'rb')
+        f_out = gzip.open(file_path + '.gz', 'wb', 9)
+        shutil.copyfileobj(f_in, f_out)
+        f_out.close()
+        f_in.close()
+
+
+# Local store of browser builds keyed by revision. Files of the ingested
+# archives are stored once by content hash under objects, each build keeps a
+# manifest of its files, and a runnable directory of the build is materialized
+# with hardlinks to the objects on demand. When the objects exceed the budget,
+# the least recently used builds are evicted.
+class BuildCache(object):
+    ARCHIVE_EXTENSIONS = ['.zip', '.tar.gz', '.tgz', '.tar.bz2', '.tar']
+    # path of browser in the Chromium snapshots
+    BROWSER_RELPATHS = {
+        'linux': 'chrome-linux/chrome',
+        'mac': 'chrome-mac/Chromium.app/Contents/MacOS/Chromium',
+        'win': 'chrome-win32/chrome.exe',
+    }
+    PATH_PREFIX = 'build:'
+    # without fcntl, builds used within this time are assumed in use
+    IN_USE_TIME = 3600
+
+    def __init__(self, cache_dir, budget):
+        self._logger = Util.get_logger()
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.budget = budget
+        self.object_dir = self.cache_dir + '/objects'
+        self.manifest_dir = self.cache_dir + '/manifests'
+        self.build_dir = self.cache_dir + '/builds'
+        self.index_file = self.cache_dir + '/index.json'
+        self.lock_file = self.cache_dir + '/lock'
+        # revision -> file shared locked while the build is used by this run
+        self.use_files = {}
+        Util.ensure_dir(self.object_dir)
+        Util.ensure_dir(self.manifest_dir)
+        Util.ensure_dir(self.build_dir)
+
+    # Add build of revision from a zip or tar archive, or a directory
+    def add(self, revision, archive_path):
+        self._logger.info('Add build %s from %s' % (revision, archive_path))
+        self._acquire()
+        try:
+            self._add(revision, archive_path)
+        finally:
+            self._release()
+
+    # Directory of build of revision, materialized if needed
+    def get_build_dir(self, revision):
+        self._acquire()
+        try:
+            index = self._read_index()
+            if revision not in index:
+                Util.error('Could not find build %s in %s' % (revision, self.cache_dir))
+            build_dir = '%s/%s' % (self.build_dir, revision)
+            if not os.path.exists(build_dir):
+                self._materialize(revision, build_dir)
+            self._use(revision)
+            index[revision] = time.time()
+            self._write_index(index)
+        finally:
+            self._release()
+        return build_dir
+
+    # Resolve path in format build:<revision>[/<relative path>], with browser
+    # of Chromium snapshot by default
+    def resolve(self, path, host_os):
+        (revision, _, relpath) = path[len(self.PATH_PREFIX):].partition('/')
+        if not relpath:
+            if host_os.name not in self.BROWSER_RELPATHS:
+                Util.error('Please designate path of browser in build %s' % revision)
+            relpath = self.BROWSER_RELPATHS[host_os.name]
+        return '%s/%s' % (Util.use_slash(self.get_build_dir(revision)), relpath)
+
+    # Builds from the most recently used, as (revision, last used time, size)
+    def get_builds(self):
+        index = self._read_index()
+        builds = []
+        for revision in sorted(index, key=lambda revision: -index[revision]):
+            size = sum(entry['size'] for entry in self._read_json('%s/%s.json' % (self.manifest_dir, revision)) if entry['type'] == 'file')
+            builds.append((revision, index[revision], size))
+        return builds
+
+    @staticmethod
+    def is_build_path(path):
+        return path and path.startswith(BuildCache.PATH_PREFIX)
+
+    def _add(self, revision, archive_path):
+        entries = []
+        new_count = 0
+        if os.path.isdir(archive_path):
+            for (dir_path, dir_names, file_names) in os.walk(archive_path):
+                for name in sorted(dir_names + file_names):
+                    file_path = os.path.join(dir_path, name)
+                    path = self._get_entry_path(os.path.relpath(file_path, archive_path))
+                    if os.path.islink(file_path):
+                        entries.append(self._get_link_entry(path, os.readlink(file_path)))
+                    elif os.path.isdir(file_path):
+                        entries.append({'path': path, 'type': 'dir'})
+                    else:
+                        f = open(file_path, 'rb')
+                        (entry, is_new) = self._add_object(path, f, os.stat(file_path).st_mode)
+                        f.close()
+                        entries.append(entry)
+                        new_count += is_new
+        elif zipfile.is_zipfile(archive_path):
+            archive = zipfile.ZipFile(archive_path)
+            for info in archive.infolist():
+                mode = info.external_attr >> 16
+                path = self._get_entry_path(info.filename)
+                if path is None:
+                    continue
+                if info.filename.endswith('/'):
+                    entries.append({'path': path, 'type': 'dir'})
+                elif stat.S_ISLNK(mode):
+                    entries.append(self._get_link_entry(path, archive.read(info)))
+                else:
+                    f = archive.open(info)
+                    (entry, is_new) = self._add_object(path, f, mode)
+                    f.close()
+                    entries.append(entry)
+                    new_count += is_new
+            archive.close()
+        else:
+            archive = tarfile.open(archive_path)
+            for info in archive:
+                path = self._get_entry_path(info.name)
+                if path is None:
+                    continue
+                if info.isdir():
+                    entries.append({'path': path, 'type': 'dir'})
+                elif info.issym():
+                    entries.append(self._get_link_entry(path, info.linkname))
+                elif info.isfile() or info.islnk():
+                    f = archive.extractfile(info)
+                    (entry, is_new) = self._add_object(path, f, info.mode)
+                    f.close()
+                    entries.append(entry)
+                    new_count += is_new
+            archive.close()
+        self._logger.info('Added %s files of build %s, %s of them are new' % (len(entries), revision, new_count))
+
+        index = self._read_index()
+        build_dir = '%s/%s' % (self.build_dir, revision)
+        if revision in index and self._is_in_use(revision, index):
+            Util.error('Could not replace build %s, which is in use' % revision)
+        self._write_json('%s/%s.json' % (self.manifest_dir, revision), entries)
+        # the materialized directory of a previous build of revision is stale
+        self._remove_dir(build_dir)
+        index[revision] = time.time()
+        self._write_index(index)
+        self._evict(index, revision)
+
+    # Normalized path of archive member, or None for the root. Absolute paths
+    # and the ones out of root would be written outside of build directory.
+    def _get_entry_path(self, name):
+        path = posixpath.normpath(name.replace('\\', '/'))
+        if path == '.':
+            return None
+        if path.startswith('/') or re.match('^[A-Za-z]:', path) or path == '..' or path.startswith('../'):
+            Util.error('Path %s in build is out of the build directory' % name)
+        return path
+
+    def _get_link_entry(self, path, target):
+        target_path = posixpath.normpath(posixpath.join(posixpath.dirname(path), target.replace('\\', '/')))
+        if target.startswith('/') or target_path == '..' or target_path.startswith('../'):
+            Util.error('Link %s to %s in build is out of the build directory' % (path, target))
+        return {'path': path, 'type': 'link', 'target': target}
+
+    # Store content of f as an object, whose name also carries the executable
+    # bit, as hardlinks share the mode
+    def _add_object(self, path, f, mode):
+        tmp_path = '%s/tmp-%s-%s' % (self.object_dir, os.getpid(), threading.current_thread().ident)
+        tmp_file = open(tmp_path, 'wb')
+        sha1 = hashlib.sha1()
+        size = 0
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            sha1.update(data)
+            tmp_file.write(data)
+            size += len(data)
+        tmp_file.close()
+
+        name = sha1.hexdigest()
+        if mode & stat.S_IXUSR:
+            name += 'x'
+        object_path = self._get_object_path(name)
+        is_new = not os.path.exists(object_path)
+        if is_new:
+            Util.ensure_dir(os.path.dirname(object_path))
+            # objects are shared by builds, so they are read only
+            if mode & stat.S_IXUSR:
+                os.chmod(tmp_path, 0o555)
+            else:
+                os.chmod(tmp_path, 0o444)
+            os.rename(tmp_path, object_path)
+        else:
+            os.remove(tmp_path)
+        return ({'path': path, 'type': 'file', 'object': name, 'size': size}, is_new)
+
+    def _materialize(self, revision, build_dir):
+        self._logger.info('Materialize build %s at %s' % (revision, build_dir))
+        tmp_dir = build_dir + '.tmp'
+        self._remove_dir(tmp_dir)
+        Util.ensure_dir(tmp_dir)
+        for entry in self._read_json('%s/%s.json' % (self.manifest_dir, revision)):
+            path = os.path.join(tmp_dir, entry['path'])
+            if entry['type'] == 'dir':
+                Util.ensure_dir(path)
+                continue
+            Util.ensure_dir(os.path.dirname(path))
+            if entry['type'] == 'link':
+                os.symlink(entry['target'], path)
+            else:
+                object_path = self._get_object_path(entry['object'])
+                try:
+                    os.link(object_path, path)
+                # no hardlink on Windows or across file systems
+                except (AttributeError, OSError):
+                    shutil.copy2(object_path, path)
+        os.rename(tmp_dir, build_dir)
+
+    # Evict the least recently used builds until the objects fit in the budget,
+    # except keep_revision and the builds in use. An object is only freed when
+    # no remaining build refers to it.
+    def _evict(self, index, keep_revision):
+        sizes = {}
+        ref_counts = {}
+        manifests = {}
+        for revision in index:
+            manifests[revision] = self._read_json('%s/%s.json' % (self.manifest_dir, revision))
+            for name in self._get_objects(manifests[revision]):
+                ref_counts[name] = ref_counts.get(name, 0) + 1
+            for entry in manifests[revision]:
+                if entry['type'] == 'file':
+                    sizes[entry['object']] = entry['size']
+        total_size = sum(sizes.values())
+
+        for revision in sorted(index, key=lambda revision: index[revision]):
+            if total_size <= self.budget:
+                break
+            if revision == keep_revision or self._is_in_use(revision, index):
+                continue
+            freed_size = 0
+            for name in self._get_objects(manifests[revision]):
+                ref_counts[name] -= 1
+                if not ref_counts[name]:
+                    del ref_counts[name]
+                    freed_size += sizes[name]
+            total_size -= freed_size
+            self._logger.info('Evict build %s, which frees %sMB' % (revision, freed_size // (1024 * 1024)))
+            del index[revision]
+            Util.ensure_nofile('%s/%s.json' % (self.manifest_dir, revision))
+            self._remove_dir('%s/%s' % (self.build_dir, revision))
+        self._write_index(index)
+
+        for sub_dir in os.listdir(self.object_dir):
+            if not os.path.isdir('%s/%s' % (self.object_dir, sub_dir)):
+                continue
+            for name in os.listdir('%s/%s' % (self.object_dir, sub_dir)):
+                if name not in ref_counts:
+                    object_path = self._get_object_path(name)
+                    os.chmod(object_path, 0o644)
+                    os.remove(object_path)
+
+    # objects referred by manifest, each once
+    def _get_objects(self, manifest):
+        return set(entry['object'] for entry in manifest if entry['type'] == 'file')
+
+    # Keep a shared lock on build until this run exits, so that concurrent
+    # runs don't evict it
+    def _use(self, revision):
+        if not fcntl or revision in self.use_files:
+            return
+        f = open('%s/%s.lock' % (self.build_dir, revision), 'a')
+        fcntl.flock(f, fcntl.LOCK_SH)
+        self.use_files[revision] = f
+
+    def _is_in_use(self, revision, index):
+        if not fcntl:
+            return time.time() - index[revision] < self.IN_USE_TIME
+        f = open('%s/%s.lock' % (self.build_dir, revision), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return True
+        finally:
+            f.close()
+        return False
+
+    def _get_object_path(self, name):
+        return '%s/%s/%s' % (self.object_dir, name[:2], name)
+
+    # read only files couldn't be removed on Windows
+    def _remove_dir(self, dir_path):
+        if not os.path.exists(dir_path):
+            return
+        def onerror(func, path, exc_info):
+            os.chmod(path, 0o777)
+            func(path)
+        shutil.rmtree(dir_path, onerror=onerror)
+
+    def _read_index(self):
+        if not os.path.exists(self.index_file):
+            return {}
+        return self._read_json(self.index_file)
+
+    def _write_index(self, index):
+        self._write_json(self.index_file, index)
+
+    def _read_json(self, file_path):
+        f = open(file_path)
+        data = json.load(f)
+        f.close()
+        return data
+
+    def _write_json(self, file_path, data):
+        tmp_path = file_path + '.tmp'
+        f = open(tmp_path, 'w')
+        json.dump(data, f, sort_keys=True)
+        f.close()
+        # rename doesn't replace existing file on Windows
+        if platform.system() == 'Windows':
+            Util.ensure_nofile(file_path)
+        os.rename(tmp_path, file_path)
+
+    # builds may be shared by concurrent runs, e.g., bisect probes
+    def _acquire(self):
+        self.lock_f = open(self.lock_file, 'w')
+        if fcntl:
+            fcntl.flock(self.lock_f, fcntl.LOCK_EX)
+
+    def _release(self):
+        if fcntl:
+            fcntl.flock(self.lock_f, fcntl.LOCK_UN)
+        self.lock_f.close()
+
+
+# Append-only journal of case results and phases for resume. Results are
+# synced in batches, and every CHECKPOINT_COUNT records the whole state is
+# written to a snapshot together with the journal offset, so that resume only
+# replays records after the last checkpoint.
+class Journal(object):
+    SYNC_COUNT = 50
+    SYNC_INTERVAL = 5
+    CHECKPOINT_COUNT = 1000
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.snapshot_path = file_path + '.snapshot'
+        self.lock = threading.Lock()
+        self.f = None
+        self.offset = 0
+        self.state = self._get_new_state()
+
+    # Restore the state of an unfinished run, keyed by phase and case path
+    def load(self):
+        state = self._get_new_state()
+        offset = 0
+        if os.path.exists(self.snapshot_path):
+            f = open(self.snapshot_path)
+            snapshot = json.load(f)
+            f.close()
+            state = snapshot['state']
+            offset = snapshot['offset']
+
+        if not os.path.exists(self.file_path) or os.path.getsize(self.file_path) < offset:
+            state = self._get_new_state()
+            offset = 0
+        else:
+            f = open(self.file_path, 'rb')
+            f.seek(offset)
+            for line in f:
+                # record partially written before the run was killed
+                if not line.endswith('\n'):
+                    break
+                self._apply(state, json.loads(line))
+                offset += len(line)
+            f.close()
+
+        if state['phase'] == 'done':
+            state = self._get_new_state()
+            offset = 0
+        self.state = state
+        self.offset = offset
+        return state
+
+    def open(self):
+        if self.offset == 0:
+            Util.ensure_nofile(self.snapshot_path)
+            self.f = open(self.file_path, 'wb')
+        else:
+            self.f = open(self.file_path, 'r+b')
+            self.f.truncate(self.offset)
+            self.f.close()
+            self.f = open(self.file_path, 'ab')
+        self.unsynced_count = 0
+        self.unsaved_count = 0
+        self.sync_time = time.time()
+
+    def add(self, phase, case):
+        self._write({'type': phase, 'case': [case.path, case.status, case.total_count, case.pass_count, case.time]})
+
+    def set_phase(self, phase):
+        if self.state['phase'] != phase:
+            self._write({'type': 'phase', 'phase': phase})
+
+    def close(self):
+        with self.lock:
+            if self.f:
+                self._sync()
+                self.f.close()
+                self.f = None
+
+    def _get_new_state(self):
+        return {'phase': '', 'firstrun': {}, 'retry': {}}
+
+    def _apply(self, state, record):
+        if record['type'] == 'phase':
+            state['phase'] = record['phase']
+        else:
+            state[record['type']][record['case'][0]] = record['case']
+
+    def _write(self, record):
+        with self.lock:
+            self.f.write(json.dumps(record) + '\n')
+            self._apply(self.state, record)
+            self.unsynced_count += 1
+            self.unsaved_count += 1
+            if record['type'] == 'phase' or self.unsaved_count >= self.CHECKPOINT_COUNT:
+                self._checkpoint()
+            elif self.unsynced_count >= self.SYNC_COUNT or time.time() - self.sync_time >= self.SYNC_INTERVAL:
+                self._sync()
+
+    def _sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.unsynced_count = 0
+        self.sync_time = time.time()
+
+    def _checkpoint(self):
+        self._sync()
+        tmp_path = self.snapshot_path + '.tmp'
+        f = open(tmp_path, 'w')
+        json.dump({'offset': self.f.tell(), 'state': self.state}, f)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        Util.ensure_nofile(self.snapshot_path)
+        os.rename(tmp_path, self.snapshot_path)
+        self.unsaved_count = 0
+
+
+class CaseManifest(object):
+    def __init__(self, file_path):
+        self.file_path = file_path
+        if os.path.exists(file_path):
+            f = open(file_path)
+            self.manifests = json.load(f)
+            f.close()
+        else:
+            self.manifests = {}
+
+    # without fingerprint, the cached case list is returned without validation
+    def get(self, key, fingerprint=None):
+        manifest = self.manifests.get(key)
+        if not manifest:
+            return None
+        if fingerprint is not None and manifest['fingerprint'] != fingerprint:
+            return None
+        return manifest['paths']
+
+    def remove(self, key):
+        return self.manifests.pop(key, None) is not None
+
+    def set(self, key, fingerprint, paths):
+        self.manifests[key] = {
+            'fingerprint': fingerprint,
+            'paths': paths,
+        }
+
+    def save(self):
+        Util.ensure_dir(os.path.dirname(os.path.abspath(self.file_path)))
+        f = open(self.file_path, 'w')
+        json.dump(self.manifests, f, sort_keys=True)
+        f.close()
+
+
+# History of all runs, with the cases of each run and the environment it ran
+# in, so that trends could be queried without going through all the reports.
+class History(object):
+    ENV_COLUMNS = ['version', 'gpu_vendor', 'gpu_product', 'gpu_driver', 'os_name', 'os_version', 'browser_name', 'browser_version']
+    SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, timestamp TEXT, %s);
+CREATE UNIQUE INDEX IF NOT EXISTS runs_env ON runs (timestamp, %s);
+CREATE TABLE IF NOT EXISTS paths (id INTEGER PRIMARY KEY, path TEXT UNIQUE);
+CREATE TABLE IF NOT EXISTS cases (run_id INTEGER, path_id INTEGER, status TEXT, total_count INTEGER, pass_count INTEGER, time REAL);
+CREATE INDEX IF NOT EXISTS cases_path ON cases (path_id, run_id);
+CREATE INDEX IF NOT EXISTS cases_run ON cases (run_id);
+''' % (', '.join('%s TEXT' % column for column in ENV_COLUMNS), ', '.join(ENV_COLUMNS))
+
+    def __init__(self, file_path):
+        self.conn = sqlite3.connect(file_path)
+        self.conn.executescript(self.SCHEMA)
+
+    def add_run(self, timestamp, version, gpu, os, browser, suite):
+        self.add_env_run(timestamp, [version, gpu.vendor_name, gpu.product_name, gpu.driver_version, os.name, os.version, browser.name, browser.version], suite.suite)
+
+    # A run with the same timestamp and environment replaces the previous one.
+    # env is the values of ENV_COLUMNS.
+    def add_env_run(self, timestamp, env, cases):
+        with self.conn:
+            where = ' AND '.join('%s = ?' % column for column in ['timestamp'] + self.ENV_COLUMNS)
+            for (run_id,) in self.conn.execute('SELECT id FROM runs WHERE %s' % where, [timestamp] + env).fetchall():
+                self.conn.execute('DELETE FROM cases WHERE run_id = ?', (run_id,))
+                self.conn.execute('DELETE FROM runs WHERE id = ?', (run_id,))
+            run_id = self.conn.execute('INSERT INTO runs (timestamp, %s) VALUES (?%s)' % (', '.join(self.ENV_COLUMNS), ', ?' * len(env)), [timestamp] + env).lastrowid
+            self.conn.executemany('INSERT OR IGNORE INTO paths (path) VALUES (?)', [(case.path,) for case in cases])
+            path_ids = dict(self.conn.execute('SELECT path, id FROM paths'))
+            self.conn.executemany(
+                'INSERT INTO cases VALUES (?, ?, ?, ?, ?, ?)',
+                [(run_id, path_ids[case.path], case.status, case.total_count, case.pass_count, case.time) for case in cases]
+            )
+
+    # Environment and cases of the latest run as (env, cases), or None if there
+    # is no run.
+    def get_latest_run(self):
+        row = self.conn.execute('SELECT id, %s FROM runs ORDER BY timestamp DESC, id DESC LIMIT 1' % ', '.join(self.ENV_COLUMNS)).fetchone()
+        if not row:
+            return None
+        cases = [Case(*values) for values in self.conn.execute(
+            'SELECT paths.path, cases.status, cases.total_count, cases.pass_count, cases.time FROM cases'
+            ' JOIN paths ON paths.id = cases.path_id WHERE cases.run_id = ? ORDER BY cases.rowid',
+            (row[0],)
+        )]
+        return (list(row[1:]), cases)
+
+    # Results of path in each run as (timestamp, status, total_count,
+    # pass_count, time), oldest first. env_filter is a dict of ENV_COLUMNS.
+    def get_trend(self, path, env_filter={}):
+        (where, params) = self._get_where(env_filter)
+        return self.conn.execute(
+            'SELECT runs.timestamp, cases.status, cases.total_count, cases.pass_count, cases.time FROM cases'
+            ' JOIN runs ON runs.id = cases.run_id'
+            ' WHERE cases.path_id = (SELECT id FROM paths WHERE path = ?)%s ORDER BY runs.timestamp' % where,
+            [path] + params
+        ).fetchall()
+
+    # First run of the latest streak that path failed in, or None if it passed
+    # in the latest run.
+    def get_first_fail(self, path, env_filter={}):
+        (where, params) = self._get_where(env_filter)
+        sql = (
+            'SELECT %s(runs.timestamp) FROM cases JOIN runs ON runs.id = cases.run_id'
+            ' WHERE cases.path_id = (SELECT id FROM paths WHERE path = ?) AND cases.status %s ?%s'
+        )
+        (last_pass,) = self.conn.execute(sql % ('MAX', '=', where), [path, Status.PASS] + params).fetchone()
+        (first_fail,) = self.conn.execute(
+            sql % ('MIN', '!=', where) + ' AND runs.timestamp > ? AND cases.status != ?',
+            [path, Status.PASS] + params + [last_pass or '', Status.FILTER]
+        ).fetchone()
+        return first_fail
+
+    # Cases slowing down the most, comparing the average time of the latest
+    # run_count runs with that of the run_count runs before, as (path,
+    # previous_time, latest_time) tuples.
+    def get_drift(self, run_count, top_count, env_filter={}):
+        (where, params) = self._get_where(env_filter)
+        run_ids = [run_id for (run_id,) in self.conn.execute(
+            'SELECT id FROM runs WHERE 1%s ORDER BY timestamp DESC LIMIT ?' % where, params + [run_count * 2]
+        )]
+        (latest_times, previous_times) = [self._get_times(ids) for ids in [run_ids[:run_count], run_ids[run_count:]]]
+        drifts = [(path, previous_times[path], latest_times[path]) for path in latest_times if latest_times[path] > previous_times.get(path, latest_times[path])]
+        return heapq.nlargest(top_count, drifts, key=lambda drift: drift[2] - drift[1])
+
+    def close(self):
+        self.conn.close()
+
+    def _get_times(self, run_ids):
+        if not run_ids:
+            return {}
+        return dict(self.conn.execute(
+            'SELECT paths.path, AVG(cases.time) FROM cases JOIN paths ON paths.id = cases.path_id'
+            ' WHERE cases.run_id IN (%s) AND cases.time > 0 GROUP BY cases.path_id' % ', '.join('?' * len(run_ids)),
+            run_ids
+        ))
+
+    def _get_where(self, env_filter):
+        for column in env_filter:
+            if column not in self.ENV_COLUMNS:
+                Util.error('History could only be filtered by %s' % ', '.join(self.ENV_COLUMNS))
+        columns = sorted(env_filter)
+        return (''.join(' AND runs.%s = ?' % column for column in columns), [env_filter[column] for column in columns])
+
+
+class Session(object):
+    def __init__(self, conformance, browser, name=''):
+        self._logger = Util.get_logger()
+        self.conformance = conformance
+        self.browser = browser
+        self.name = name
+        self.webdriver = None
+        self.driver = None
+        self.case_elements = {}
+        self.script_timeout = None
+        # user data dir to remove on quit, only for standby and probe browsers
+        self.user_data_dir = None
+        # indexes of recent cases run in firstrun, for crash isolation
+        self.history = collections.deque(maxlen=conformance.args.crash_window)
+
+    @property
+    def log_prefix(self):
+        if self.name:
+            return '[%s] ' % self.name
+        else:
+            return ''
+
+    def launch(self):
+        self.quit()
+        conformance = self.conformance
+        self.webdriver = Webdriver(browser=self.browser, path=conformance.webdriver_path, host_os=conformance.host_os, target_os=conformance.target_os, android_device=conformance.android_device, port=conformance.args.webdriver_port)
+        self.driver = self.webdriver.driver
+        self.script_timeout = None
+        self.history.clear()
+
+    def load(self):
+        url = self.conformance.url
+        self.driver.get(url)
+        try:
+            WebDriverWait(self.driver, 60).until(lambda driver: driver.find_element_by_id('page0'))
+        except TimeoutException:
+            Util.error('Could not open %s correctly' % url)
+
+    # Only cases at indexes are resolved, as the others are not going to run.
+    # With use_standby, a browser prepared by standby pool is taken if any.
+    def start(self, indexes=None, use_standby=False):
+        standby = None
+        if use_standby and self.conformance.standby_pool:
+            standby = self.conformance.standby_pool.get()
+        if standby:
+            self.quit()
+            self.browser = standby.browser
+            self.webdriver = standby.webdriver
+            self.driver = standby.driver
+            self.user_data_dir = standby.user_data_dir
+            self.script_timeout = None
+            self.history.clear()
+            self._logger.info('%sSwitch to standby browser %s' % (self.log_prefix, standby.name))
+        else:
+            self.launch()
+            self.load()
+        self.case_elements = {}
+        if indexes:
+            self.resolve(indexes)
+
+    def resolve(self, indexes):
+        indexes = [index for index in indexes if index not in self.case_elements]
+        if not indexes:
+            return
+        conformance = self.conformance
+        case_elements = conformance._get_case_elements(self.driver, indexes)
+        if any(not case_elements[index] or case_elements[index]['path'] != conformance.case_paths[index] for index in indexes):
+            # the cached case list is stale, so it is harvested again next time
+            self._logger.warning('%sThe cases in %s have changed, find them by path' % (self.log_prefix, conformance.url))
+            if conformance.case_manifest.remove(conformance._get_manifest_key()):
+                conformance.case_manifest.save()
+            case_elements = conformance._get_case_elements(self.driver, indexes, by_path=True)
+            for index in indexes:
+                if not case_elements[index]:
+                    Util.error('Could not find case %s in %s' % (conformance.case_paths[index], conformance.url))
+        self.case_elements.update(case_elements)
+
+    def wait_case(self, element, timeout):
+        # the deadline is kept by the script itself, so the script timeout is
+        # only raised when needed to save a round trip for each case
+        script_timeout = timeout + Harvester.SCRIPT_TIMEOUT_MARGIN
+        if self.script_timeout is None or script_timeout > self.script_timeout:
+            self.driver.set_script_timeout(script_timeout)
+            self.script_timeout = script_timeout
+        return Harvester.wait_case(self.driver, element, timeout)
+
+    def quit(self):
+        if self.webdriver:
+            self.webdriver._quit()
+        self.webdriver = None
+        self.driver = None
+        if self.user_data_dir:
+            Util.ensure_nodir(self.user_data_dir)
+            self.user_data_dir = None
+
+
+# Browsers with the harness loaded, prespawned in background so that a crashed
+# or timed out session can switch to one without waiting for browser startup.
+class StandbyPool(object):
+    def __init__(self, conformance, size):
+        self._logger = Util.get_logger()
+        self.conformance = conformance
+        self.count = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.sessions = Queue.Queue()
+        for _ in range(size):
+            self._spawn()
+
+    # Wait for a standby being prepared, and spawn another one to replace it.
+    # None is returned if the pool is closed or the standby failed to start.
+    def get(self):
+        with self.lock:
+            if self.pending == 0:
+                return None
+            self.pending -= 1
+        session = self.sessions.get()
+        self._spawn()
+        return session
+
+    def close(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = 0
+        for _ in range(pending):
+            session = self.sessions.get()
+            if session:
+                session.quit()
+
+    def _spawn(self):
+        with self.lock:
+            name = 'standby%s' % self.count
+            self.count += 1
+            self.pending += 1
+        thread = threading.Thread(target=self._prepare, args=(name,))
+        thread.daemon = True
+        thread.start()
+
+    def _prepare(self, name):
+        session = Session(self.conformance, self.conformance._get_browser(name), name)
+        session.user_data_dir = self.conformance._get_user_data_dir(name)
+        try:
+            session.launch()
+            session.load()
+        except (Exception, SystemExit) as e:
+            self._logger.warning('Failed to prepare standby browser %s: %s' % (name, e))
+            session.quit()
+            session = None
+        self.sessions.put(session)
+
+
+# Failed cases of firstrun are retried as soon as they are recorded, in a
+# browser of its own running alongside the firstrun. The results are journaled
+# as retry records, so the retry phase takes these cases as done.
+class RetryPipeline(object):
+    def __init__(self, conformance):
+        self._logger = Util.get_logger()
+        self.conformance = conformance
+        self.path_index = dict((case_path, index) for (index, case_path) in enumerate(conformance.case_paths))
+        self.session = Session(conformance, conformance._get_browser('retry'), 'retry')
+        self.queue = Queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # case is copied, as the retry must not change the firstrun result
+    def add(self, case):
+        self.queue.put((self.path_index[case.path], Case(case.path, case.status, case.total_count, case.pass_count, case.time)))
+
+    # Wait for the queued cases to be retried
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.session.quit()
+        if self.error:
+            self._logger.warning('Retry pipeline stopped on error, the rest cases are left to the retry phase: %s' % self.error)
+
+    # Cases queued while retrying are taken in one batch, so that a crash is
+    # found by the next case like in the retry phase.
+    def _run(self):
+        try:
+            self.session.start()
+            closed = False
+            while not closed:
+                cases = {}
+                item = self.queue.get()
+                while True:
+                    if item is None:
+                        closed = True
+                        break
+                    cases[item[0]] = item[1]
+                    try:
+                        item = self.queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                if cases:
+                    self.conformance._run_cases(self.session, 'retry', sorted(cases), cases)
+        except (Exception, SystemExit) as e:
+            self.error = e
+
+
+# A crash is often only found by the case after the one causing it, so the
+# recent window of cases run before a crash is replayed in fresh browsers, in
+# parallel with the main run. The shortest prefix of the window that crashes
+# ends with the trigger, and if the trigger doesn't crash alone, the latest
+# case before it still needed for the crash is its partner. Both searches probe
+# jobs points of the range in parallel each round.
+class CrashIsolator(object):
+    def __init__(self, conformance, jobs):
+        self._logger = Util.get_logger()
+        self.conformance = conformance
+        self.jobs = jobs
+        self.semaphore = threading.Semaphore(jobs)
+        self.lock = threading.Lock()
+        self.count = 0
+        self.threads = []
+        self.findings = []
+
+    # window is the indexes of cases run in the session before the crash, and
+    # blamed_case is the case marked as CRASH, with its result before that
+    def add(self, window, blamed_case, blamed_result):
+        thread = threading.Thread(target=self._isolate, args=(window, blamed_case, blamed_result))
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    # Wait for all isolations, and return the findings as (blamed_case,
+    # blamed_result, trigger_index, partner_index) tuples, where trigger_index
+    # is None if the crash was not reproduced.
+    def close(self):
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        (findings, self.findings) = (self.findings, [])
+        return findings
+
+    def _isolate(self, window, blamed_case, blamed_result):
+        trigger = None
+        partner = None
+        try:
+            # shortest crashing prefix, window[:high] is known to crash
+            (low, high) = (0, len(window))
+            if not self._probe_all([window])[0]:
+                self._logger.warning('Could not reproduce the crash blamed on %s' % blamed_case.path)
+            else:
+                while high - low > 1:
+                    lengths = self._get_points(low, high)
+                    crashes = self._probe_all([window[:length] for length in lengths])
+                    for (length, crash) in zip(lengths, crashes):
+                        if crash:
+                            high = length
+                            break
+                        low = length
+                trigger = high - 1
+
+                # latest start still crashing with the trigger, window[low:]
+                # is known to crash
+                if trigger > 0 and not self._probe_all([[window[trigger]]])[0]:
+                    (low, high) = (0, trigger)
+                    while high - low > 1:
+                        starts = self._get_points(low, high)
+                        crashes = self._probe_all([window[start:trigger + 1] for start in starts])
+                        for (start, crash) in reversed(zip(starts, crashes)):
+                            if crash:
+                                low = start
+                                break
+                            high = start
+                    partner = window[low]
+                trigger = window[trigger]
+        except (Exception, SystemExit) as e:
+            self._logger.warning('Failed to isolate the crash blamed on %s: %s' % (blamed_case.path, e))
+            trigger = None
+            partner = None
+        with self.lock:
+            self.findings.append((blamed_case, blamed_result, trigger, partner))
+
+    # at most jobs points evenly spread in (low, high)
+    def _get_points(self, low, high):
+        count = min(self.jobs, high - low - 1)
+        return sorted(set(low + (high - low) * (point + 1) // (count + 1) for point in range(count)))
+
+    def _probe_all(self, sequences):
+        crashes = [False] * len(sequences)
+
+        def probe(number, sequence):
+            with self.semaphore:
+                crashes[number] = self._probe(sequence)
+
+        threads = []
+        for (number, sequence) in enumerate(sequences):
+            thread = threading.Thread(target=probe, args=(number, sequence))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return crashes
+
+    # Run the cases at indexes in a fresh browser, and tell if it crashed
+    def _probe(self, indexes):
+        conformance = self.conformance
+        with self.lock:
+            name = 'isolate%s' % self.count
+            self.count += 1
+        session = Session(conformance, conformance._get_browser(name), name)
+        session.user_data_dir = conformance._get_user_data_dir(name)
+        try:
+            session.launch()
+            session.load()
+            session.resolve(indexes)
+            for index in indexes:
+                case_element = session.case_elements[index]
+                try:
+                    case_element['button'].click()
+                except WebDriverException:
+                    return True
+                state = session.wait_case(case_element['element'], conformance._get_timeout(conformance.case_paths[index]))
+                if state and state['messages'] and re.search(Conformance.CONTEXT_LOST_PATTERN, state['messages'][0]):
+                    return True
+            try:
+                session.driver.execute_script('return 0;')
+            except WebDriverException:
+                return True
+            return False
+        finally:
+            session.quit()
+
+
+# Run the suite on several Android devices at the same time, each by a child
+# process with its own log and result directories, webdriver port and mirror
+# port. In shard mode the cases are split across the devices, which should be
+# identical, and in matrix mode every device runs the whole suite. Results
+# exported by the children are merged into a combined report, and their runs
+# are added to the history of fanout.
+class DeviceFanout(object):
+    # options of children decided by fanout
+    CHILD_OPTIONS = ['--android-devices', '--android-fanout', '--android-device-id', '--os-name', '--log-dir', '--result-dir', '--export', '--shard', '--time-file', '--flake-file', '--history-file', '--webdriver-port', '--mirror-port']
+    WEBDRIVER_PORT = 9515
+
+    def __init__(self, conformance, devices, mode):
+        self._logger = Util.get_logger()
+        self.conformance = conformance
+        self.devices = devices
+        self.mode = mode
+        # device id -> {path: (record, case)}
+        self.results = {}
+        # device id -> exit status of child
+        self.statuses = {}
+
+    def run(self):
+        conformance = self.conformance
+        args = conformance.args
+        if self.mode == 'shard':
+            models = set(device.get_prop('ro.product.model') for device in self.devices)
+            if len(models) > 1:
+                self._logger.warning('Cases are sharded across different models: %s' % ', '.join(sorted(models)))
+
+        argv = self._strip_argv(sys.argv[1:])
+        processes = []
+        for (index, device) in enumerate(self.devices):
+            log_dir = self._get_log_dir(device)
+            Util.ensure_dir(log_dir)
+            # shards are balanced by the same durations on all devices, and
+            # case lists cached by fanout are reused
+            time_file = '%s/time-%s.json' % (log_dir, conformance.version)
+            if os.path.exists(conformance.time_file):
+                shutil.copyfile(conformance.time_file, time_file)
+            if os.path.exists(conformance.case_manifest.file_path):
+                shutil.copyfile(conformance.case_manifest.file_path, self._get_manifest_file(device))
+            child_argv = [
+                '--os-name', 'android',
+                '--android-device-id', device.id,
+                '--log-dir', log_dir,
+                '--result-dir', self._get_result_dir(device),
+                '--export', 'jsonl',
+                '--time-file', time_file,
+                '--flake-file', conformance.flake_file,
+                '--history-file', self._get_history_file(device),
+                '--webdriver-port', str((args.webdriver_port or self.WEBDRIVER_PORT) + index),
+                '--mirror-port', str(args.mirror_port + index),
+            ]
+            if self.mode == 'shard':
+                child_argv += ['--shard', '%d/%d' % (index, len(self.devices))]
+            cmd = [sys.executable, os.path.basename(sys.argv[0])] + argv + child_argv
+            self._logger.info('[CMD]: %s' % ' '.join(cmd))
+            output = open('%s/output.txt' % log_dir, 'w')
+            processes.append((device, subprocess.Popen(cmd, stdout=output, stderr=subprocess.STDOUT), output))
+
+        for (device, process, output) in processes:
+            self.statuses[device.id] = process.wait()
+            output.close()
+            if self.statuses[device.id]:
+                self._logger.warning('Test on %s failed with status %s, see %s/output.txt' % (device.id, self.statuses[device.id], self._get_log_dir(device)))
+            else:
+                self._logger.info('Test on %s finished' % device.id)
+            self.results[device.id] = self._read_results(device)
+
+        for device in self.devices:
+            for (path, (record, case)) in sorted(self.results[device.id].items()):
+                if case.time > 0:
+                    conformance.case_time.add(path, case.time)
+                if self.mode == 'matrix':
+                    case = Case('%s/%s' % (device.id, path), case.status, case.total_count, case.pass_count, case.time)
+                for exporter in conformance.exporters:
+                    exporter.add(record, case)
+        conformance.case_time.save()
+        self._merge_manifests()
+        self._add_history()
+        for exporter in conformance.exporters:
+            exporter.close()
+        self._gen_report()
+
+    # Remove the options decided by fanout from argv
+    def _strip_argv(self, argv):
+        stripped = []
+        skip = False
+        for arg in argv:
+            if skip:
+                skip = False
+                continue
+            if arg.split('=', 1)[0] in self.CHILD_OPTIONS:
+                skip = '=' not in arg
+                continue
+            stripped.append(arg)
+        return stripped
+
+    def _get_log_dir(self, device):
+        return '%s/device-%s' % (self.conformance.log_dir, self._get_name(device))
+
+    def _get_result_dir(self, device):
+        return '%s/%s-%s' % (self.conformance.result_dir, self.conformance.timestamp, self._get_name(device))
+
+    def _get_manifest_file(self, device):
+        return '%s/manifest.json' % self._get_log_dir(device)
+
+    # history of child only has the run of this fanout
+    def _get_history_file(self, device):
+        return '%s/history.db' % self._get_result_dir(device)
+
+    # id of device over network has colon
+    def _get_name(self, device):
+        return re.sub('[^\w.-]', '_', device.id)
+
+    # The last result of each case exported by child
+    def _read_results(self, device):
+        results = {}
+        result_dir = self._get_result_dir(device)
+        if not os.path.exists(result_dir):
+            return results
+        for name in os.listdir(result_dir):
+            if not name.endswith('.jsonl'):
+                continue
+            f = open('%s/%s' % (result_dir, name))
+            for line in f:
+                record = json.loads(line)
+                if record['record'] in ['firstrun', 'retry']:
+                    results[record['path']] = (record['record'], Case(record['path'], record['status'], record['total_count'], record['pass_count'], record['time']))
+            f.close()
+        return results
+
+    # case lists found by children are cached for later runs
+    def _merge_manifests(self):
+        case_manifest = self.conformance.case_manifest
+        for device in self.devices:
+            if os.path.exists(self._get_manifest_file(device)):
+                case_manifest.manifests.update(CaseManifest(self._get_manifest_file(device)).manifests)
+        case_manifest.save()
+
+    # Shards are added as one run, so that history has only complete runs, and
+    # in matrix mode each device is added as a run.
+    def _add_history(self):
+        conformance = self.conformance
+        runs = []
+        for device in self.devices:
+            if not os.path.exists(self._get_history_file(device)):
+                continue
+            history = History(self._get_history_file(device))
+            run = history.get_latest_run()
+            history.close()
+            if not run:
+                continue
+            if self.mode == 'shard' and runs:
+                runs[0][1].extend(run[1])
+            elif run[0] in [env for (env, _) in runs]:
+                self._logger.warning('Run on %s has the same environment as another device, and is not added to history' % device.id)
+            else:
+                runs.append(run)
+        if not runs:
+            return
+        history = History(conformance.history_file)
+        for (env, cases) in runs:
+            history.add_env_run(conformance.timestamp, env, cases)
+        history.close()
+
+    def _gen_report(self):
+        conformance = self.conformance
+        device_ids = [device.id for device in self.devices]
+        writer = ReportWriter(conformance.result_file)
+        writer.write_table(ReportTable(
+            'Devices',
+            ['Device', 'Model', 'Android', 'Exit Status', 'All', 'Pass', 'Pass Rate %', 'Report'],
+            self._get_device_rows()
+        ))
+
+        # pass counts of each category on each device
+        categories = collections.OrderedDict()
+        for device_id in device_ids:
+            for (path, (_, case)) in sorted(self.results[device_id].items()):
+                counts = categories.setdefault(path.split('/')[0], dict((device_id, [0, 0]) for device_id in device_ids))
+                counts[device_id][0] += case.total_count
+                counts[device_id][1] += case.pass_count
+        if self.mode == 'shard':
+            rows = []
+            for (category, counts) in categories.items():
+                total_count = sum(count[0] for count in counts.values())
+                pass_count = sum(count[1] for count in counts.values())
+                rows.append(([category, total_count, pass_count, conformance._get_passrate(total_count, pass_count)], None, 0))
+            writer.write_table(ReportTable('Summary', ['Test Case Category ', 'All', 'Pass ', 'Pass Rate %'], rows))
+            writer.write_table(ReportTable(
+                'Issue Cases',
+                ['Case', 'Device', 'Status', 'All', 'Pass'],
+                (([path, device_id, case.status, case.total_count, case.pass_count], None, 0) for device_id in device_ids for (path, (_, case)) in sorted(self.results[device_id].items()) if case.status != Status.PASS)
+            ))
+        else:
+            writer.write_table(ReportTable(
+                'Summary',
+                ['Test Case Category '] + ['%s Pass Rate %%' % device_id for device_id in device_ids],
+                (([category] + [conformance._get_passrate(*counts[device_id]) for device_id in device_ids], None, 0) for (category, counts) in categories.items())
+            ))
+            paths = sorted(set(path for device_id in device_ids for path in self.results[device_id]))
+            writer.write_table(ReportTable(
+                'Issue Cases on Any Device',
+                ['Case'] + device_ids,
+                self._get_matrix_rows(paths, device_ids)
+            ))
+        writer.close()
+        self._logger.info('Combined report is at %s' % conformance.result_file)
+
+    def _get_device_rows(self):
+        for device in self.devices:
+            cases = [case for (_, case) in self.results[device.id].values()]
+            total_count = sum(case.total_count for case in cases)
+            pass_count = sum(case.pass_count for case in cases)
+            reports = [name for name in os.listdir(self._get_result_dir(device)) if name.endswith('.html')] if os.path.exists(self._get_result_dir(device)) else []
+            report = '%s/%s' % (self._get_result_dir(device), reports[0]) if reports else ''
+            yield ([device.id, device.get_prop('ro.product.model'), device.get_prop('ro.build.version.release'), self.statuses[device.id], total_count, pass_count, self.conformance._get_passrate(total_count, pass_count), report], None, 1)
+
+    def _get_matrix_rows(self, paths, device_ids):
+        for path in paths:
+            statuses = []
+            for device_id in device_ids:
+                if path in self.results[device_id]:
+                    statuses.append(self.results[device_id][path][1].status)
+                else:
+                    statuses.append('')
+            if any(status != Status.PASS for status in statuses):
+                yield ([path] + statuses, None, 0)
+
+
+# Rows of a table are (cells, bgcolor, strong_count) tuples, where the first
+# strong_count cells are in bold, and a single cell spans the whole row.
+class ReportTable(object):
+    def __init__(self, title, header, rows):
+        self.title = title
+        self.header = header
+        self.rows = rows
+
+
+# Write html report table by table, and row by row within a table, so that the
+# whole document is never held in memory.
+class ReportWriter(object):
+    HEAD = '''<html>
+  <head>
+    <meta http-equiv="content-type" content="text/html; charset=utf-8">
+    <style type="text/css">
+      table {
+        border: 2px solid black;
+        border-collapse: collapse;
+        border-spacing: 0;
+      }
+      table tr td {
+        border: 1px solid black;
+      }
+    </style>
+  </head>
+  <body>
+'''
+
+    TAIL = '''  </body>
+</html>
+'''
+
+    def __init__(self, file_path):
+        self.f = open(file_path, 'w')
+        self.f.write(self.HEAD)
+        self.row_formats = {}
+
+    def write_table(self, table):
+        self.f.write('    <h2>%s</h2>\n    <table>\n      <tbody>\n' % table.title)
+        column_count = 0
+        if table.header:
+            column_count = len(table.header)
+            self._write_row(table.header, None, column_count, column_count)
+        for (cells, bgcolor, strong_count) in table.rows:
+            self._write_row(cells, bgcolor, strong_count, column_count or 2)
+        self.f.write('      </tbody>\n    </table>\n')
+
+    def close(self):
+        self.f.write(self.TAIL)
+        self.f.close()
+
+    def _write_row(self, cells, bgcolor, strong_count, column_count):
+        key = (len(cells), bgcolor, strong_count, column_count)
+        if key not in self.row_formats:
+            self.row_formats[key] = self._get_row_format(*key)
+        escape = self._escape
+        self.f.write(self.row_formats[key] % tuple([escape(cell) if type(cell) in (str, unicode) else cell for cell in cells]))
+
+    # format of a whole row, so that it's rendered with a single % operation
+    def _get_row_format(self, cell_count, bgcolor, strong_count, column_count):
+        if cell_count == 1 and column_count > 1:
+            td = '<td align="left" colspan="%s">' % column_count
+        else:
+            td = '<td align="left">'
+        tds = []
+        for index in range(cell_count):
+            if index < strong_count:
+                tds.append(td + '<strong>%s</strong></td>')
+            else:
+                tds.append(td + '%s</td>')
+        if bgcolor:
+            tr = '<tr bgcolor="#%s">' % bgcolor
+        else:
+            tr = '<tr>'
+        return '        %s%s</tr>\n' % (tr, ''.join(tds))
+
+    @staticmethod
+    def _escape(cell):
+        if isinstance(cell, unicode):
+            cell = cell.encode('utf-8')
+        if '&' in cell or '<' in cell or '>' in cell:
+            cell = cgi.escape(cell)
+        return cell
+
+
+# Exporters write each case as soon as it's recorded, so that a partially
+# finished run could already be consumed without parsing the html report.
+# Records are firstrun or retry cases, and changes against the expectation at
+# the end of run.
+class Exporter(object):
+    FORMAT = ''
+    EXTENSION = ''
+    FIELDS = ['record', 'path', 'status', 'total_count', 'pass_count', 'time', 'exp_status', 'exp_total_count', 'exp_pass_count', 'change']
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.f = open(file_path, 'wb')
+        self.lock = threading.Lock()
+
+    def add(self, mode, case):
+        with self.lock:
+            self._add(self._get_record(mode, case))
+            self.f.flush()
+
+    def add_changes(self, details):
+        with self.lock:
+            for (name, _, detail) in details:
+                for change in detail:
+                    self._add(self._get_record('change', change.cur_case, change.exp_case, name))
+            self.f.flush()
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+    def _add(self, record):
+        pass
+
+    def _get_record(self, record, case, exp_case=None, change=''):
+        values = [record, case.path, case.status, case.total_count, case.pass_count, case.time]
+        if exp_case:
+            values += [exp_case.status, exp_case.total_count, exp_case.pass_count, change]
+        else:
+            values += ['', '', '', '']
+        return collections.OrderedDict(zip(self.FIELDS, values))
+
+    @staticmethod
+    def get_exporter(format, file_prefix):
+        for exporter in [JsonlExporter, CsvExporter, JunitExporter]:
+            if exporter.FORMAT == format:
+                return exporter('%s.%s' % (file_prefix, exporter.EXTENSION))
+        Util.error('Export format %s is not supported' % format)
+
+
+class JsonlExporter(Exporter):
+    FORMAT = 'jsonl'
+    EXTENSION = 'jsonl'
+
+    def _add(self, record):
+        self.f.write(json.dumps(record) + '\n')
+
+
+class CsvExporter(Exporter):
+    FORMAT = 'csv'
+    EXTENSION = 'csv'
+
+    def __init__(self, file_path):
+        super(CsvExporter, self).__init__(file_path)
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(self.FIELDS)
+
+    def _add(self, record):
+        self.writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value for value in record.values()])
+
+
+# Closing tags are written after each case and overwritten by the next one, so
+# that the file is always a well-formed document. As firstrun and retry cases
+# may interleave, retried ones are told apart by their name. Changes are not
+# exported as they are not cases.
+class JunitExporter(Exporter):
+    FORMAT = 'junit'
+    EXTENSION = 'xml'
+    TAIL = '  </testsuite>\n</testsuites>\n'
+
+    def __init__(self, file_path):
+        super(JunitExporter, self).__init__(file_path)
+        self.f.write('<?xml version="1.0" encoding="UTF-8"?>\n<testsuites name="webgl-conformance">\n  <testsuite name="webgl-conformance">\n')
+        self.offset = self.f.tell()
+        self.f.write(self.TAIL)
+        self.f.flush()
+
+    def add_changes(self, details):
+        pass
+
+    def _add(self, record):
+        self.f.seek(self.offset)
+        path = record['path']
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        (class_name, _, name) = path.rpartition('/')
+        if record['record'] == 'retry':
+            name += ' (retry)'
+        self.f.write('    <testcase classname=%s name=%s time="%.3f">' % (self._quote(class_name.replace('/', '.')), self._quote(name), float(record['time']) / 1000))
+        status = record['status']
+        if status == Status.FILTER:
+            self.f.write('<skipped/>')
+        elif status == Status.FAIL:
+            self.f.write('<failure message="%s of %s passed"/>' % (record['pass_count'], record['total_count']))
+        elif status != Status.PASS:
+            self.f.write('<error message="%s"/>' % status)
+        self.f.write('</testcase>\n')
+        self.offset = self.f.tell()
+        self.f.write(self.TAIL)
+        self.f.truncate()
+
+    @staticmethod
+    def _quote(value):
+        return '"%s"' % cgi.escape(value, True)
 
 
 class Conformance(object):
@@ -890,8 +3240,8 @@ class Conformance(object):
         '2.0.1': 'beta',
     }
 
-    TEST_DONE = 'TESTDONE'
     TOP_TIME_COUNT = 20
+    CONTEXT_LOST_PATTERN = 'Unable to fetch WebGL rendering context for Canvas'
 
     def __init__(self):
         # argument
@@ -901,17 +3251,68 @@ class Conformance(object):
     ''')
         parser.add_argument('--browser-name', dest='browser_name', help='name of browser')
         parser.add_argument('--browser-options', dest='browser_options', help='extra options of browser, split by ","')
-        parser.add_argument('--browser-path', dest='browser_path', help='path of browser')
-        parser.add_argument('--webdriver-path', dest='webdriver_path', help='path of webdriver')
+        parser.add_argument('--browser-path', dest='browser_path', help='path of browser, or build:<revision>[/<relative path>] for a build in build cache')
+        parser.add_argument('--webdriver-path', dest='webdriver_path', help='path of webdriver, or build:<revision>/<relative path> for a build in build cache')
         parser.add_argument('--version', dest='version', help='WebGL conformance test version', default='2.0.1')
         parser.add_argument('--url', dest='url', help='url for website other than default Khronos WebGL CTS')
         parser.add_argument('--suite', dest='suite', help='instead of whole suite, we may test specific cases, e.g., conformance/attibs or "conformance/attribs/gl-bindAttribLocation-matrix.html"', default='all')
         parser.add_argument('--os-name', dest='os_name', help='OS to run test on')
         parser.add_argument('--android-device-id', dest='android_device_id', help='id of Android device to run test on')
+        parser.add_argument('--android-devices', dest='android_devices', help='run test on these Android devices at the same time, "all" or ids split by ","')
+        parser.add_argument('--android-fanout', dest='android_fanout', help='how to run test on --android-devices, shard to split cases across identical devices, or matrix to run all cases on each device', choices=['shard', 'matrix'], default='shard')
+        parser.add_argument('--adb-server', dest='adb_server', help='talk to adb server at host:port over its protocol instead of spawning adb for each command, e.g., localhost:5037')
+        parser.add_argument('--webdriver-port', dest='webdriver_port', help='port of webdriver for Android and Chrome OS, default is an unused one', type=int)
         parser.add_argument('--mesa-dir', dest='mesa_dir', help='directory of Mesa')
         parser.add_argument('--gles', dest='gles', help='gles', action='store_true')
         parser.add_argument('--logging-level', dest='logging_level', help='level of logging', default=logging.INFO)
+        parser.add_argument('--refresh-env', dest='refresh_env', help='probe OS, GPUs and browser again instead of using the ones cached in <log-dir>/env.json', action='store_true')
+        parser.add_argument('--log-dir', dest='log_dir', help='directory of logs, journal and recorded data', default='log')
+        parser.add_argument('--result-dir', dest='result_dir', help='directory of reports and exported results', default='result')
+        parser.add_argument('--user-data-dir', dest='user_data_dir', help='user data directory of browser relative to this script, default is user-data-dir-<username>')
         parser.add_argument('--timeout', dest='timeout', help='timeout seconds for each test', type=int, default=60)
+        parser.add_argument('--adaptive-timeout', dest='adaptive_timeout', help='derive timeout of each case from its durations in time file, and use --timeout for the cases with too few durations', action='store_true')
+        parser.add_argument('--timeout-percentile', dest='timeout_percentile', help='percentile of recorded durations the adaptive timeout is based on', type=int, default=90)
+        parser.add_argument('--timeout-factor', dest='timeout_factor', help='factor to multiply the percentile by for the adaptive timeout', type=float, default=3)
+        parser.add_argument('--timeout-floor', dest='timeout_floor', help='minimum seconds of adaptive timeout', type=int, default=10)
+        parser.add_argument('--timeout-ceiling', dest='timeout_ceiling', help='maximum seconds of adaptive timeout', type=int, default=300)
+        parser.add_argument('--timeout-samples', dest='timeout_samples', help='minimum number of recorded durations for the adaptive timeout', type=int, default=3)
+        parser.add_argument('--jobs', dest='jobs', help='number of browser instances to run the firstrun in parallel', type=int, default=1)
+        parser.add_argument('--pipeline-retry', dest='pipeline_retry', help='retry failed cases in another browser while the firstrun is still running', action='store_true')
+        parser.add_argument('--isolate-crash', dest='isolate_crash', help='find the case really causing a crash in firstrun by replaying the cases before it in other browsers', action='store_true')
+        parser.add_argument('--crash-window', dest='crash_window', help='number of cases before a crash to replay for --isolate-crash', type=int, default=8)
+        parser.add_argument('--standby', dest='standby', help='number of standby browsers prespawned to replace crashed or timed out ones', type=int, default=0)
+        parser.add_argument('--shard', dest='shard', help='only test shard i of n, e.g., 0/4. Cases are balanced by the durations in time file, so all machines should share it')
+        parser.add_argument('--time-file', dest='time_file', help='file of recorded case durations, default is log/time-<version>.json')
+        parser.add_argument('--expectations-file', dest='expectations_file', help='file of expectations in addition to the built-in ones, see Expectations for the format')
+        parser.add_argument('--export', dest='export', help='formats of results exported while testing, split by ",", e.g., jsonl,csv,junit')
+        parser.add_argument('--list-cases', dest='list_cases', help='list cases of the suite from the case list cached by a previous run, without launching browser', action='store_true')
+
+        mirror_group = parser.add_argument_group('mirror')
+        mirror_group.add_argument('--mirror', dest='mirror', help='test with a local mirror of the conformance test, which is built on first use', action='store_true')
+        mirror_group.add_argument('--build-mirror', dest='build_mirror', help='build or refresh the local mirror of the version, then exit', action='store_true')
+        mirror_group.add_argument('--mirror-dir', dest='mirror_dir', help='directory of local mirrors', default='mirror')
+        mirror_group.add_argument('--mirror-port', dest='mirror_port', help='port of local mirror server', type=int, default=8000)
+        mirror_group.add_argument('--mirror-archive', dest='mirror_archive', help='url or path of WebGL repository archive to build mirror from', default=CtsMirror.ARCHIVE_URL)
+
+        flake_group = parser.add_argument_group('flake')
+        flake_group.add_argument('--flake-runs', dest='flake_runs', help='after the retry, rerun the cases failed in firstrun and the quarantined ones this number of times, spread over --jobs browsers, to measure their flakiness', type=int, default=0)
+        flake_group.add_argument('--flake-file', dest='flake_file', help='file of recorded outcomes of flaky cases, default is log/flake-<version>.json')
+        flake_group.add_argument('--flake-threshold', dest='flake_threshold', help='flakiness score from 0 to 1 for a case to be quarantined', type=float, default=0.2)
+        flake_group.add_argument('--skip-flaky', dest='skip_flaky', help='skip quarantined cases in firstrun, they are marked as FLAKY. About 1 in 10 of them still run to check if they are fixed', action='store_true')
+
+        build_group = parser.add_argument_group('build')
+        build_group.add_argument('--build-cache-dir', dest='build_cache_dir', help='directory of build cache, whose builds are stored once per file content', default='build')
+        build_group.add_argument('--build-cache-size', dest='build_cache_size', help='budget of build cache in GB, the least recently used builds are evicted beyond it', type=float, default=20)
+        build_group.add_argument('--build-add', dest='build_add', help='add zip or tar archives or directories of builds to build cache, split by ",", e.g., 500000=chrome-linux-500000.zip, then exit')
+        build_group.add_argument('--build-list', dest='build_list', help='list builds in build cache, then exit', action='store_true')
+
+        history_group = parser.add_argument_group('history')
+        history_group.add_argument('--history-file', dest='history_file', help='database of run history, which every run is added to, default is <log-dir>/history.db')
+        history_group.add_argument('--history-trend', dest='history_trend', help='print results of the case in all runs, then exit')
+        history_group.add_argument('--history-first-fail', dest='history_first_fail', help='print the first run of the latest failures of the case, then exit')
+        history_group.add_argument('--history-drift', dest='history_drift', help='print cases slowing down the most between the latest runs and the runs before, then exit', action='store_true')
+        history_group.add_argument('--history-runs', dest='history_runs', help='number of runs in each window to compare for --history-drift', type=int, default=7)
+        history_group.add_argument('--history-filter', dest='history_filter', help='only query runs with these environments, split by ",", e.g., gpu_product=HD Graphics 530,browser_name=chrome. Keys are %s' % ', '.join(History.ENV_COLUMNS))
 
         debug_group = parser.add_argument_group('debug')
         debug_group.add_argument('--fixed-time', dest='fixed_time', help='fixed time', action='store_true')
@@ -927,18 +3328,111 @@ class Conformance(object):
         # log
         work_dir = Util.use_slash(sys.path[0])
         os.chdir(work_dir)
-        self.log_dir = 'log'
+        self.log_dir = args.log_dir
         Util.ensure_dir(self.log_dir)
         self.log_file = '%s/%s.log' % (self.log_dir, self.timestamp)
         Util.ensure_nofile(self.log_file)
         Util.set_logger(self.log_file, args.logging_level)
         self._logger = Util.get_logger()
-        self.resume_file = '%s/resume' % self.log_dir
+        self.journal = Journal('%s/journal' % self.log_dir)
+        if args.history_file:
+            self.history_file = args.history_file
+        else:
+            self.history_file = '%s/history.db' % self.log_dir
+        if args.history_trend or args.history_first_fail or args.history_drift:
+            self._query_history(args)
+            return
+        self.args = args
+        self.build_cache = None
+        if args.build_add or args.build_list:
+            for item in args.build_add.split(',') if args.build_add else []:
+                (revision, _, archive_path) = item.partition('=')
+                if not revision or not os.path.exists(archive_path):
+                    Util.error('Build should be in format <revision>=<archive>, and %s is not' % item)
+                self._get_build_cache().add(revision, archive_path)
+            if args.build_list:
+                for (revision, last_used, size) in self._get_build_cache().get_builds():
+                    print('%s %s %sMB' % (revision, datetime.datetime.fromtimestamp(last_used).strftime('%Y-%m-%d %H:%M:%S'), size // (1024 * 1024)))
+            return
 
         # result
-        self.result_dir = 'result'
+        self.result_dir = args.result_dir
         Util.ensure_dir(self.result_dir)
         self.result_file = '%s/%s.html' % (self.result_dir, self.timestamp)
+        self.exporters = []
+        if args.export:
+            for format in args.export.split(','):
+                self.exporters.append(Exporter.get_exporter(format, '%s/%s' % (self.result_dir, self.timestamp)))
+
+        # url
+        self.version = args.version
+        if args.time_file:
+            self.time_file = args.time_file
+        else:
+            self.time_file = '%s/time-%s.json' % (self.log_dir, self.version)
+        self.case_time = CaseTime(self.time_file)
+        if args.flake_file:
+            self.flake_file = args.flake_file
+        else:
+            self.flake_file = '%s/flake-%s.json' % (self.log_dir, self.version)
+        self.flake_stats = FlakeStats(self.flake_file)
+        self.quarantine = set()
+        if args.skip_flaky:
+            self.quarantine = self.flake_stats.get_skipped(args.flake_threshold)
+        self.flake_paths = []
+        self.case_indexes = None
+        if args.shard:
+            match = re.match('^(\d+)/(\d+)$', args.shard)
+            if not match or int(match.group(1)) >= int(match.group(2)):
+                Util.error('Shard should be in format i/n with 0 <= i < n')
+            self.shard_index = int(match.group(1))
+            self.shard_count = int(match.group(2))
+        if args.url:
+            self.url = args.url
+        else:
+            if self.version not in self.VERSION_TYPE:
+                Util.error('The version %s is not supported' % self.version)
+            type = self.VERSION_TYPE[self.version]
+            if args.mirror:
+                self.url = 'http://localhost:%d' % args.mirror_port
+            elif type == 'stable':
+                self.url = 'https://www.khronos.org/registry/webgl/conformance-suites/%s' % self.version
+            elif type == 'beta':
+                self.url = 'https://www.khronos.org/registry/webgl/sdk/tests'
+            self.url += '/webgl-conformance-tests.html'
+            if type == 'beta':
+                self.url += '?version=%s' % self.version
+        self.case_manifest = CaseManifest('%s/manifest.json' % self.log_dir)
+        if args.list_cases:
+            self._list_cases()
+            return
+
+        # mirror
+        if args.mirror or args.build_mirror:
+            if self.version not in self.VERSION_TYPE:
+                Util.error('The version %s is not supported' % self.version)
+            self.mirror = CtsMirror(args.mirror_dir, self.version, self.VERSION_TYPE[self.version])
+            if args.build_mirror or not self.mirror.exists():
+                self.mirror.build(args.mirror_archive)
+            if args.build_mirror:
+                return
+
+        # adb
+        if args.adb_server:
+            (host, _, port) = args.adb_server.partition(':')
+            AdbClient.shared = AdbClient(host or 'localhost', int(port or 5037))
+
+        # fanout
+        if args.android_devices:
+            if args.shard:
+                Util.error('Android devices are sharded by --android-fanout, and --shard could not be used with it')
+            android_devices = AndroidDevices()
+            if args.android_devices == 'all':
+                devices = android_devices.devices
+            else:
+                devices = [android_devices.get_device(device_id) for device_id in args.android_devices.split(',')]
+            DeviceFanout(self, devices, args.android_fanout).run()
+            return
 
         # device
         if args.os_name == 'android':
@@ -947,7 +3441,11 @@ class Conformance(object):
             self.android_device = None
 
         # OS
-        self.host_os = HostOS()
+        pkgs = []
+        if args.gles and platform.system() == 'Linux':
+            pkgs.append('libgles-mesa')
+        self.env_cache = EnvCache('%s/env.json' % self.log_dir, pkgs, args.refresh_env)
+        self.host_os = self.env_cache.get_host_os()
         if args.os_name == 'android':
             self.target_os = AndroidOS(self.android_device)
         else:
@@ -968,32 +3466,34 @@ class Conformance(object):
         if args.gles and self.target_os.is_linux() and 'chrome' in browser_name:
             browser_options.append('--use-gl=egl')
 
-        if 'chrome' in browser_name and not self.target_os.is_android() and not self.target_os.is_cros():
-            user_data_dir = 'user-data-dir-%s' % self.target_os.username
-            browser_options.append('--user-data-dir=%s' % (work_dir + '/' + user_data_dir))
-            Util.ensure_nodir(user_data_dir)
-            Util.ensure_dir(user_data_dir)
-
-        self.browser = Browser(name=browser_name, path=args.browser_path, options=browser_options, os=self.target_os)
+        self.work_dir = work_dir
+        self.browser_name = browser_name
+        self.browser_options = browser_options
+        self.browser_path = args.browser_path
+        if BuildCache.is_build_path(self.browser_path):
+            self.browser_path = self._get_build_cache().resolve(self.browser_path, self.host_os)
+        self.browser = self._get_browser()
 
         # others
         self.webdriver_path = args.webdriver_path
-        self.args = args
+        if BuildCache.is_build_path(self.webdriver_path):
+            self.webdriver_path = self._get_build_cache().resolve(self.webdriver_path, self.host_os)
         self.timeout = args.timeout
-
-        # url
-        self.version = args.version
-        if args.url:
-            self.url = args.url
-        else:
-            self.url = 'https://www.khronos.org/registry/webgl'
-            if self.version not in self.VERSION_TYPE:
-                Util.error('The version %s is not supported' % self.version)
-            type = self.VERSION_TYPE[self.version]
-            if type == 'stable':
-                self.url += '/conformance-suites/%s/webgl-conformance-tests.html' % self.version
-            elif type == 'beta':
-                self.url += '/sdk/tests/webgl-conformance-tests.html?version=%s' % self.version
+        if args.adaptive_timeout and (args.timeout_floor > args.timeout_ceiling or not 0 < args.timeout_percentile <= 100):
+            Util.error('Adaptive timeout needs floor <= ceiling and percentile in (0, 100]')
+        if args.jobs < 1:
+            Util.error('The number of jobs should be at least 1')
+        if args.jobs > 1 and (self.target_os.is_android() or self.target_os.is_cros()):
+            Util.error('Parallel jobs are only supported on desktop')
+        if args.standby > 0 and (self.target_os.is_android() or self.target_os.is_cros()):
+            Util.error('Standby browsers are only supported on desktop')
+        if args.pipeline_retry and (self.target_os.is_android() or self.target_os.is_cros()):
+            Util.error('Pipelined retry is only supported on desktop')
+        if args.isolate_crash and (self.target_os.is_android() or self.target_os.is_cros()):
+            Util.error('Crash isolation is only supported on desktop')
+        self.standby_pool = None
+        self.retry_pipeline = None
+        self.crash_isolator = None
 
         # runtime env
         mesa_dir = args.mesa_dir
@@ -1003,45 +3503,131 @@ class Conformance(object):
 
         if args.gles and self.target_os.is_linux() and self.gpu.is_intel():
             pkg = 'libgles-mesa'
-            if not Util.has_pkg(pkg):
+            if not self.env_cache.has_pkg(pkg):
                 Util.error('Package %s is not installed' % pkg)
         if args.gles and self.gpu.is_nvidia():
             Util.set_env('LD_LIBRARY_PATH', '/usr/lib/nvidia-' + self.gpu.version.split('.')[0])
 
+        if args.mirror:
+            self.mirror.serve(args.mirror_port, self.android_device)
+            # CrOS device couldn't reach localhost of host
+            if self.target_os.is_cros() and not args.url:
+                self.url = self.url.replace('localhost', Util.get_host_ip(), 1)
+
         # test
         if args.dryrun_test:
             self.exp_suite = Suite()
             self.cur_suite = Suite(self.exp_suite)
-            self.driver = None
-            self.gpu = self.gpus.get_active(self.driver)
+            self.gpu = self.gpus.get_active(None)
         else:
-            self._start(is_firstrun=True)
-            self._run('firstrun')
+            if args.standby > 0:
+                self.standby_pool = StandbyPool(self, args.standby)
+            try:
+                self._start()
+                if args.pipeline_retry:
+                    self.retry_pipeline = RetryPipeline(self)
+                if args.isolate_crash:
+                    self.crash_isolator = CrashIsolator(self, args.jobs)
+                self._run('firstrun')
+            finally:
+                # standby browsers only replace the crashed ones of firstrun
+                if self.standby_pool:
+                    self.standby_pool.close()
+                    self.standby_pool = None
+            if self.retry_pipeline:
+                self.retry_pipeline.close()
+                self.retry_pipeline = None
             self._run('retry')
+            self.flake_stats.add_suite(self.cur_suite)
+            if args.flake_runs > 0:
+                self._run_flake(args.flake_runs)
+            self.flake_stats.save()
+            self.case_time.add_suite(self.cur_suite)
+            self.case_time.save()
 
         # report
-        self._gen_report()
+        details = self._get_details()
+        self._gen_report(details)
+        for exporter in self.exporters:
+            exporter.add_changes(details)
+            exporter.close()
+
+        # history
+        if not args.dryrun_test:
+            history = History(self.history_file)
+            history.add_run(self.timestamp, self.version, self.gpu, self.target_os, self.browser, self.cur_suite)
+            history.close()
+
+    def _query_history(self, args):
+        env_filter = {}
+        if args.history_filter:
+            for item in args.history_filter.split(','):
+                (key, _, value) = item.partition('=')
+                env_filter[key] = value
+        history = History(self.history_file)
+        if args.history_trend:
+            for (timestamp, status, total_count, pass_count, time) in history.get_trend(args.history_trend, env_filter):
+                print('%s %s %s/%s %s%% %sms' % (timestamp, status, pass_count, total_count, self._get_passrate(total_count, pass_count), time))
+        if args.history_first_fail:
+            timestamp = history.get_first_fail(args.history_first_fail, env_filter)
+            if timestamp:
+                print('%s fails since %s' % (args.history_first_fail, timestamp))
+            else:
+                print('%s is not failing' % args.history_first_fail)
+        if args.history_drift:
+            for (path, previous_time, latest_time) in history.get_drift(args.history_runs, self.TOP_TIME_COUNT, env_filter):
+                print('%s %.0fms -> %.0fms' % (path, previous_time, latest_time))
+        history.close()
 
     # Crash in previous case may only be found in current case, so we just log
     # the previous result so that we don't need to modify a record.
-    def _append_resume(self, f, index):
-        if index < 1:
+    def _append_resume(self, mode, case):
+        if not case or mode == 'flake':
             return
-        case = self.cur_suite.get_case(index - 1)
-        f.write('%s,%s,%s,%s,%s\n' % (case.path, case.status, case.total_count, case.pass_count, case.time))
-
-    def _crash(self, mode, index):
-        if mode == 'firstrun':
-            crash_case = self.cur_suite.get_case(index - 1)
-        else:
-            crash_case = self.cur_suite.get_case(self.cur_suite.retry_index[index - 1])
-        crash_case.status = Status.CRASH
-        crash_case.total_count = 1
-        crash_case.pass_count = 0
-        self._logger.warning('Case %s crashed' % crash_case.path)
-        self._start()
-
-    def _gen_report(self):
+        self.journal.add(mode, case)
+        for exporter in self.exporters:
+            exporter.add(mode, case)
+        if mode == 'firstrun' and self.retry_pipeline and self._need_retry(case):
+            self.retry_pipeline.add(case)
+
+    # same as the cases put into retry_index of cur_suite
+    def _need_retry(self, case):
+        return case.is_fail() and case.path not in self.exp_suite.issue_path
+
+    # Blame the crashes on the cases found by crash isolator, and give the
+    # wrongly blamed cases back their results.
+    def _isolate_crashes(self, cases):
+        for (blamed_case, blamed_result, trigger, partner) in self.crash_isolator.close():
+            if trigger is None or trigger not in cases:
+                continue
+            if partner is not None:
+                self._logger.warning('Crash of %s only happens after %s' % (self.case_paths[trigger], self.case_paths[partner]))
+            trigger_case = cases[trigger]
+            if trigger_case is blamed_case:
+                continue
+            self._logger.warning('Crash blamed on %s is caused by %s' % (blamed_case.path, trigger_case.path))
+            (blamed_case.status, blamed_case.total_count, blamed_case.pass_count) = blamed_result
+            trigger_case.status = Status.CRASH
+            trigger_case.total_count = 1
+            trigger_case.pass_count = 0
+            self._append_resume('firstrun', blamed_case)
+            self._append_resume('firstrun', trigger_case)
+
+    # Only crashes in firstrun are isolated, as session.history is only
+    # recorded there. indexes[0] is the case running when the crash was found,
+    # so it is not in the window.
+    def _crash(self, session, mode, crash_case, indexes):
+        window = [index for index in session.history if not indexes or index != indexes[0]]
+        if mode == 'firstrun' and crash_case and self.crash_isolator and window:
+            self.crash_isolator.add(window, crash_case, (crash_case.status, crash_case.total_count, crash_case.pass_count))
+        if crash_case:
+            crash_case.status = Status.CRASH
+            crash_case.total_count = 1
+            crash_case.pass_count = 0
+            self._logger.warning('%sCase %s crashed' % (session.log_prefix, crash_case.path))
+        session.start(indexes, use_standby=mode == 'firstrun')
+
+    def _gen_report(self, details):
         # summary
         summary = []
         path_index = {}
@@ -1063,7 +3649,44 @@ class Conformance(object):
         case = Case('all', total_count=total_count, pass_count=pass_count)
         summary.append(case)
 
-        # detail
+        # top_time
+        top_time = heapq.nlargest(self.TOP_TIME_COUNT, [case for case in self.cur_suite.suite if case.path], key=lambda case: case.time)
+
+        # generate html
+        writer = ReportWriter(self.result_file)
+        writer.write_table(ReportTable('Environment', None, self._get_environment_rows()))
+        writer.write_table(ReportTable(
+            'Summary',
+            ['Test Case Category ', 'All', 'Pass ', 'Pass Rate %'],
+            (([case.path, case.total_count, case.pass_count, self._get_passrate(case.total_count, case.pass_count)], None, 0) for case in summary)
+        ))
+        writer.write_table(ReportTable(
+            'Details',
+            ['Case', 'Expectation Status', 'Expectation All', 'Expectation Pass', 'Expectation Pass Rate', 'Current Status', 'Current All', 'Current Pass', 'Current Pass Rate', 'Change'],
+            self._get_detail_rows(details)
+        ))
+        writer.write_table(ReportTable(
+            'Retry Cases',
+            ['Case'],
+            (([self.cur_suite.get_case(index).path], None, 0) for index in self.cur_suite.retry_index)
+        ))
+        if self.flake_paths:
+            writer.write_table(ReportTable(
+                'Flaky Cases',
+                ['Case', 'Runs', 'Passes', 'Flakiness', 'Quarantined'],
+                self._get_flake_rows()
+            ))
+        if self.version != '1.0.3':
+            writer.write_table(ReportTable(
+                'Top Time Consuming Cases',
+                ['Case', 'Time (ms)'],
+                (([case.path, case.time], None, 0) for case in top_time)
+            ))
+        writer.close()
+
+    # Changes of cur_suite against exp_suite, as (name, bgcolor, changes) of
+    # each category.
+    def _get_details(self):
         cur_diff_exp_path = Util.diff_list(self.cur_suite.issue_path, self.exp_suite.issue_path)
         exp_diff_cur_path = Util.diff_list(self.exp_suite.issue_path, self.cur_suite.issue_path)
         cur_exp_common_path = Util.intersect_list(self.cur_suite.issue_path, self.exp_suite.issue_path)
@@ -1071,11 +3694,15 @@ class Conformance(object):
         improve_fail_detail = []  # passrate < 100%
         regress_detail = []
         remain_detail = []
+        flaky_detail = []  # quarantined and not run
 
         for path in cur_diff_exp_path:
             cur_case = self.cur_suite.get_case(self.cur_suite.path_index[path])
             exp_case = Case(path, Status.PASS, cur_case.total_count, cur_case.total_count)
-            regress_detail.append(Change(exp_case, cur_case))
+            if cur_case.status == Status.FLAKY:
+                flaky_detail.append(Change(exp_case, cur_case))
+            else:
+                regress_detail.append(Change(exp_case, cur_case))
         for path in exp_diff_cur_path:
             exp_case = self.exp_suite.get_case(self.exp_suite.path_index[path])
             if path in self.cur_suite.path_index:
@@ -1095,7 +3722,9 @@ class Conformance(object):
             cur_case = self.cur_suite.get_case(self.cur_suite.path_index[path])
             exp_passrate = self._get_passrate(exp_case.total_count, exp_case.pass_count)
             cur_passrate = self._get_passrate(cur_case.total_count, cur_case.pass_count)
-            if cur_passrate < exp_passrate:
+            if cur_case.status == Status.FLAKY:
+                category = flaky_detail
+            elif cur_passrate < exp_passrate:
                 category = regress_detail
             elif cur_passrate > exp_passrate:
                 if cur_passrate == 100:
@@ -1104,199 +3733,99 @@ class Conformance(object):
                     category = improve_fail_detail
             else:
                 category = remain_detail
-            category.append(Change(exp_case, cur_case))
-
-        improve_pass_detail = sorted(improve_pass_detail, cmp=lambda x, y: cmp(x.exp_case.path, y.exp_case.path))
-        improve_fail_detail = sorted(improve_fail_detail, cmp=lambda x, y: cmp(x.exp_case.path, y.exp_case.path))
-        regress_detail = sorted(regress_detail, cmp=lambda x, y: cmp(x.exp_case.path, y.exp_case.path))
-        remain_detail = sorted(remain_detail, cmp=lambda x, y: cmp(x.exp_case.path, y.exp_case.path))
-
-        # top_time
-        top_time = []
-        all_time = sorted(self.cur_suite.suite, cmp=lambda x, y: cmp(x.time, y.time), reverse=True)
-        count = 0
-        for case in all_time:
-            if not case.path:
-                break
-            if count == self.TOP_TIME_COUNT:
-                break
-            top_time.append([case.path, case.time])
-            count += 1
-
-        # generate html
-        content = '''
-<html>
-  <head>
-    <meta http-equiv="content-type" content="text/html; charset=windows-1252">
-    <style type="text/css">
-      table {
-        border: 2px solid black;
-        border-collapse: collapse;
-        border-spacing: 0;
-      }
-      table tr td {
-        border: 1px solid black;
-      }
-    </style>
-  </head>
-  <body>
-        '''
-
-        # environment
-        content += '''
-    <h2>Environment</h2>
-    <table>
-      <tbody>
-        '''
+            category.append(Change(exp_case, cur_case, exp_passrate, cur_passrate))
+
+        details = [
+            ('improve_pass', '00FF00', improve_pass_detail),
+            ('improve_fail', 'A6FFA6', improve_fail_detail),
+            ('regress', 'FF9797', regress_detail),
+            ('remain', 'FFFF93', remain_detail),
+            ('flaky', 'C0C0C0', flaky_detail),
+        ]
+        for (_, _, detail) in details:
+            detail.sort(key=lambda change: change.exp_case.path)
+        return details
+
+    def _get_flake_rows(self):
+        quarantine = self.flake_stats.get_quarantine(self.args.flake_threshold)
+        for path in sorted(self.flake_paths, key=lambda path: -self.flake_stats.get_score(path)):
+            samples = self.flake_stats.samples[path]
+            yield ([path, len(samples), sum(samples), self.flake_stats.get_score(path), 'yes' if path in quarantine else 'no'], None, 0)
+
+    def _get_environment_rows(self):
         for env in ['gpu', 'host_os', 'target_os', 'browser']:
             if env == 'target_os' and self.host_os == self.target_os:
                 continue
-            content += '''
-        <tr bgcolor="#FFFF93"><td align="left" colspan="2"><strong>''' + env.upper() + '''</strong></td></tr>
-            '''
-            env_dict = json.loads(str(eval('self.' + env)))
+            yield ([env.upper()], 'FFFF93', 1)
+            env_dict = json.loads(str(getattr(self, env)))
             for key in env_dict:
-                content += '''
-        <tr>
-          <td align="left"><strong>''' + str(key) + '''</strong></td>
-          <td align="left">''' + str(env_dict[key]) + '''</td>
-        </tr>
-            '''
-
-        content += '''
-      </tbody>
-    </table>
-    '''
-
-        # summary
-        content += '''
-    <h2>Summary</h2>
-    <table>
-      <tbody>
-        <tr>
-          <td align="left"><strong>Test Case Category </strong></td>
-          <td align="left"><strong>All</strong> </td>
-          <td align="left"><strong>Pass </strong> </td>
-          <td align="left"><strong>Pass Rate %</strong> </td>
-        </tr>
-    '''
-        for case in summary:
-            content += '''
-        <tr>
-          <td align="left"> ''' + case.path + ''' </td>
-          <td align="left"> ''' + str(case.total_count) + ''' </td>
-          <td align="left"> ''' + str(case.pass_count) + ''' </td>
-          <td align="left"> ''' + str(self._get_passrate(case.total_count, case.pass_count)) + ''' </td>
-        </tr>
-        '''
-
-        content += '''
-      </tbody>
-    </table>
-    '''
-
-        # detail
-        content += '''
-    <h2>Details</h2>
-    <table>
-      <tbody>
-        <tr>
-          <td align="left"><strong>Case</strong></td>
-          <td align="left"><strong>Expectation Status</strong></td>
-          <td align="left"><strong>Expectation All</strong></td>
-          <td align="left"><strong>Expectation Pass</strong></td>
-          <td align="left"><strong>Expectation Pass Rate</strong></td>
-          <td align="left"><strong>Current Status</strong></td>
-          <td align="left"><strong>Current All</strong></td>
-          <td align="left"><strong>Current Pass</strong></td>
-          <td align="left"><strong>Current Pass Rate</strong></td>
-          <td align="left"><strong>Change</strong></td>
-        </tr>
-    '''
-
-        for detail in ['improve_pass_detail', 'improve_fail_detail', 'regress_detail', 'remain_detail']:
-            if detail == 'improve_pass_detail':
-                bgcolor = '00FF00'
-            elif detail == 'improve_fail_detail':
-                bgcolor = 'A6FFA6'
-            elif detail == 'regress_detail':
-                bgcolor = 'FF9797'
-            elif detail == 'remain_detail':
-                bgcolor = 'FFFF93'
-            for change in eval(detail):
-                content += '''
-        <tr bgcolor=#''' + bgcolor + '''>
-          <td align="left"> ''' + str(change.exp_case.path) + '''</td>
-          <td align="left"> ''' + str(change.exp_case.status) + '''</td>
-          <td align="left"> ''' + str(change.exp_case.total_count) + '''</td>
-          <td align="left"> ''' + str(change.exp_case.pass_count) + '''</td>
-          <td align="left"> ''' + str(self._get_passrate(change.exp_case.total_count, change.exp_case.pass_count)) + '''</td>
-          <td align="left"> ''' + str(change.cur_case.status) + '''</td>
-          <td align="left"> ''' + str(change.cur_case.total_count) + '''</td>
-          <td align="left"> ''' + str(change.cur_case.pass_count) + '''</td>
-          <td align="left"> ''' + str(self._get_passrate(change.cur_case.total_count, change.cur_case.pass_count)) + '''</td>
-          <td align="left"> ''' + detail.replace('_detail', '') + '''</td>
-        </tr>
-            '''
-
-        content += '''
-      </tbody>
-    </table>
-    '''
-
-        # retry
-        content += '''
-    <h2>Retry Cases</h2>
-    <table>
-      <tbody>
-        <tr>
-          <td align="left"> <strong>Case</strong>  </td>
-        </tr>
-    '''
-        for index in self.cur_suite.retry_index:
-            content += '''
-        <tr>
-          <td align="left"> ''' + self.cur_suite.get_case(index).path + ''' </td>
-        </tr>
-        '''
-        content += '''
-      </tbody>
-    </table>
-'''
-
-        # top time consuming
-        if self.version != '1.0.3':
-            content += '''
-    <h2>Top Time Consuming Cases</h2>
-    <table>
-      <tbody>
-        <tr>
-          <td align="left"><strong>Case</strong>  </td>
-          <td align="left"><strong>Time (ms)</strong> </td>
-        </tr>
-    '''
-            for case in top_time:
-                content += '''
-        <tr>
-          <td align="left"> ''' + case[0] + ''' </td>
-          <td align="left"> ''' + str(case[1]) + ''' </td>
-        </tr>
-        '''
-            content += '''
-      </tbody>
-    </table>
-'''
+                yield ([key, env_dict[key]], None, 1)
+
+    def _get_detail_rows(self, details):
+        for (name, bgcolor, detail) in details:
+            for change in detail:
+                exp_case = change.exp_case
+                cur_case = change.cur_case
+                if change.exp_passrate is None:
+                    change.exp_passrate = self._get_passrate(exp_case.total_count, exp_case.pass_count)
+                    change.cur_passrate = self._get_passrate(cur_case.total_count, cur_case.pass_count)
+                yield ([
+                    exp_case.path,
+                    exp_case.status,
+                    exp_case.total_count,
+                    exp_case.pass_count,
+                    change.exp_passrate,
+                    cur_case.status,
+                    cur_case.total_count,
+                    cur_case.pass_count,
+                    change.cur_passrate,
+                    name,
+                ], bgcolor, 0)
+
+    # Timeout of case in seconds. Adaptive timeout is rounded up to whole
+    # seconds, and durations in time file are in ms.
+    def _get_timeout(self, case_path):
+        if not self.args.adaptive_timeout:
+            return self.timeout
+        time = self.case_time.get_percentile(case_path, self.args.timeout_percentile, self.args.timeout_samples)
+        if time is None:
+            return self.timeout
+        timeout = int(math.ceil(time * self.args.timeout_factor / 1000))
+        return min(max(timeout, self.args.timeout_floor), self.args.timeout_ceiling)
+
+    # build cache is only created when used
+    def _get_build_cache(self):
+        if not self.build_cache:
+            args = self.args
+            self.build_cache = BuildCache(args.build_cache_dir, int(args.build_cache_size * 1024 * 1024 * 1024))
+        return self.build_cache
+
+    def _get_user_data_dir(self, name=''):
+        if 'chrome' not in self.browser_name or self.target_os.is_android() or self.target_os.is_cros():
+            return None
+        if self.args.user_data_dir:
+            user_data_dir = self.args.user_data_dir
+        else:
+            user_data_dir = 'user-data-dir-%s' % self.target_os.username
+        if name:
+            user_data_dir += '-%s' % name
+        return user_data_dir
+
+    def _get_browser(self, name=''):
+        browser_options = list(self.browser_options)
+        user_data_dir = self._get_user_data_dir(name)
+        if user_data_dir:
+            browser_options.append('--user-data-dir=%s' % (self.work_dir + '/' + user_data_dir))
+            Util.ensure_nodir(user_data_dir)
+            Util.ensure_dir(user_data_dir)
 
-        # tail
-        content += '''
-  </body>
-</html>
-    '''
-        f = open(self.result_file, 'w')
-        f.write(content)
-        f.close()
+        return Browser(name=self.browser_name, path=self.browser_path, options=browser_options, os=self.target_os, mirror=self.args.mirror)
 
-    def _get_case_elements(self):
+    # Return the harvested cases at indexes of self.case_paths, or all cases
+    # of the suite, as a dict keyed by index.
+    # With by_path, cases at indexes are found by their paths rather than their
+    # positions in page
+    def _get_case_elements(self, driver, indexes=None, by_path=False):
         if re.match('all', self.args.suite):
             suite = self.args.suite
         else:
@@ -1309,23 +3838,27 @@ class Conformance(object):
             folder_name = suite
             case_name = ''
 
-        folder_name_elements = self.driver.find_elements_by_class_name('folderName')
-        for folder_name_element in folder_name_elements:
-            if folder_name_element.text == folder_name:
-                tmp_case_elements = folder_name_element.find_elements_by_xpath('../..//*[@class="testpage"]')
-                if not case_name:
-                    case_elements = tmp_case_elements
-                    break
-                for case_element in tmp_case_elements:
-                    if '%s/%s' % ('all', case_element.find_element_by_xpath('./div/a').text) == suite:
-                        case_elements = [case_element]
-                        break
-                if case_elements:
-                    break
+        if case_name:
+            case_path = suite
         else:
-            Util.error('Could not find suite %s' % suite)
+            case_path = ''
+
+        if indexes is None and self.case_indexes is not None:
+            indexes = range(len(self.case_indexes))
+        if by_path or indexes is None or self.case_indexes is None:
+            page_indexes = None if by_path else indexes
+        else:
+            page_indexes = [self.case_indexes[index] for index in indexes]
 
-        self.case_elements = case_elements
+        case_elements = Harvester.get_cases(driver, folder_name, case_path, page_indexes)
+        if case_elements is None:
+            Util.error('Could not find suite %s' % suite)
+        if by_path:
+            path_elements = dict((case_element['path'], case_element) for case_element in case_elements)
+            return dict((index, path_elements.get(self.case_paths[index])) for index in indexes)
+        if indexes is None:
+            indexes = range(len(case_elements))
+        return dict(zip(indexes, case_elements))
 
     def _get_passrate(self, total, passed):
         if float(total) == 0:
@@ -1403,12 +3936,31 @@ class Conformance(object):
 
         return (status, total, passed + skipped, time)
 
-    def _log_resume(self, index, total_count, msg, case_path):
-        self._logger.info('(%s/%s) %s %s' % (index + 1, total_count, msg, case_path))
+    def _log_resume(self, session, index, total_count, msg, case_path):
+        self._logger.info('%s(%s/%s) %s %s' % (session.log_prefix, index + 1, total_count, msg, case_path))
+
+    def _read_resume(self):
+        state = self.journal.load()
+        path_index = dict((case_path, index) for index, case_path in enumerate(self.case_paths))
+        resume_cases = {}
+        for case_path in state['firstrun']:
+            if case_path not in path_index:
+                Util.error('The suite currently tested is different from the resumed one')
+            case = Case(*state['firstrun'][case_path])
+            resume_cases[path_index[case_path]] = case
+            for exporter in self.exporters:
+                exporter.add('firstrun', case)
+        for case_path in state['retry']:
+            for exporter in self.exporters:
+                exporter.add('retry', Case(*state['retry'][case_path]))
+        if resume_cases:
+            self._logger.info('Resume %s cases' % len(resume_cases))
+        self.journal.open()
+        return resume_cases
 
     def _run(self, mode):
         if mode == 'firstrun':
-            total_count = len(self.case_elements)
+            total_count = len(self.case_paths)
         elif mode == 'retry':
             total_count = len(self.cur_suite.retry_index)
         else:
@@ -1417,147 +3969,327 @@ class Conformance(object):
         if total_count < 1 and mode == 'firstrun':
             Util.error('No case will be tested')
         elif total_count < 1 and mode == 'retry':
-            f = open(self.resume_file, 'a')
-            f.write(self.TEST_DONE + '\n')
-            f.close()
+            self.journal.set_phase('done')
+            self.journal.close()
             self._logger.info('No need the %s' % mode)
             return
         else:
             self._logger.info('Begin the %s...' % mode)
 
         if mode == 'firstrun':
-            # resume_count
-            if os.path.exists(self.resume_file):
-                resume_lines = Util.read_file(self.resume_file)
-                resume_count = len(resume_lines)
-                if resume_count > 0 and resume_lines[-1].rstrip('\n') == self.TEST_DONE:
-                    resume_count = 0
+            cases = self._read_resume()
+            indexes = [index for index in range(total_count) if index not in cases]
+            if self.retry_pipeline:
+                for index in sorted(cases):
+                    if self._need_retry(cases[index]) and cases[index].path not in self.journal.state['retry']:
+                        self.retry_pipeline.add(cases[index])
+            if indexes:
+                self.journal.set_phase(mode)
+            if self.args.jobs > 1 and len(indexes) > 1:
+                self._run_shards(indexes, cases)
             else:
-                resume_count = 0
-
-            # resume file
-            if resume_count == 0:
-                Util.ensure_nofile(self.resume_file)
-                Util.ensure_file(self.resume_file)
-            f = open(self.resume_file, 'a')
-
-            # resume
-            if resume_count > 0:
-                if resume_count > len(self.case_elements) or resume_lines[-1].split(',')[0] != self.case_elements[resume_count - 1].find_element_by_xpath('./div/a').text:
-                    Util.error('The suite currently tested is different from the resumed one')
-
-                for resume_line in resume_lines:
-                    fields = resume_line.split(',')
-                    case = Case(fields[0], fields[1], int(fields[2]), int(fields[3]), float(fields[4]))
-                    self.cur_suite.add_case(case)
-                self._logger.info('Resume %s cases' % resume_count)
-
-            index = resume_count
+                self._run_cases(self.session, mode, indexes, cases)
+            # no crash is isolated after firstrun, so the isolator is drained once
+            if self.crash_isolator:
+                self._isolate_crashes(cases)
+                self.crash_isolator = None
+
+            for index in range(total_count):
+                self.cur_suite.add_case(cases[index])
         else:
-            index = 0
+            retry_cases = dict(self.journal.state['retry'])
+            indexes = []
+            for index in self.cur_suite.retry_index:
+                case = self.cur_suite.get_case(index)
+                if case.path not in retry_cases:
+                    indexes.append(index)
+                    continue
+                (case.path, case.status, case.total_count, case.pass_count, case.time) = retry_cases[case.path]
+                if case.is_pass():
+                    self.cur_suite.remove_issue(index)
+            if len(indexes) < total_count:
+                self._logger.info('%s cases were already retried' % (total_count - len(indexes)))
+
+            self.journal.set_phase(mode)
+            cases = dict((index, self.cur_suite.get_case(index)) for index in indexes)
+            self._run_cases(self.session, mode, indexes, cases)
+            for index in indexes:
+                if cases[index].is_pass():
+                    self.cur_suite.remove_issue(index)
+            self.journal.set_phase('done')
+            self.journal.close()
+
+    # Run cases at indexes one by one in session. In firstrun and flake, new
+    # cases are put into cases by index. In retry, the cases in cases are
+    # updated.
+    def _run_cases(self, session, mode, indexes, cases=None):
+        total_count = len(indexes)
+        prev_case = None
+        index = 0
+        session.resolve(indexes)
         while index < total_count:
-            if mode == 'firstrun':
-                case_index = index
-                case_element = self.case_elements[case_index]
-            else:
-                case_index = self.cur_suite.retry_index[index]
-                case_element = self.case_elements[case_index]
-                case = self.cur_suite.get_case(case_index)
-            case_path = case_element.find_element_by_xpath('./div/a').text
+            case_index = indexes[index]
+            case_path = self.case_paths[case_index]
+            case_element = session.case_elements[case_index]
+            if mode == 'retry':
+                case = cases[case_index]
 
             # filter
             if mode == 'firstrun' and case_path in self.exp_suite.filter_path:
                 case = Case(case_path, Status.FILTER)
-                self.cur_suite.add_case(case)
-                self._log_resume(index, total_count, 'Filter', case_path)
-                if mode == 'firstrun':
-                    self._append_resume(f, index)
+                cases[case_index] = case
+                self._log_resume(session, index, total_count, 'Filter', case_path)
+                self._append_resume(mode, prev_case)
+                prev_case = case
+                index += 1
+                continue
+            if mode == 'firstrun' and case_path in self.quarantine:
+                case = Case(case_path, Status.FLAKY)
+                cases[case_index] = case
+                self._log_resume(session, index, total_count, 'Skip flaky', case_path)
+                self._append_resume(mode, prev_case)
+                prev_case = case
                 index += 1
                 continue
 
             # run test
-            self._log_resume(index, total_count, 'Run', case_path)
+            self._log_resume(session, index, total_count, 'Run', case_path)
             try:
-                button = case_element.find_element_by_xpath('./div/input[@type="button"]')
-                button.click()
-            except NoSuchElementException:
-                self._crash(mode, index)
+                if not case_element['button']:
+                    raise NoSuchElementException('Could not find button of case %s' % case_path)
+                case_element['button'].click()
+            except WebDriverException:
+                self._crash(session, mode, prev_case, indexes[index:])
                 continue
+            if mode == 'firstrun':
+                session.history.append(case_index)
 
             # handle result
-            try:
-                WebDriverWait(self.driver, self.timeout).until(lambda driver: re.search('(passed|skipped|failed|timeout)', case_element.find_element_by_xpath('./div').text, re.I))
-            except TimeoutException:
-                if mode == 'firstrun':
+            state = session.wait_case(case_element['element'], self._get_timeout(case_path))
+            if not state:
+                if mode != 'retry':
                     case = Case(case_path, Status.PYTIMEOUT)
-                    self.cur_suite.add_case(case)
-                self._logger.warning('Case %s timeout in python script' % case_path)
-                self._start()
-                index += 1
+                    cases[case_index] = case
+                self._logger.warning('%sCase %s timeout in python script' % (session.log_prefix, case_path))
+                session.start(indexes[index + 1:], use_standby=mode == 'firstrun')
             else:
-                (case_status, case_total_count, case_pass_count, case_time) = self._get_result(case_element.find_element_by_xpath('./div').text)
-                if mode == 'firstrun':
+                (case_status, case_total_count, case_pass_count, case_time) = self._get_result(state['text'])
+                if mode != 'retry':
                     case = Case(case_path, case_status, case_total_count, case_pass_count, case_time)
-                    self.cur_suite.add_case(case)
+                    cases[case_index] = case
                 else:
                     case.status = case_status
                     case.total_count = case_total_count
                     case.pass_count = case_pass_count
                     case.time = case_time
-                self._logger.info(case.status)
+                self._logger.info(session.log_prefix + case.status)
 
-                if case.is_pass():
-                    if mode == 'retry':
-                        self.cur_suite.remove_issue(case_index)
-                elif case_element.find_element_by_xpath('./ul').find_elements_by_tag_name('li') and re.search('Unable to fetch WebGL rendering context for Canvas', case_element.find_element_by_xpath('./ul/li').text):
-                    self._crash(mode, index)
+                if not case.is_pass() and state['messages'] and re.search(self.CONTEXT_LOST_PATTERN, state['messages'][0]):
+                    self._crash(session, mode, prev_case, indexes[index:])
                     continue
 
-                if mode == 'firstrun':
-                    self._append_resume(f, index)
-                index += 1
+            self._append_resume(mode, prev_case)
+            prev_case = case
+            index += 1
 
-        if mode == 'firstrun':
-            self._append_resume(f, index)
-        if mode == 'retry':
-            f = open(self.resume_file, 'a')
-            f.write(self.TEST_DONE + '\n')
-        f.close()
+        self._append_resume(mode, prev_case)
 
-    def _start(self, is_firstrun=False):
-        self.webdriver = Webdriver(browser=self.browser, path=self.webdriver_path, host_os=self.host_os, target_os=self.target_os, android_device=self.android_device)
-        self.driver = self.webdriver.driver
+    # Rerun the cases failed in firstrun and the quarantined ones run_count
+    # times. Each session runs whole rounds of these cases, and the outcomes of
+    # all rounds are sampled into flake_stats.
+    def _run_flake(self, run_count):
+        indexes = sorted(set(self.cur_suite.retry_index) | set(index for (index, case) in enumerate(self.cur_suite.suite) if case.status == Status.FLAKY))
+        if not indexes:
+            self._logger.info('No need the flake analysis')
+            return
+        self._logger.info('Begin the flake analysis of %s cases...' % len(indexes))
 
-        if is_firstrun:
-            self.browser.update(self.driver)
-            self.gpus = GPUs(self.target_os, self.android_device, self.driver)
-            self.gpu = self.gpus.get_active(self.driver)
-            self.exp_suite = Suite()
-            for exp in Expectations().expectations:
-                if exp.is_valid(self.gpu, self.target_os, self.browser) and (self.args.suite == 'all' or re.match(self.args.suite, exp.path)):
-                    self.exp_suite.add_case(Case(exp.path, exp.status, exp.total_count, exp.pass_count))
-            self.cur_suite = Suite(self.exp_suite)
+        jobs = min(self.args.jobs, run_count)
+        self.session.name = 'flake0'
+        sessions = [self.session]
+        for job in range(1, jobs):
+            name = 'flake%s' % job
+            sessions.append(Session(self, self._get_browser(name), name))
 
-        self.driver.get(self.url)
-        try:
-            WebDriverWait(self.driver, 60).until(lambda driver: self.driver.find_element_by_id('page0'))
-        except TimeoutException:
-            Util.error('Could not open %s correctly' % self.url)
-
-        if is_firstrun:
-            option_element = Select(self.driver.find_element_by_id("testVersion")).first_selected_option
-            real_version = option_element.text
-            type = self.VERSION_TYPE[self.version]
-            if type == 'beta':
-                real_version = real_version.replace(' (beta)', '')
-            if self.version != real_version:
-                Util.error('The designated version does not match the real version')
+        rounds = []
+        errors = []
 
-        self._get_case_elements()
+        def run_rounds(session, round_count):
+            try:
+                if not session.driver:
+                    session.start()
+                for _ in range(round_count):
+                    cases = {}
+                    self._run_cases(session, 'flake', indexes, cases)
+                    rounds.append(cases)
+            except (Exception, SystemExit) as e:
+                errors.append('%s: %s' % (session.name, e))
+
+        threads = []
+        for job in range(jobs):
+            thread = threading.Thread(target=run_rounds, args=(sessions[job], len(range(job, run_count, jobs))))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        for session in sessions[1:]:
+            session.quit()
+        self.session.name = ''
+
+        if errors:
+            Util.error('Failed to run flake analysis: %s' % ', '.join(errors))
+        for cases in rounds:
+            for index in cases:
+                if cases[index].is_pass() or cases[index].is_fail():
+                    self.flake_stats.add(cases[index].path, cases[index].is_pass())
+        self.flake_paths = [self.case_paths[index] for index in indexes]
+        self._logger.info('Finished %s rounds of flake analysis' % len(rounds))
+
+    # Each shard has its own browser instance, so that crashes and restarts
+    # only affect the cases of the shard that hit them.
+    def _run_shards(self, indexes, cases):
+        jobs = min(self.args.jobs, len(indexes))
+        shards = self._schedule(indexes, jobs)
+        self.session.name = 'shard0'
+        sessions = [self.session]
+        for job in range(1, jobs):
+            name = 'shard%s' % job
+            sessions.append(Session(self, self._get_browser(name), name))
+
+        errors = []
+
+        def run_shard(session, shard_indexes):
+            try:
+                if not session.driver:
+                    session.start()
+                self._run_cases(session, 'firstrun', shard_indexes, cases)
+            except (Exception, SystemExit) as e:
+                errors.append('%s: %s' % (session.name, e))
+
+        threads = []
+        for job in range(jobs):
+            thread = threading.Thread(target=run_shard, args=(sessions[job], shards[job]))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        for session in sessions[1:]:
+            session.quit()
+        self.session.name = ''
+
+        if errors:
+            Util.error('Failed to run shards: %s' % ', '.join(errors))
+        self._logger.info('Merged results of %s shards' % jobs)
+
+    # Longest processing time first: cases are assigned from the slowest to the
+    # least loaded shard, and ties go to the shard with fewer cases. Cases keep
+    # their original order within a shard.
+    def _schedule(self, indexes, count):
+        shards = [[] for _ in range(count)]
+        loads = [(0, 0, shard) for shard in range(count)]
+        costs = self.case_time.get_all([self.case_paths[index] for index in indexes])
+        for cost, index in sorted(zip(costs, indexes), key=lambda x: (-x[0], x[1])):
+            (load, case_count, shard) = heapq.heappop(loads)
+            shards[shard].append(index)
+            heapq.heappush(loads, (load + cost, case_count + 1, shard))
+        for shard in shards:
+            shard.sort()
+        return shards
+
+    def _start(self):
+        self.session = Session(self, self.browser)
+        self.session.launch()
+        driver = self.session.driver
+        self.env_cache.update_browser(self.browser, driver)
+        self.gpus = self.env_cache.get_gpus(self.target_os, self.android_device, driver)
+        self.gpu = self.env_cache.get_active_gpu(self.gpus, self.browser, driver)
+        self.exp_suite = Suite()
+        for exp in Expectations(self.args.expectations_file, self.log_dir).resolve(self.version, self.gpu, self.target_os, self.browser, self.args.suite):
+            self.exp_suite.add_case(Case(exp.path, exp.status, exp.total_count, exp.pass_count))
+        self.cur_suite = Suite(self.exp_suite)
+
+        self.session.load()
+        option_element = Select(driver.find_element_by_id("testVersion")).first_selected_option
+        real_version = option_element.text
+        type = self.VERSION_TYPE[self.version]
+        if type == 'beta':
+            real_version = real_version.replace(' (beta)', '')
+        if self.version != real_version:
+            Util.error('The designated version does not match the real version')
+
+        # case list is cached until the fingerprint of harness page changes
+        fingerprint = Harvester.get_fingerprint(driver)
+        case_paths = self.case_manifest.get(self._get_manifest_key(), fingerprint)
+        if case_paths is None:
+            case_elements = self._get_case_elements(driver)
+            case_paths = [case_elements[index]['path'] for index in range(len(case_elements))]
+            self.case_manifest.set(self._get_manifest_key(), fingerprint, case_paths)
+            self.case_manifest.save()
+        else:
+            case_elements = {}
+            self._logger.info('Use cached list of %s cases' % len(case_paths))
+        self.case_paths = self._select_shard(case_paths)
+        if self.case_indexes is None:
+            self.session.case_elements = case_elements
+
+    def _get_manifest_key(self):
+        return '%s|%s|%s' % (self.version, self.url, self.args.suite)
+
+    def _list_cases(self):
+        case_paths = self.case_manifest.get(self._get_manifest_key())
+        if case_paths is None:
+            Util.error('Case list of suite %s is not cached yet, please run it once' % self.args.suite)
+        for case_path in self._select_shard(case_paths):
+            print(case_path)
+
+    def _select_shard(self, case_paths):
+        if not self.args.shard:
+            return case_paths
+        self.case_paths = case_paths
+        self.case_indexes = self._schedule(range(len(case_paths)), self.shard_count)[self.shard_index]
+        self._logger.info('Test shard %s/%s with %s cases' % (self.shard_index, self.shard_count, len(self.case_indexes)))
+        return [case_paths[index] for index in self.case_indexes]
+
+
+# Paths split by "/" into nested dicts, so that the values under a folder are
+# found without going through all the paths.
+class PathTrie(object):
+    def __init__(self, root=None):
+        if root is None:
+            root = {}
+        self.root = root
+
+    def add(self, path, value):
+        node = self.root
+        for name in path.split('/'):
+            node = node.setdefault(name, {})
+        node.setdefault(None, []).append(value)
+
+    # Values of all the paths under prefix, in no particular order.
+    def get(self, prefix=''):
+        node = self.root
+        for name in prefix.split('/'):
+            if not name:
+                continue
+            if name not in node:
+                return []
+            node = node[name]
+        values = []
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            for name in node:
+                if name is None:
+                    values.extend(node[name])
+                else:
+                    nodes.append(node[name])
+        return values
 
 
 class Expectation(object):
-    def __init__(self, version, path, status, total_count=0, pass_count=0, gpu=None, os=None, browser=None):
+    def __init__(self, version, path, status, total_count=0, pass_count=0, gpu=None, os=None, browser=None, conditions=None):
         self.version = version
         self.path = path
         self.status = status
@@ -1566,20 +4298,187 @@ class Expectation(object):
         self.gpu = gpu
         self.os = os
         self.browser = browser
+        self.conditions = {}
+        if gpu or os or browser:
+            self.conditions = dict((key, value) for (key, value) in Expectations.get_env(gpu, os, browser).items() if value)
+        if conditions:
+            self.conditions.update(conditions)
+
+
+# Expectations are indexed by the keys of their conditions, then by the values
+# of these keys, so that resolving only looks up each set of keys once with the
+# values of environment, instead of checking every expectation.
+#
+# Expectations could also be read from a file, with one expectation per line:
+#   <version> <path> <status> [<total_count> <pass_count>] [<key>=<value> ...]
+# where key is one of ENV_KEYS, and value could be quoted if it has spaces,
+# e.g.,
+#   2.0.1 deqp/functional/gles3/builtinprecision/atan2.html FAIL 25 17 os_name=win gpu_product_name="HD Graphics 530"
+# Lines starting with "#" are comments. The index built from the file is cached
+# in cache_dir, and reused until the content of file changes.
+class Expectations(object):
+    ENV_KEYS = ['gpu_vendor', 'gpu_product_id', 'gpu_product_name', 'gpu_driver', 'os_name', 'os_version', 'browser_name', 'browser_version']
+    CACHE_FORMAT = 1
+    CONDITION_PATTERN = re.compile('(\w+)=("[^"]*"|\S+)')
 
-    def is_valid(self, gpu, os, browser):
-        return True
+    def __init__(self, file_path=None, cache_dir=None):
+        self.index = {}
+        self.records = []
+        self._logger = Util.get_logger()
+        if file_path:
+            self._load(file_path, cache_dir)
 
+        # win_os = OS('win')
+        # self._add_exp('2.0.1', 'deqp/functional/gles3/builtinprecision/atan2.html', Status.FAIL, 25, 17, os=win_os)
 
-class Expectations(object):
-    def __init__(self):
-        self.expectations = []
+    # Expectations of version under suite that match the environment, in the
+    # order they were added. If a path has several, the one with most
+    # conditions wins.
+    def resolve(self, version, gpu, os, browser, suite='all'):
+        env = self.get_env(gpu, os, browser)
+        prefix = re.sub('^all(/|$)', '', suite)
+        selected = {}
+        for keys in self.index:
+            trie = self.index[keys].get((version,) + tuple(env[key] for key in keys))
+            if not trie:
+                continue
+            for order in trie.get(prefix):
+                path = self.records[order][1]
+                if path not in selected or selected[path] < (len(keys), order):
+                    selected[path] = (len(keys), order)
+        records = [self.records[order] for (_, order) in sorted(selected.values(), key=lambda priority: priority[1])]
+        return [Expectation(*record[:5], conditions=record[5]) for record in records]
 
-        # win_os = OS('windows')
-        # self._add_exp('2.0.1', 'deqp/functional/gles3/builtinprecision/atan2.html', Status.FAIL, 25, 17, os=win_os)
+    @staticmethod
+    def get_env(gpu, os, browser):
+        env = dict((key, '') for key in Expectations.ENV_KEYS)
+        if gpu:
+            env['gpu_vendor'] = gpu.vendor_name
+            env['gpu_product_id'] = gpu.product_id
+            env['gpu_product_name'] = gpu.product_name
+            env['gpu_driver'] = gpu.driver_version
+        if os:
+            env['os_name'] = os.name
+            env['os_version'] = os.version
+        if browser:
+            env['browser_name'] = browser.name
+            env['browser_version'] = browser.version
+        return env
 
     def _add_exp(self, version, path, status, total_count=0, pass_count=0, gpu=None, os=None, browser=None):
-        self.expectations.append(Expectation(version, path, status, total_count, pass_count, gpu, os, browser))
+        exp = Expectation(version, path, status, total_count, pass_count, gpu, os, browser)
+        self._add_record((version, path, status, total_count, pass_count, exp.conditions))
+
+    # record is (version, path, status, total_count, pass_count, conditions)
+    def _add_record(self, record):
+        conditions = record[5]
+        keys = tuple(sorted(conditions))
+        values = (record[0],) + tuple(conditions[key] for key in keys)
+        tries = self.index.setdefault(keys, {})
+        if values not in tries:
+            tries[values] = PathTrie()
+        tries[values].add(record[1], len(self.records))
+        self.records.append(record)
+
+    def _load(self, file_path, cache_dir):
+        if not os.path.exists(file_path):
+            Util.error('Could not find expectations file %s' % file_path)
+        stat = os.stat(file_path)
+        cache_file = None
+        if cache_dir:
+            Util.ensure_dir(cache_dir)
+            cache_file = '%s/%s-%s.cache' % (cache_dir, os.path.basename(file_path), hashlib.sha1(os.path.abspath(file_path)).hexdigest()[:8])
+
+        # the cache is valid if mtime and size are unchanged, or otherwise the
+        # content hash is unchanged. gc is paused while loading, as it's
+        # triggered again and again by the many containers created.
+        cache = None
+        if cache_file and os.path.exists(cache_file):
+            f = open(cache_file, 'rb')
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                cache = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                cache = None
+            finally:
+                if gc_enabled:
+                    gc.enable()
+            f.close()
+            if not cache or cache['format'] != self.CACHE_FORMAT or cache['python'] != sys.version or cache['offset'] != len(self.records):
+                cache = None
+        if cache and (cache['mtime'] != stat.st_mtime or cache['size'] != stat.st_size):
+            if cache['hash'] != self._get_hash(file_path):
+                cache = None
+            else:
+                cache['mtime'] = stat.st_mtime
+                cache['size'] = stat.st_size
+                self._save_cache(cache_file, cache)
+
+        if cache:
+            for keys in cache['index']:
+                self.index[keys] = dict((values, PathTrie(root)) for (values, root) in cache['index'][keys].items())
+            self.records += cache['records']
+            self._logger.info('Use cached %s expectations of %s' % (len(cache['records']), file_path))
+            return
+
+        offset = len(self.records)
+        f = open(file_path)
+        for (line_number, line) in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            self._add_record(self._parse(file_path, line_number, line))
+        f.close()
+        self._logger.info('Load %s expectations of %s' % (len(self.records) - offset, file_path))
+        if cache_file:
+            self._save_cache(cache_file, {
+                'format': self.CACHE_FORMAT,
+                'python': sys.version,
+                'offset': offset,
+                'records': self.records[offset:],
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
+                'hash': self._get_hash(file_path),
+                'index': dict((keys, dict((values, trie.root) for (values, trie) in self.index[keys].items())) for keys in self.index),
+            })
+
+    def _parse(self, file_path, line_number, line):
+        fields = line.split(None, 3)
+        if len(fields) < 3 or fields[2] not in Status.ALL:
+            Util.error('Line %s of %s is not a valid expectation' % (line_number, file_path))
+        (version, path, status) = fields[:3]
+        total_count = 0
+        pass_count = 0
+        rest = ''.join(fields[3:])
+        match = re.match('(\d+)\s+(\d+)(\s+|$)', rest)
+        if match:
+            total_count = int(match.group(1))
+            pass_count = int(match.group(2))
+            rest = rest[match.end():]
+        conditions = {}
+        for (key, value) in self.CONDITION_PATTERN.findall(rest):
+            if key not in self.ENV_KEYS:
+                Util.error('Line %s of %s has unknown condition %s' % (line_number, file_path, key))
+            conditions[key] = value.strip('"')
+        if self.CONDITION_PATTERN.sub('', rest).strip():
+            Util.error('Line %s of %s is not a valid expectation' % (line_number, file_path))
+        return (version, path, status, total_count, pass_count, conditions)
+
+    def _get_hash(self, file_path):
+        f = open(file_path, 'rb')
+        file_hash = hashlib.sha1(f.read()).hexdigest()
+        f.close()
+        return file_hash
+
+    def _save_cache(self, cache_file, cache):
+        tmp_file = cache_file + '.tmp'
+        f = open(tmp_file, 'wb')
+        marshal.dump(cache, f)
+        f.close()
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        os.rename(tmp_file, cache_file)
 
 
 if __name__ == '__main__':
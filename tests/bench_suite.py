@@ -0,0 +1,49 @@
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conformance import Case, Status, Suite, Timer, Util
+
+
+# Benchmark building and diffing suites with a large number of cases
+def bench_suite(count):
+    print('Benchmark suites with %s cases' % count)
+    timer = Timer(use_ms=True)
+    exp_suite = Suite()
+    for index in range(count):
+        if index % 50 == 0:
+            exp_suite.add_case(Case('bench/%s.html' % index, Status.FILTER))
+        elif index % 10 == 0:
+            exp_suite.add_case(Case('bench/%s.html' % index, Status.FAIL, 10, 5))
+    cur_suite = Suite(exp_suite)
+    for index in range(count):
+        path = 'bench/%s.html' % index
+        if path in exp_suite.filter_path:
+            cur_suite.add_case(Case(path, Status.FILTER))
+        elif index % 7 == 0:
+            cur_suite.add_case(Case(path, Status.FAIL, 10, 5, index))
+        else:
+            cur_suite.add_case(Case(path, Status.PASS, 10, 10, index))
+    timer.stop()
+    print('Build: %s' % timer.diff())
+
+    timer = Timer(use_ms=True)
+    for index in cur_suite.retry_index[::2]:
+        cur_suite.remove_issue(index)
+    timer.stop()
+    print('Remove issues of %s retried cases: %s' % (len(cur_suite.retry_index[::2]), timer.diff()))
+
+    timer = Timer(use_ms=True)
+    cur_diff_exp_path = Util.diff_list(cur_suite.issue_path, exp_suite.issue_path)
+    exp_diff_cur_path = Util.diff_list(exp_suite.issue_path, cur_suite.issue_path)
+    cur_exp_common_path = Util.intersect_list(cur_suite.issue_path, exp_suite.issue_path)
+    timer.stop()
+    print('Diff: %s (regressed %s, improved %s, common %s)' % (timer.diff(), len(cur_diff_exp_path), len(exp_diff_cur_path), len(cur_exp_common_path)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark building and diffing suites')
+    parser.add_argument('--count', dest='count', help='number of cases', type=int, default=100000)
+    args = parser.parse_args()
+    bench_suite(args.count)
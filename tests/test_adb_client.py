@@ -0,0 +1,172 @@
+import os
+import pipes
+import socket
+import SocketServer
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conformance import AdbClient, AdbShellBatch, AdbShellCmd
+
+
+# Fake adb server, whose shell commands run by local sh with getprop and
+# dumpsys of a fake device.
+class FakeAdbRequestHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        self.server.connection_count += 1
+        serial = None
+        while True:
+            try:
+                payload = self._read(int(self._read(4), 16))
+            except (socket.error, ValueError):
+                return
+            self.server.payloads.append(payload)
+            if payload == 'host:devices':
+                data = ''.join('%s\tdevice\n' % serial for serial in self.server.serials)
+                self.request.sendall('OKAY%04x%s' % (len(data), data))
+                return
+            elif payload.startswith('host:transport:'):
+                serial = payload[len('host:transport:'):]
+                if serial not in self.server.serials:
+                    self._fail("device '%s' not found" % serial)
+                    return
+                self.request.sendall('OKAY')
+            elif payload.startswith('shell:') and serial:
+                self.request.sendall('OKAY')
+                process = self.server.run_shell(serial, payload[len('shell:'):])
+                try:
+                    # output is streamed as it comes, like adbd does
+                    for chunk in iter(lambda: os.read(process.stdout.fileno(), 4096), ''):
+                        self.request.sendall(chunk)
+                except socket.error:
+                    process.kill()
+                process.wait()
+                return
+            elif payload.startswith('reverse:forward:') and serial:
+                self.server.reverses.append((serial, payload[len('reverse:forward:'):]))
+                self.request.sendall('OKAYOKAY')
+                return
+            else:
+                self._fail('unknown service %s' % payload)
+                return
+
+    def _fail(self, msg):
+        self.request.sendall('FAIL%04x%s' % (len(msg), msg))
+
+    def _read(self, size):
+        data = ''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise socket.error('Connection closed')
+            data += chunk
+        return data
+
+
+class FakeAdbServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    PROPS = {
+        'ro.build.version.release': '9',
+        'ro.product.manufacturer': 'Fake',
+        'ro.product.model': 'Fake Phone',
+    }
+    GLES = 'GLES: Qualcomm, Adreno (TM) 540, OpenGL ES 3.2'
+
+    def __init__(self, device_count):
+        self.serials = ['fake-%d' % index for index in range(device_count)]
+        self.payloads = []
+        self.reverses = []
+        self.connection_count = 0
+        SocketServer.TCPServer.__init__(self, ('localhost', 0), FakeAdbRequestHandler)
+
+    def run_shell(self, serial, cmd):
+        props = dict(self.PROPS, **{'ro.serialno': serial})
+        getprop = ''.join('[%s]: [%s]\n' % (key, props[key]) for key in sorted(props))
+        script = 'getprop() { printf %%s %s; }; dumpsys() { echo %s; }; %s' % (pipes.quote(getprop), pipes.quote(self.GLES), cmd)
+        return subprocess.Popen(['sh', '-c', script], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+class AdbClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAdbServer(2)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = AdbClient('localhost', self.server.server_address[1])
+
+    def tearDown(self):
+        AdbClient.shared = None
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _wait_pool(self, serial, count):
+        for _ in range(100):
+            if len(self.client.pool.get(serial, [])) >= count:
+                return
+            time.sleep(0.02)
+        self.fail('Pool of %s is not refilled' % serial)
+
+    def test_devices(self):
+        self.assertEqual(self.client.get_devices(), [('fake-0', 'device'), ('fake-1', 'device')])
+
+    def test_shell(self):
+        (output, timed_out) = self.client.shell('fake-1', 'echo hello; getprop | grep serialno')
+        self.assertEqual(output, 'hello\n[ro.serialno]: [fake-1]\n')
+        self.assertFalse(timed_out)
+        self.assertEqual(self.server.payloads[:2], ['host:transport:fake-1', 'shell:echo hello; getprop | grep serialno'])
+
+    def test_shell_timeout(self):
+        (output, timed_out) = self.client.shell('fake-0', 'echo partial; sleep 5', timeout=0.5)
+        self.assertEqual(output, 'partial\n')
+        self.assertTrue(timed_out)
+
+    def test_fail(self):
+        self.assertRaises(socket.error, self.client.shell, 'missing', 'echo hello')
+        self.assertEqual(self.client.pool, {})
+
+    def test_refill(self):
+        self.client.shell('fake-0', 'true')
+        self._wait_pool('fake-0', 1)
+        connection_count = self.server.connection_count
+        self.client._refill = lambda serial: None
+        (output, _) = self.client.shell('fake-0', 'echo pooled')
+        self.assertEqual(output, 'pooled\n')
+        # the pooled connection is already switched to the transport
+        self.assertEqual(self.server.payloads.count('host:transport:fake-0'), 2)
+        self.assertEqual(self.server.connection_count, connection_count)
+
+    def test_stale_pool(self):
+        self.client.shell('fake-0', 'true')
+        self._wait_pool('fake-0', 1)
+        for s in self.client.pool['fake-0']:
+            s.close()
+        (output, _) = self.client.shell('fake-0', 'echo retried')
+        self.assertEqual(output, 'retried\n')
+
+    def test_reverse(self):
+        self.client.reverse('fake-0', 8000, 8001)
+        self.assertEqual(self.server.reverses, [('fake-0', 'tcp:8000;tcp:8001')])
+        self.assertRaises(socket.error, self.client.reverse, 'missing', 8000, 8000)
+
+    def test_shell_cmd(self):
+        AdbClient.shared = self.client
+        self.assertTrue(AdbShellCmd('true', 'fake-0').status)
+        self.assertFalse(AdbShellCmd('false', 'fake-0').status)
+        self.assertFalse(AdbShellCmd('true', 'missing').status)
+
+    def test_batch(self):
+        AdbClient.shared = self.client
+        batch = AdbShellBatch('fake-0')
+        batch.add('echo one; echo two')
+        batch.add('printf partial; exit 3')
+        batch.add('dumpsys SurfaceFlinger | grep GLES')
+        self.assertEqual(batch.run(), [(0, 'one\ntwo\n'), (3, 'partial'), (0, FakeAdbServer.GLES + '\n')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import os
+import shutil
+import stat
+import sys
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conformance import BuildCache, HostOS
+
+
+class BuildCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            for f in cache.use_files.values():
+                f.close()
+        # objects are read only
+        for (dir_path, dir_names, file_names) in os.walk(self.tmp_dir):
+            for name in file_names:
+                if not os.path.islink(os.path.join(dir_path, name)):
+                    os.chmod(os.path.join(dir_path, name), 0o644)
+        shutil.rmtree(self.tmp_dir)
+
+    def _new_cache(self, budget=1024 * 1024):
+        cache = BuildCache(os.path.join(self.tmp_dir, 'build'), budget)
+        self.caches.append(cache)
+        return cache
+
+    # files is a list of (name, content, mode), where a link has content of its target
+    def _zip(self, name, files):
+        archive_path = os.path.join(self.tmp_dir, name)
+        archive = zipfile.ZipFile(archive_path, 'w')
+        for (file_name, content, mode) in files:
+            info = zipfile.ZipInfo(file_name)
+            info.external_attr = mode << 16
+            archive.writestr(info, content)
+        archive.close()
+        return archive_path
+
+    def _read(self, file_path):
+        f = open(file_path)
+        data = f.read()
+        f.close()
+        return data
+
+    def _get_object_count(self, cache):
+        return sum(len(file_names) for (_, _, file_names) in os.walk(cache.object_dir))
+
+    def test_zip(self):
+        cache = self._new_cache()
+        cache.add('100', self._zip('100.zip', [
+            ('chrome-linux/', '', 0o40755),
+            ('chrome-linux/chrome', 'binary', 0o100755),
+            ('chrome-linux/resources.pak', 'data', 0o100644),
+            ('chrome-linux/chrome-wrapper', 'chrome', 0o120777),
+        ]))
+        browser_path = cache.resolve('build:100', HostOS('linux', '16.04'))
+        self.assertEqual(browser_path, '%s/100/chrome-linux/chrome' % cache.build_dir)
+        self.assertEqual(self._read(browser_path), 'binary')
+        self.assertTrue(os.stat(browser_path).st_mode & stat.S_IXUSR)
+        self.assertFalse(os.stat('%s/100/chrome-linux/resources.pak' % cache.build_dir).st_mode & stat.S_IXUSR)
+        self.assertEqual(os.readlink('%s/100/chrome-linux/chrome-wrapper' % cache.build_dir), 'chrome')
+        self.assertEqual(cache.resolve('build:100/chrome-linux/resources.pak', HostOS('linux', '16.04')), '%s/100/chrome-linux/resources.pak' % cache.build_dir)
+        self.assertEqual([(revision, size) for (revision, _, size) in cache.get_builds()], [('100', 10)])
+
+    def test_tar_and_dir(self):
+        cache = self._new_cache()
+        src_dir = os.path.join(self.tmp_dir, '200')
+        os.makedirs(os.path.join(src_dir, 'chrome-linux'))
+        f = open(os.path.join(src_dir, 'chrome-linux', 'chrome'), 'w')
+        f.write('binary')
+        f.close()
+        os.symlink('chrome', os.path.join(src_dir, 'chrome-linux', 'chrome-wrapper'))
+        archive_path = os.path.join(self.tmp_dir, '200.tar.gz')
+        archive = tarfile.open(archive_path, 'w:gz')
+        archive.add(src_dir, arcname='.')
+        archive.close()
+
+        cache.add('200', archive_path)
+        cache.add('201', src_dir)
+        for revision in ['200', '201']:
+            build_dir = cache.get_build_dir(revision)
+            self.assertEqual(self._read(build_dir + '/chrome-linux/chrome'), 'binary')
+            self.assertEqual(os.readlink(build_dir + '/chrome-linux/chrome-wrapper'), 'chrome')
+        # the same file of both builds is stored once
+        self.assertEqual(self._get_object_count(cache), 1)
+
+    def test_out_of_root(self):
+        cache = self._new_cache()
+        for files in [
+            [('../evil', 'x', 0o100644)],
+            [('a/../../evil', 'x', 0o100644)],
+            [('/tmp/evil', 'x', 0o100644)],
+            [('C:/evil', 'x', 0o100644)],
+            [('a/link', '../../evil', 0o120777)],
+            [('a/link', '/etc/passwd', 0o120777)],
+        ]:
+            self.assertRaises(SystemExit, cache.add, '300', self._zip('300.zip', files))
+        self.assertEqual(cache.get_builds(), [])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'evil')))
+
+        # paths within the root are normalized
+        cache.add('301', self._zip('301.zip', [('./a/../b/c', 'x', 0o100644), ('b/link', '../b/c', 0o120777)]))
+        build_dir = cache.get_build_dir('301')
+        self.assertEqual(self._read(build_dir + '/b/c'), 'x')
+        self.assertEqual(self._read(build_dir + '/b/link'), 'x')
+
+    def test_evict(self):
+        cache = self._new_cache(budget=20)
+        cache.add('1', self._zip('1.zip', [('shared', 'x' * 10, 0o100644)]))
+        cache.add('2', self._zip('2.zip', [('shared', 'x' * 10, 0o100644), ('own', 'a' * 10, 0o100644)]))
+        self.assertEqual(sorted(revision for (revision, _, _) in cache.get_builds()), ['1', '2'])
+        self.assertEqual(self._get_object_count(cache), 2)
+
+        # evicting 1 frees nothing, as its only object is shared with 2, so 2
+        # is evicted as well
+        cache.add('3', self._zip('3.zip', [('shared', 'x' * 10, 0o100644), ('own', 'b' * 5, 0o100644)]))
+        self.assertEqual([revision for (revision, _, _) in cache.get_builds()], ['3'])
+        self.assertEqual(self._get_object_count(cache), 2)
+        self.assertEqual(self._read(cache.get_build_dir('3') + '/shared'), 'x' * 10)
+
+    def test_in_use(self):
+        cache = self._new_cache(budget=15)
+        cache.add('1', self._zip('1.zip', [('a', 'a' * 10, 0o100644)]))
+        build_dir = cache.get_build_dir('1')
+
+        # another run doesn't evict or replace the build used by this one
+        other_cache = self._new_cache(budget=15)
+        other_cache.add('2', self._zip('2.zip', [('b', 'b' * 10, 0o100644)]))
+        self.assertEqual(sorted(revision for (revision, _, _) in other_cache.get_builds()), ['1', '2'])
+        self.assertEqual(self._read(build_dir + '/a'), 'a' * 10)
+        self.assertRaises(SystemExit, other_cache.add, '1', self._zip('1.zip', [('a', 'c' * 10, 0o100644)]))
+
+        for f in cache.use_files.values():
+            f.close()
+        cache.use_files = {}
+        other_cache.add('3', self._zip('3.zip', [('c', 'c' * 10, 0o100644)]))
+        self.assertEqual([revision for (revision, _, _) in other_cache.get_builds()], ['3'])
+        self.assertFalse(os.path.exists(build_dir))
+
+    def test_missing(self):
+        cache = self._new_cache()
+        self.assertRaises(SystemExit, cache.get_build_dir, '404')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conformance import Cmd, CmdProcess
+
+
+class CmdProcessTest(unittest.TestCase):
+    def test_output(self):
+        process = CmdProcess('echo out; echo err >&2; exit 3')
+        self.assertEqual(process.wait(), 3)
+        self.assertEqual(sorted(process.output.splitlines()), ['err', 'out'])
+        self.assertFalse(process.timed_out)
+
+    def test_full_pipes(self):
+        # both pipes are filled far beyond their buffers
+        process = CmdProcess('seq 1 100000; seq 1 100000 >&2', timeout=60, max_lines=10)
+        self.assertEqual(process.wait(), 0)
+        self.assertEqual(len(process.output.splitlines()), 10)
+        self.assertFalse(process.timed_out)
+
+    def test_callback(self):
+        lines = []
+        CmdProcess('seq 1 5', callback=lines.append).wait()
+        self.assertEqual(lines, ['1\n', '2\n', '3\n', '4\n', '5\n'])
+
+    def test_stream(self):
+        process = CmdProcess('echo 1; sleep 0.1; echo 2', stream=True)
+        self.assertEqual(list(process), ['1\n', '2\n'])
+        self.assertEqual(process.process.returncode, 0)
+        self.assertRaises(ValueError, iter(CmdProcess('true')).next)
+
+    def test_timeout(self):
+        start_time = time.time()
+        # the child holding the pipes is killed with its process group
+        process = CmdProcess('echo begin; sleep 30 & sleep 30', timeout=0.5)
+        self.assertNotEqual(process.wait(), 0)
+        self.assertTrue(process.timed_out)
+        self.assertEqual(process.output, 'begin\n')
+        self.assertTrue(time.time() - start_time < CmdProcess.KILL_WAIT)
+
+    def test_stream_timeout(self):
+        process = CmdProcess('echo begin; sleep 30', timeout=0.5, stream=True)
+        self.assertEqual(list(process), ['begin\n'])
+        self.assertTrue(process.timed_out)
+
+
+class CmdTest(unittest.TestCase):
+    def test_cmd(self):
+        cmd = Cmd('echo hello')
+        self.assertEqual((cmd.status, cmd.output, cmd.timed_out), (0, 'hello\n', False))
+        cmd = Cmd('sleep 30', timeout=0.5)
+        self.assertTrue(cmd.status != 0 and cmd.timed_out)
+
+    def test_dryrun(self):
+        cmd = Cmd('exit 1', dryrun=True)
+        self.assertEqual((cmd.status, cmd.output, cmd.process), (0, '', None))
+
+    def test_abort(self):
+        self.assertRaises(SystemExit, Cmd, 'exit 1', abort=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
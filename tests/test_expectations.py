@@ -0,0 +1,126 @@
+import marshal
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conformance import Expectations, Status
+
+
+# gpu, os or browser with only the attributes expectations look at
+class Env(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+GPU = Env(vendor_name='intel', product_id='5912', product_name='HD Graphics 630', driver_version='24.20.100.6286')
+OS = Env(name='win', version='10.0.17134')
+BROWSER = Env(name='chrome', version='70.0.3538.0')
+
+LINES = '''# expectations of test
+2.0.1 conformance/textures/a.html FAIL 10 8
+2.0.1 conformance/textures/a.html CRASH os_name=win gpu_vendor=intel
+2.0.1 conformance/textures/b.html PYTIMEOUT gpu_product_name="HD Graphics 630"
+2.0.1 conformance/textures/c.html FAIL os_name=linux
+2.0.1 conformance/more/d.html FAIL 3 1
+1.0.3 conformance/textures/e.html FAIL
+'''
+
+
+class ExpectationsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.tmp_dir, 'expectations.txt')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self._write(LINES)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, lines):
+        f = open(self.file_path, 'w')
+        f.write(lines)
+        f.close()
+
+    def _resolve(self, expectations, suite='all'):
+        return [(exp.path, exp.status, exp.total_count, exp.pass_count) for exp in expectations.resolve('2.0.1', GPU, OS, BROWSER, suite)]
+
+    def _get_cache_file(self):
+        names = os.listdir(self.cache_dir)
+        self.assertEqual(len(names), 1)
+        return os.path.join(self.cache_dir, names[0])
+
+    def test_parse(self):
+        expectations = Expectations()
+        self.assertEqual(expectations._parse('f', 1, '2.0.1 a/b.html FAIL 10 8 os_name=win gpu_product_name="HD Graphics 630"'),
+                         ('2.0.1', 'a/b.html', Status.FAIL, 10, 8, {'os_name': 'win', 'gpu_product_name': 'HD Graphics 630'}))
+        self.assertEqual(expectations._parse('f', 1, '2.0.1 a/b.html PASS'), ('2.0.1', 'a/b.html', Status.PASS, 0, 0, {}))
+
+    def test_parse_error(self):
+        expectations = Expectations()
+        for line in ['2.0.1 a/b.html', '2.0.1 a/b.html __init__', '2.0.1 a/b.html fail', '2.0.1 a/b.html FAIL cpu=x', '2.0.1 a/b.html FAIL 10 8 junk']:
+            self.assertRaises(SystemExit, expectations._parse, 'f', 1, line)
+
+    def test_resolve(self):
+        expectations = Expectations(self.file_path)
+        self.assertEqual(self._resolve(expectations), [
+            ('conformance/textures/a.html', Status.CRASH, 0, 0),
+            ('conformance/textures/b.html', Status.PYTIMEOUT, 0, 0),
+            ('conformance/more/d.html', Status.FAIL, 3, 1),
+        ])
+        self.assertEqual(self._resolve(expectations, 'all/conformance/more'), [('conformance/more/d.html', Status.FAIL, 3, 1)])
+        self.assertEqual(self._resolve(expectations, 'conformance/textures/b.html'), [('conformance/textures/b.html', Status.PYTIMEOUT, 0, 0)])
+        self.assertEqual(expectations.resolve('2.0.1', GPU, Env(name='linux', version=''), BROWSER, 'conformance/textures')[0].status, Status.FAIL)
+
+    def test_cache(self):
+        expected = self._resolve(Expectations(self.file_path, self.cache_dir))
+        self._get_cache_file()
+
+        # the cache is used without parsing the file
+        parse = Expectations._parse
+        Expectations._parse = None
+        try:
+            self.assertEqual(self._resolve(Expectations(self.file_path, self.cache_dir)), expected)
+        finally:
+            Expectations._parse = parse
+
+    def test_cache_touched(self):
+        Expectations(self.file_path, self.cache_dir)
+        cache_file = self._get_cache_file()
+        mtime = os.stat(self.file_path).st_mtime + 10
+        os.utime(self.file_path, (mtime, mtime))
+
+        # the content is unchanged, so the cache is kept with the new mtime
+        parse = Expectations._parse
+        Expectations._parse = None
+        try:
+            Expectations(self.file_path, self.cache_dir)
+        finally:
+            Expectations._parse = parse
+        f = open(cache_file, 'rb')
+        self.assertEqual(marshal.load(f)['mtime'], os.stat(self.file_path).st_mtime)
+        f.close()
+
+    def test_cache_changed(self):
+        Expectations(self.file_path, self.cache_dir)
+        self._write(LINES.replace('FAIL 3 1', 'FAIL 3 2'))
+        mtime = os.stat(self.file_path).st_mtime + 10
+        os.utime(self.file_path, (mtime, mtime))
+        self.assertIn(('conformance/more/d.html', Status.FAIL, 3, 2), self._resolve(Expectations(self.file_path, self.cache_dir)))
+
+    def test_cache_corrupt(self):
+        Expectations(self.file_path, self.cache_dir)
+        cache_file = self._get_cache_file()
+        f = open(cache_file, 'wb')
+        f.write('corrupt')
+        f.close()
+        self.assertEqual(len(self._resolve(Expectations(self.file_path, self.cache_dir))), 3)
+        f = open(cache_file, 'rb')
+        self.assertEqual(marshal.load(f)['format'], Expectations.CACHE_FORMAT)
+        f.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
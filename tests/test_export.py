@@ -0,0 +1,84 @@
+import csv
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conformance import Case, Exporter, Status
+
+
+class Change(object):
+    def __init__(self, cur_case, exp_case):
+        self.cur_case = cur_case
+        self.exp_case = exp_case
+
+
+class ExporterTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_prefix = os.path.join(self.tmp_dir, 'result')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _export(self, format):
+        exporter = Exporter.get_exporter(format, self.file_prefix)
+        exporter.add('firstrun', Case('conformance/textures/a.html', Status.FAIL, 10, 8, 1500))
+        exporter.add('firstrun', Case('conformance/textures/b.html', Status.PASS, 2, 2, 20))
+        exporter.add('retry', Case('conformance/textures/a.html', Status.PASS, 10, 10, 1400))
+        exporter.add_changes([('improve', None, [Change(Case('conformance/textures/a.html', Status.PASS, 10, 10, 1400), Case('conformance/textures/a.html', Status.FAIL, 10, 8))])])
+        exporter.close()
+        return exporter.file_path
+
+    def test_jsonl(self):
+        f = open(self._export('jsonl'))
+        records = [json.loads(line) for line in f]
+        f.close()
+        self.assertEqual([(record['record'], record['path'], record['status']) for record in records], [
+            ('firstrun', 'conformance/textures/a.html', Status.FAIL),
+            ('firstrun', 'conformance/textures/b.html', Status.PASS),
+            ('retry', 'conformance/textures/a.html', Status.PASS),
+            ('change', 'conformance/textures/a.html', Status.PASS),
+        ])
+        self.assertEqual((records[3]['exp_status'], records[3]['exp_pass_count'], records[3]['change']), (Status.FAIL, 8, 'improve'))
+        self.assertEqual(records[0]['exp_status'], '')
+
+    def test_csv(self):
+        f = open(self._export('csv'), 'rb')
+        rows = list(csv.reader(f))
+        f.close()
+        self.assertEqual(rows[0], Exporter.FIELDS)
+        self.assertEqual(rows[1], ['firstrun', 'conformance/textures/a.html', Status.FAIL, '10', '8', '1500', '', '', '', ''])
+        self.assertEqual(rows[4][-4:], [Status.FAIL, '10', '8', 'improve'])
+
+    def test_junit(self):
+        exporter = Exporter.get_exporter('junit', self.file_prefix)
+        # the document is well-formed after each case
+        for count in range(1, 3):
+            exporter.add('firstrun', Case('conformance/textures/%s.html' % count, Status.PASS, 1, 1, 10))
+            f = open(exporter.file_path)
+            self.assertEqual(len(ET.parse(f).getroot().findall('testsuite/testcase')), count)
+            f.close()
+        exporter.close()
+
+        f = open(self._export('junit'))
+        cases = ET.parse(f).getroot().findall('testsuite/testcase')
+        f.close()
+        self.assertEqual([(case.get('classname'), case.get('name'), case.get('time')) for case in cases], [
+            ('conformance.textures', 'a.html', '1.500'),
+            ('conformance.textures', 'b.html', '0.020'),
+            ('conformance.textures', 'a.html (retry)', '1.400'),
+        ])
+        self.assertEqual(cases[0].find('failure').get('message'), '8 of 10 passed')
+        self.assertEqual(list(cases[1]), [])
+
+    def test_unknown_format(self):
+        self.assertRaises(SystemExit, Exporter.get_exporter, 'yaml', self.file_prefix)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conformance import Case, CaseManifest, Conformance, DeviceFanout, FlakeStats, History, Status, Suite
+
+
+class Device(object):
+    def __init__(self, id):
+        self.id = id
+
+    def get_prop(self, name):
+        return ''
+
+
+# gpu, os or browser with only the attributes history looks at
+class Env(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+GPU = Env(vendor_name='qualcomm', product_name='Adreno 540', driver_version='OpenGL ES 3.2 V@258.0')
+OTHER_GPU = Env(vendor_name='arm', product_name='Mali-G72', driver_version='OpenGL ES 3.2 v1.r12p1')
+OS = Env(name='android', version='8.0.0')
+BROWSER = Env(name='chrome_stable', version='70.0.3538.64')
+
+
+class DeviceFanoutTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.conformance = Conformance.__new__(Conformance)
+        self.conformance.log_dir = os.path.join(self.tmp_dir, 'log')
+        os.makedirs(self.conformance.log_dir)
+        self.conformance.result_dir = os.path.join(self.tmp_dir, 'result')
+        self.conformance.timestamp = '20181018120000'
+        self.conformance.history_file = os.path.join(self.tmp_dir, 'log', 'history.db')
+        self.conformance.case_manifest = CaseManifest(os.path.join(self.tmp_dir, 'log', 'manifest.json'))
+        self.devices = [Device('0123456789abcdef'), Device('192.168.1.2:5555')]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _new_fanout(self, mode):
+        return DeviceFanout(self.conformance, self.devices, mode)
+
+    # records are (record, path, status)
+    def _write_results(self, fanout, device, records):
+        result_dir = fanout._get_result_dir(device)
+        os.makedirs(result_dir)
+        f = open(os.path.join(result_dir, '%s.jsonl' % self.conformance.timestamp), 'w')
+        for (record, path, status) in records:
+            f.write(json.dumps({'record': record, 'path': path, 'status': status, 'total_count': 2, 'pass_count': 1 if status == Status.FAIL else 2, 'time': 100}) + '\n')
+        f.close()
+
+    def _add_child_run(self, fanout, device, gpu, paths):
+        os.makedirs(fanout._get_result_dir(device))
+        suite = Suite()
+        for path in paths:
+            suite.add_case(Case(path, Status.PASS, 2, 2, 100))
+        history = History(fanout._get_history_file(device))
+        history.add_run('20181018120001', '2.0.1', gpu, OS, BROWSER, suite)
+        history.close()
+
+    def test_strip_argv(self):
+        fanout = self._new_fanout('shard')
+        self.assertEqual(fanout._strip_argv([
+            '--android-devices', 'all', '--android-fanout=shard', '--suite', 'all', '--log-dir', 'log', '--result-dir=result',
+            '--jobs=2', '--flake-file', 'flake.json', '--history-file=history.db', '--mirror', '--mirror-port', '8000',
+        ]), ['--suite', 'all', '--jobs=2', '--mirror'])
+
+    def test_read_results(self):
+        fanout = self._new_fanout('shard')
+        self.assertEqual(fanout._read_results(self.devices[0]), {})
+
+        # the retry wins over the firstrun, and other records are ignored
+        self._write_results(fanout, self.devices[0], [
+            ('firstrun', 'conformance/a.html', Status.FAIL),
+            ('firstrun', 'conformance/b.html', Status.PASS),
+            ('retry', 'conformance/a.html', Status.PASS),
+            ('change', 'conformance/a.html', Status.PASS),
+        ])
+        f = open(os.path.join(fanout._get_result_dir(self.devices[0]), 'output.txt'), 'w')
+        f.write('not a result')
+        f.close()
+        results = fanout._read_results(self.devices[0])
+        self.assertEqual(sorted((path, record, case.status) for (path, (record, case)) in results.items()), [
+            ('conformance/a.html', 'retry', Status.PASS),
+            ('conformance/b.html', 'firstrun', Status.PASS),
+        ])
+
+    def test_matrix_rows(self):
+        fanout = self._new_fanout('matrix')
+        device_ids = [device.id for device in self.devices]
+        fanout.results = {
+            device_ids[0]: {
+                'conformance/a.html': ('firstrun', Case('conformance/a.html', Status.PASS)),
+                'conformance/b.html': ('retry', Case('conformance/b.html', Status.FAIL)),
+            },
+            device_ids[1]: {
+                'conformance/a.html': ('firstrun', Case('conformance/a.html', Status.PASS)),
+                'conformance/b.html': ('firstrun', Case('conformance/b.html', Status.PASS)),
+                'conformance/c.html': ('firstrun', Case('conformance/c.html', Status.PASS)),
+            },
+        }
+        paths = ['conformance/a.html', 'conformance/b.html', 'conformance/c.html']
+        self.assertEqual(list(fanout._get_matrix_rows(paths, device_ids)), [
+            (['conformance/b.html', Status.FAIL, Status.PASS], None, 0),
+            (['conformance/c.html', '', Status.PASS], None, 0),
+        ])
+
+    def test_history_shard(self):
+        fanout = self._new_fanout('shard')
+        self._add_child_run(fanout, self.devices[0], GPU, ['conformance/a.html', 'conformance/b.html'])
+        self._add_child_run(fanout, self.devices[1], GPU, ['conformance/c.html'])
+        fanout._add_history()
+
+        # shards are one run with the timestamp of fanout
+        history = History(self.conformance.history_file)
+        (env, cases) = history.get_latest_run()
+        self.assertEqual([case.path for case in cases], ['conformance/a.html', 'conformance/b.html', 'conformance/c.html'])
+        self.assertEqual(history.get_trend('conformance/c.html'), [('20181018120000', Status.PASS, 2, 2, 100)])
+        self.assertEqual(env[0], '2.0.1')
+        history.close()
+
+    def test_history_matrix(self):
+        self.devices.append(Device('fedcba9876543210'))
+        fanout = self._new_fanout('matrix')
+        self._add_child_run(fanout, self.devices[0], GPU, ['conformance/a.html'])
+        self._add_child_run(fanout, self.devices[1], OTHER_GPU, ['conformance/a.html'])
+        self._add_child_run(fanout, self.devices[2], GPU, ['conformance/a.html'])
+        fanout._add_history()
+
+        history = History(self.conformance.history_file)
+        self.assertEqual(len(history.get_trend('conformance/a.html')), 2)
+        self.assertEqual(len(history.get_trend('conformance/a.html', {'gpu_vendor': 'arm'})), 1)
+        history.close()
+
+    def test_history_dryrun(self):
+        self._new_fanout('shard')._add_history()
+        self.assertFalse(os.path.exists(self.conformance.history_file))
+
+    def test_merge_manifests(self):
+        fanout = self._new_fanout('shard')
+        self.conformance.case_manifest.set('2.0.1|a', 'old', ['conformance/a.html'])
+        for (device, paths) in zip(self.devices, [['conformance/a.html', 'conformance/b.html'], ['conformance/c.html']]):
+            os.makedirs(fanout._get_log_dir(device))
+            case_manifest = CaseManifest(fanout._get_manifest_file(device))
+            case_manifest.set('2.0.1|%s' % device.id, 'new', paths)
+            case_manifest.set('2.0.1|a', 'new', paths)
+            case_manifest.save()
+        fanout._merge_manifests()
+
+        case_manifest = CaseManifest(self.conformance.case_manifest.file_path)
+        self.assertEqual(case_manifest.get('2.0.1|%s' % self.devices[0].id), ['conformance/a.html', 'conformance/b.html'])
+        self.assertEqual(case_manifest.get('2.0.1|%s' % self.devices[1].id), ['conformance/c.html'])
+        self.assertEqual(case_manifest.get('2.0.1|a', 'new'), ['conformance/c.html'])
+
+
+class FlakeStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.tmp_dir, 'flake.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_shared_file(self):
+        flake_stats = FlakeStats(self.file_path)
+        flake_stats.add('conformance/a.html', True)
+        flake_stats.save()
+
+        # children of fanout read the same samples, and add theirs on save
+        children = [FlakeStats(self.file_path), FlakeStats(self.file_path)]
+        self.assertEqual(children[1].samples, {'conformance/a.html': [1]})
+        children[0].add('conformance/a.html', False)
+        children[0].add('conformance/b.html', True)
+        children[1].add('conformance/a.html', True)
+        for child in children:
+            child.save()
+        self.assertEqual(FlakeStats(self.file_path).samples, {'conformance/a.html': [1, 0, 1], 'conformance/b.html': [1]})
+        self.assertEqual(children[1].samples, {'conformance/a.html': [1, 0, 1], 'conformance/b.html': [1]})
+
+    def test_sample_count(self):
+        flake_stats = FlakeStats(self.file_path)
+        for index in range(FlakeStats.SAMPLE_COUNT):
+            flake_stats.add('conformance/a.html', True)
+        flake_stats.save()
+        flake_stats.add('conformance/a.html', False)
+        flake_stats.save()
+        samples = FlakeStats(self.file_path).samples['conformance/a.html']
+        self.assertEqual((len(samples), samples[-1]), (FlakeStats.SAMPLE_COUNT, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conformance import Case, History, Status, Suite
+
+
+# gpu, os or browser with only the attributes history looks at
+class Env(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+GPU = Env(vendor_name='intel', product_name='HD Graphics 630', driver_version='24.20.100.6286')
+OS = Env(name='linux', version='16.04')
+WIN_OS = Env(name='win', version='10.0.17134')
+BROWSER = Env(name='chrome', version='70.0.3538.0')
+
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.tmp_dir, 'history.db')
+        self.history = History(self.file_path)
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.tmp_dir)
+
+    # cases are (path, status, time)
+    def _add_run(self, timestamp, cases, os=OS):
+        suite = Suite()
+        for (path, status, time) in cases:
+            if status == Status.PASS:
+                suite.add_case(Case(path, status, 2, 2, time))
+            else:
+                suite.add_case(Case(path, status, 2, 1, time))
+        self.history.add_run(timestamp, '2.0.1', GPU, os, BROWSER, suite)
+
+    def test_trend(self):
+        self._add_run('20180102000000', [('a.html', Status.FAIL, 20), ('b.html', Status.PASS, 10)])
+        self._add_run('20180101000000', [('a.html', Status.PASS, 10)])
+        self._add_run('20180103000000', [('a.html', Status.PASS, 30)], os=WIN_OS)
+        self.assertEqual(self.history.get_trend('a.html'), [
+            ('20180101000000', Status.PASS, 2, 2, 10),
+            ('20180102000000', Status.FAIL, 2, 1, 20),
+            ('20180103000000', Status.PASS, 2, 2, 30),
+        ])
+        self.assertEqual([trend[0] for trend in self.history.get_trend('a.html', {'os_name': 'linux'})], ['20180101000000', '20180102000000'])
+        self.assertEqual(self.history.get_trend('c.html'), [])
+        self.assertRaises(SystemExit, self.history.get_trend, 'a.html', {'cpu': 'x'})
+
+    def test_replace_run(self):
+        self._add_run('20180101000000', [('a.html', Status.FAIL, 20)])
+        self._add_run('20180101000000', [('a.html', Status.PASS, 10)])
+        self.assertEqual(self.history.get_trend('a.html'), [('20180101000000', Status.PASS, 2, 2, 10)])
+
+    def test_first_fail(self):
+        self._add_run('20180101000000', [('a.html', Status.FAIL, 0)])
+        self._add_run('20180102000000', [('a.html', Status.PASS, 0)])
+        self._add_run('20180103000000', [('a.html', Status.FILTER, 0)])
+        self._add_run('20180104000000', [('a.html', Status.CRASH, 0)])
+        self._add_run('20180105000000', [('a.html', Status.FAIL, 0)])
+        self.assertEqual(self.history.get_first_fail('a.html'), '20180104000000')
+        self._add_run('20180106000000', [('a.html', Status.PASS, 0)])
+        self.assertEqual(self.history.get_first_fail('a.html'), None)
+
+    def test_drift(self):
+        self._add_run('20180101000000', [('a.html', Status.PASS, 10), ('b.html', Status.PASS, 10), ('c.html', Status.PASS, 10)])
+        self._add_run('20180102000000', [('a.html', Status.PASS, 20), ('b.html', Status.PASS, 10), ('c.html', Status.PASS, 10)])
+        self._add_run('20180103000000', [('a.html', Status.PASS, 30), ('b.html', Status.PASS, 50), ('c.html', Status.PASS, 5)])
+        self._add_run('20180104000000', [('a.html', Status.PASS, 50), ('b.html', Status.PASS, 50), ('c.html', Status.PASS, 5)])
+        self.assertEqual(self.history.get_drift(2, 5), [('b.html', 10, 50), ('a.html', 15, 40)])
+        self.assertEqual(self.history.get_drift(2, 1), [('b.html', 10, 50)])
+
+    def test_reopen(self):
+        self._add_run('20180101000000', [('a.html', Status.PASS, 10)])
+        self.history.close()
+        self.history = History(self.file_path)
+        self._add_run('20180102000000', [('a.html', Status.FAIL, 10)])
+        self.assertEqual(len(self.history.get_trend('a.html')), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conformance import Case, Journal, Status
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.tmp_dir, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _new_journal(self, checkpoint_count=Journal.CHECKPOINT_COUNT):
+        journal = Journal(self.file_path)
+        journal.CHECKPOINT_COUNT = checkpoint_count
+        journal.load()
+        journal.open()
+        return journal
+
+    def _add_cases(self, journal, phase, start, count):
+        for index in range(start, start + count):
+            journal.add(phase, Case('conformance/%s.html' % index, Status.PASS, 1, 1, index))
+
+    def test_resume(self):
+        journal = self._new_journal()
+        journal.set_phase('firstrun')
+        self._add_cases(journal, 'firstrun', 0, 3)
+        journal.add('firstrun', Case('conformance/1.html', Status.FAIL, 2, 1, 10))
+        journal.set_phase('retry')
+        journal.add('retry', Case('conformance/1.html', Status.PASS, 2, 2, 12))
+        journal.close()
+
+        state = Journal(self.file_path).load()
+        self.assertEqual(state['phase'], 'retry')
+        self.assertEqual(sorted(state['firstrun']), ['conformance/0.html', 'conformance/1.html', 'conformance/2.html'])
+        self.assertEqual(state['firstrun']['conformance/1.html'], ['conformance/1.html', Status.FAIL, 2, 1, 10])
+        self.assertEqual(state['retry']['conformance/1.html'], ['conformance/1.html', Status.PASS, 2, 2, 12])
+
+    def test_partial_record(self):
+        journal = self._new_journal()
+        journal.set_phase('firstrun')
+        self._add_cases(journal, 'firstrun', 0, 2)
+        journal.close()
+        f = open(self.file_path, 'ab')
+        f.write('{"type": "firstrun", "case": ["conformance/2.ht')
+        f.close()
+
+        journal = Journal(self.file_path)
+        state = journal.load()
+        self.assertEqual(sorted(state['firstrun']), ['conformance/0.html', 'conformance/1.html'])
+        # the partial record is dropped before appending
+        journal.open()
+        self._add_cases(journal, 'firstrun', 2, 1)
+        journal.close()
+        f = open(self.file_path)
+        records = [json.loads(line) for line in f]
+        f.close()
+        self.assertEqual(len(records), 4)
+        self.assertEqual(sorted(Journal(self.file_path).load()['firstrun']), ['conformance/0.html', 'conformance/1.html', 'conformance/2.html'])
+
+    def test_snapshot(self):
+        journal = self._new_journal(checkpoint_count=10)
+        journal.set_phase('firstrun')
+        self._add_cases(journal, 'firstrun', 0, 25)
+        journal.close()
+        self.assertTrue(os.path.exists(journal.snapshot_path))
+
+        f = open(journal.snapshot_path)
+        snapshot = json.load(f)
+        f.close()
+        self.assertTrue(0 < snapshot['offset'] < os.path.getsize(self.file_path))
+        self.assertEqual(len(snapshot['state']['firstrun']), 20)
+
+        journal = Journal(self.file_path)
+        state = journal.load()
+        self.assertEqual(len(state['firstrun']), 25)
+        self.assertEqual(journal.offset, os.path.getsize(self.file_path))
+
+    def test_snapshot_beyond_journal(self):
+        journal = self._new_journal(checkpoint_count=10)
+        journal.set_phase('firstrun')
+        self._add_cases(journal, 'firstrun', 0, 15)
+        journal.close()
+        # a journal shorter than the offset of snapshot is not the one of it
+        f = open(self.file_path, 'wb')
+        f.close()
+
+        journal = Journal(self.file_path)
+        state = journal.load()
+        self.assertEqual(state['firstrun'], {})
+        self.assertEqual(journal.offset, 0)
+        journal.open()
+        self.assertFalse(os.path.exists(journal.snapshot_path))
+        journal.close()
+
+    def test_done(self):
+        journal = self._new_journal()
+        journal.set_phase('firstrun')
+        self._add_cases(journal, 'firstrun', 0, 2)
+        journal.set_phase('done')
+        journal.close()
+
+        journal = Journal(self.file_path)
+        state = journal.load()
+        self.assertEqual(state, {'phase': '', 'firstrun': {}, 'retry': {}})
+        self.assertEqual(journal.offset, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
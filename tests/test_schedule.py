@@ -0,0 +1,71 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conformance import CaseTime, Conformance
+
+
+class ScheduleTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.case_time = CaseTime(os.path.join(self.tmp_dir, 'time.json'))
+        self.conformance = Conformance.__new__(Conformance)
+        self.conformance.case_time = self.case_time
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _schedule(self, times, count):
+        self.conformance.case_paths = ['conformance/%s.html' % index for index in range(len(times))]
+        for (path, time) in zip(self.conformance.case_paths, times):
+            if time is not None:
+                self.case_time.add(path, time)
+        return self.conformance._schedule(range(len(times)), count)
+
+    def _get_loads(self, shards, times):
+        return [sum(times[index] for index in shard) for shard in shards]
+
+    def test_balance(self):
+        times = [70, 10, 10, 10, 10, 10, 10, 30, 30, 40]
+        shards = self._schedule(times, 3)
+        self.assertEqual(sorted(sum(shards, [])), range(len(times)))
+        self.assertEqual(sorted(self._get_loads(shards, times)), [70, 80, 80])
+        for shard in shards:
+            self.assertEqual(shard, sorted(shard))
+
+    def test_long_case(self):
+        shards = self._schedule([1000, 10, 10, 10, 10], 2)
+        self.assertEqual(shards, [[0], [1, 2, 3, 4]])
+
+    def test_unknown_time(self):
+        # unknown cases take the average time of known ones
+        self.assertEqual(self.case_time.get_all(['a', 'b', 'c']), [0, 0, 0])
+        shards = self._schedule([40, None, 20, None], 2)
+        self.assertEqual(self._get_loads(shards, [40, 30, 20, 30]), [60, 60])
+
+    def test_no_time(self):
+        # without any recorded time, cases are spread evenly
+        shards = self._schedule([None] * 7, 3)
+        self.assertEqual(sorted(len(shard) for shard in shards), [2, 2, 3])
+
+    def test_more_shards(self):
+        shards = self._schedule([10, 20], 3)
+        self.assertEqual(sorted(shards), [[], [0], [1]])
+
+    def test_case_time(self):
+        for time in range(1, 13):
+            self.case_time.add('a', time)
+        self.assertEqual(self.case_time.times['a'], range(3, 13))
+        self.assertEqual(self.case_time.get('a'), 8)
+        self.assertEqual(self.case_time.get_percentile('a', 90), 12)
+        self.assertEqual(self.case_time.get_percentile('a', 90, min_count=20), None)
+        self.assertEqual(self.case_time.get('b'), None)
+        self.case_time.save()
+        self.assertEqual(CaseTime(self.case_time.file_path).times, self.case_time.times)
+
+
+if __name__ == '__main__':
+    unittest.main()
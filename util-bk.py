@@ -7,16 +7,20 @@ import json
 import logging
 import os
 import platform
+import Queue
 import re
 import urllib2
 import shutil
 import socket
 import subprocess
 import sys
+import threading
 import time
 import Tkinter as tk
 from Tkinter import *
 
+from conformance import BuildCache
+
 try:
     import selenium
     from selenium import webdriver
@@ -46,6 +50,17 @@ class Diag(object):
         parser.add_argument('--android-device-id', dest='android_device_id', help='id of Android device to run test on')
         parser.add_argument('--logging-level', dest='logging_level', help='level of logging', default=logging.INFO)
 
+        bisect_group = parser.add_argument_group('bisect')
+        bisect_group.add_argument('--bisect-store', dest='bisect_store', help='directory of browser builds to add to build cache, one directory or archive per revision named by the revision')
+        bisect_group.add_argument('--bisect-build-cache-dir', dest='bisect_build_cache_dir', help='build cache of conformance.py, which holds the builds to bisect', default='build')
+        bisect_group.add_argument('--bisect-good', dest='bisect_good', help='good revision')
+        bisect_group.add_argument('--bisect-bad', dest='bisect_bad', help='bad revision')
+        bisect_group.add_argument('--bisect-browser-relpath', dest='bisect_browser_relpath', help='path of browser executable in a build, default is the one of Chromium snapshots on host OS decided by conformance.py')
+        bisect_group.add_argument('--bisect-version', dest='bisect_version', help='WebGL conformance test version', default='2.0.1')
+        bisect_group.add_argument('--bisect-suite', dest='bisect_suite', help='cases to test for each revision', default='all')
+        bisect_group.add_argument('--bisect-criterion', dest='bisect_criterion', help='minimum pass rate in percent for a revision to be good', type=float, default=100)
+        bisect_group.add_argument('--bisect-jobs', dest='bisect_jobs', help='number of revisions probed in parallel each round', type=int, default=3)
+
         debug_group = parser.add_argument_group('debug')
         debug_group.add_argument('--fixed-time', dest='fixed_time', help='fixed time', action='store_true')
         self.args = parser.parse_args()
@@ -100,7 +115,11 @@ class Diag(object):
 
         self.browser = Browser(name=browser_name, path=self.args.browser_path, options=browser_options, os=self.target_os)
 
+        self.bisect_thread = None
+        self.bisect_messages = Queue.Queue()
+
         root = Tk()
+        self.root = root
         root.title("Chrome Diagnostic Tool")
         width = 1024
         height = 768
@@ -173,8 +192,205 @@ class Diag(object):
 
         self.diag_listbox.insert(END, 'GPU: %s' % self.gpu)
 
+    # Bisect runs in background, and its messages are moved to listbox by Tk
+    # main loop, as Tk is not thread safe.
     def bisect(self):
-        pass
+        if self.bisect_thread and self.bisect_thread.is_alive():
+            self.bisect_listbox.insert(END, 'Bisect is still running')
+            return
+        args = self.args
+        if not args.bisect_good or not args.bisect_bad:
+            self.bisect_listbox.insert(END, 'Please designate --bisect-good and --bisect-bad')
+            return
+
+        conformance_args = ['--browser-name', 'chrome', '--version', args.bisect_version, '--suite', args.bisect_suite]
+        if args.webdriver_path:
+            conformance_args += ['--webdriver-path', args.webdriver_path]
+        if args.browser_options:
+            conformance_args += ['--browser-options', args.browser_options]
+        work_dir = 'ignore/bisect/%s' % Util.get_datetime()
+        bisector = Bisector(args.bisect_build_cache_dir, args.bisect_browser_relpath, conformance_args, args.bisect_criterion, args.bisect_jobs, work_dir, log=self.bisect_messages.put)
+
+        def run():
+            try:
+                if args.bisect_store:
+                    bisector.add_builds(args.bisect_store)
+                bisector.run(args.bisect_good, args.bisect_bad)
+            except (Exception, SystemExit) as e:
+                self.bisect_messages.put('Bisect failed: %s' % e)
+
+        self.bisect_thread = threading.Thread(target=run)
+        self.bisect_thread.daemon = True
+        self.bisect_thread.start()
+        self._poll_bisect()
+
+    def _poll_bisect(self):
+        while True:
+            try:
+                self.bisect_listbox.insert(END, self.bisect_messages.get_nowait())
+            except Queue.Empty:
+                break
+        if self.bisect_thread.is_alive() or not self.bisect_messages.empty():
+            self.root.after(500, self._poll_bisect)
+
+
+# Find the first bad revision between a good and a bad one. The builds are kept
+# in the build cache of conformance.py, and each probe runs conformance.py on
+# the suite with the build of a revision, and the revision is good if the pass
+# rate of the suite reaches criterion without any crash or timeout. Each round
+# probes jobs revisions evenly spread in the range in parallel, so the range
+# shrinks to 1/(jobs + 1) of it. A revision whose probe fails on its own, e.g.,
+# the build is broken, is skipped rather than judged.
+class Bisector(object):
+    BAD_STATUSES = ['CRASH', 'PYTIMEOUT', 'JSTIMEOUT']
+    PROBE_ATTEMPTS = 2
+
+    ARCHIVE_EXTENSIONS = ['.zip', '.tar.gz', '.tgz', '.tar.bz2', '.tar']
+
+    def __init__(self, build_cache_dir, browser_relpath, conformance_args, criterion, jobs, work_dir, log=None):
+        self._logger = Util.get_logger()
+        self.build_cache_dir = build_cache_dir
+        self.browser_relpath = browser_relpath
+        self.conformance_args = conformance_args
+        self.criterion = criterion
+        self.jobs = jobs
+        self.work_dir = work_dir
+        self.log = log
+
+    # Add the builds of store_dir missing in build cache, either a directory
+    # <store>/<revision> or an archive <store>/<revision>.zip|.tar.gz|...
+    def add_builds(self, store_dir):
+        revisions = self.get_revisions()
+        builds = []
+        for name in sorted(os.listdir(store_dir)):
+            path = '%s/%s' % (store_dir, name)
+            revision = None
+            if os.path.isdir(path):
+                revision = name
+            for extension in self.ARCHIVE_EXTENSIONS:
+                if name.endswith(extension):
+                    revision = name[:-len(extension)]
+                    break
+            if revision and revision not in revisions:
+                builds.append('%s=%s' % (revision, path))
+        if not builds:
+            return
+        self._log('Add %s builds to build cache' % len(builds))
+        if self._run_conformance(['--build-add', ','.join(builds)])[0]:
+            raise ValueError('Could not add builds of %s to build cache' % store_dir)
+
+    # revisions are commit positions, or sorted as strings otherwise
+    def get_revisions(self):
+        if not os.path.exists(self.build_cache_dir):
+            return []
+        # budget is only used to add builds
+        revisions = [revision for (revision, _, _) in BuildCache(self.build_cache_dir, 0).get_builds()]
+        if all(re.match('^\d+$', revision) for revision in revisions):
+            return sorted(revisions, key=int)
+        return sorted(revisions)
+
+    def run(self, good, bad):
+        revisions = self.get_revisions()
+        for revision in [good, bad]:
+            if revision not in revisions:
+                raise ValueError('Could not find build of revision %s' % revision)
+        (low, high) = (revisions.index(good), revisions.index(bad))
+        if low >= high:
+            raise ValueError('Good revision %s should be earlier than bad revision %s' % (good, bad))
+
+        round = 0
+        skipped = set()
+        while True:
+            candidates = [index for index in range(low + 1, high) if index not in skipped]
+            if not candidates:
+                break
+            round += 1
+            count = min(self.jobs, len(candidates))
+            points = sorted(set(candidates[len(candidates) * (point + 1) // (count + 1)] for point in range(count)))
+            self._log('Round %s: %s revisions left, probe %s' % (round, len(candidates), ', '.join(revisions[point] for point in points)))
+            results = {}
+            threads = []
+            for point in points:
+                thread = threading.Thread(target=lambda point=point: results.update({point: self._probe(revisions[point])}))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+            for point in points:
+                if results[point] is None:
+                    self._log('%s is skipped' % revisions[point])
+                    skipped.add(point)
+                    continue
+                self._log('%s is %s' % (revisions[point], 'good' if results[point] else 'bad'))
+                if results[point]:
+                    low = point
+                else:
+                    high = point
+                    break
+
+        untested = [revisions[index] for index in range(low + 1, high)]
+        if untested:
+            self._log('First bad revision is one of %s, %s, as they could not be tested. Last good revision is %s' % (', '.join(untested), revisions[high], revisions[low]))
+        else:
+            self._log('First bad revision is %s, last good revision is %s' % (revisions[high], revisions[low]))
+        return revisions[high]
+
+    # True for good, False for bad, and None if the revision couldn't be tested
+    def _probe(self, revision):
+        for attempt in range(self.PROBE_ATTEMPTS):
+            result = self._probe_once(revision)
+            if result is not None:
+                return result
+        return None
+
+    def _probe_once(self, revision):
+        probe_dir = '%s/%s' % (self.work_dir, revision)
+        Util.ensure_nodir(probe_dir)
+        Util.ensure_dir(probe_dir)
+        browser_path = 'build:' + revision
+        if self.browser_relpath:
+            browser_path += '/' + self.browser_relpath
+        cmd = [sys.executable, 'conformance.py', '--build-cache-dir', self.build_cache_dir, '--browser-path', browser_path, '--log-dir', probe_dir + '/log', '--result-dir', probe_dir + '/result', '--user-data-dir', probe_dir + '/user-data-dir', '--export', 'jsonl'] + self.conformance_args
+        self._logger.info('[CMD]: %s' % ' '.join(cmd))
+        output = open('%s/output.txt' % probe_dir, 'w')
+        status = subprocess.call(cmd, stdout=output, stderr=subprocess.STDOUT)
+        output.close()
+
+        result_dir = probe_dir + '/result'
+        result_files = []
+        if os.path.exists(result_dir):
+            result_files = [name for name in os.listdir(result_dir) if name.endswith('.jsonl')]
+        if status or not result_files:
+            self._log('Probe of %s failed with status %s, see %s/output.txt' % (revision, status, probe_dir))
+            return None
+
+        # the last record of a case is its final result
+        cases = {}
+        f = open('%s/%s' % (result_dir, result_files[0]))
+        for line in f:
+            record = json.loads(line)
+            if record['record'] in ['firstrun', 'retry']:
+                cases[record['path']] = record
+        f.close()
+        total_count = sum(case['total_count'] for case in cases.values())
+        pass_count = sum(case['pass_count'] for case in cases.values())
+        if any(case['status'] in self.BAD_STATUSES for case in cases.values()):
+            return False
+        if total_count == 0:
+            return True
+        return float(pass_count) / total_count * 100 >= self.criterion
+
+    def _run_conformance(self, args):
+        cmd = [sys.executable, 'conformance.py', '--build-cache-dir', self.build_cache_dir] + args
+        self._logger.info('[CMD]: %s' % ' '.join(cmd))
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        return (process.returncode, output)
+
+    def _log(self, msg):
+        self._logger.info(msg)
+        if self.log:
+            self.log(msg)
 
 
 class Cmd(object):